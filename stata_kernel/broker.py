@@ -0,0 +1,457 @@
+"""Broker that shares a few Stata consoles among many kernels
+
+Site licenses cap how many Stata processes run at once, while most notebooks
+sit idle most of the time. The broker runs at most `--size` consoles and
+lends one to a kernel for each execution:
+
+    STATA_KERNEL_AGENT_TOKEN=... python -m stata_kernel.broker --size 4
+
+Kernels connect to it with `remote_agent` and `remote_agent_token` as they
+would to an agent (see `remote.py`), and say when an execution is `DONE`.
+A console stays with its kernel until another kernel needs it and none is
+free. Then the first kernel's state (what `%checkpoint` saves, and the
+working directory, linesize and open logs) is saved to the cache directory
+with `_StataKernelPark`, the console is cleared, and the next kernel's
+state, if it had any, is loaded. Stata is
+started with `stata_path` from the broker's own configuration.
+
+`python -m stata_kernel.broker --stats` prints how many consoles are leased,
+how many kernels wait for one, and how long they waited.
+"""
+
+import os
+import json
+import shutil
+import select
+import socket
+import threading
+import pexpect
+
+from uuid import uuid4
+from argparse import ArgumentParser
+from collections import deque
+from timeit import default_timer
+
+from . import __version__
+from .config import config
+from .code_manager import CodeManager
+from .stata_session import StataSession
+from .remote import (
+    Agent, AgentHandler, TOKEN_ENVVAR_NAME, HELLO, INPUT, DONE, STATS,
+    frame, exit_frame, output_frame, unframe)
+
+
+class Owner():
+    """Kernel connected to the broker, and where its state is parked
+
+    Attributes:
+        parked (bool): whether its state is saved in the directory `path`
+            instead of being in a console
+        lost (dict or None): exit status of a console that exited with its
+            state, which the kernel is told about with its next input
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.parked = False
+        self.lost = None
+
+    def forget(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+class Console():
+    """Console of the pool, and the kernel whose state it has"""
+
+    def __init__(self, session):
+        self.session = session
+        self.owner = None
+        self.busy = True
+        self.dirty = False
+        self.last_used = default_timer()
+
+
+class PooledSession(StataSession):
+    """Console of the broker, always started on this host"""
+
+    def spawn(self):
+        return pexpect.spawn(
+            config.get('stata_path'), encoding='utf-8', codec_errors='replace')
+
+    def start_log_console(self):
+        # Kernels read the pty, which the broker passes on
+        pass
+
+
+class Quiet():
+    """Stand-in for the kernel for the broker's own commands"""
+    implementation_version = __version__
+    graph_formats = []
+    iopub_socket = None
+
+    def send_response(self, stream, msg_type, content):
+        pass
+
+    def graph_messages(self, graph_paths):
+        return []
+
+
+class Pool():
+    """Consoles lent to kernels, at most `size` of them
+
+    Args:
+        spawn (Callable[[], StataSession]): starts another console
+        size (int): most consoles to run at once
+    """
+
+    def __init__(self, spawn, size):
+        self.spawn = spawn
+        self.size = size
+        self.consoles = []
+        self.starting = 0
+        self.queued = 0
+        self.leases = 0
+        self.latencies = deque(maxlen=1000)
+        self.changed = threading.Condition()
+
+    def acquire(self, owner):
+        """Lend a console to `owner`, with its state, waiting for one if all
+        are busy
+
+        Returns:
+            (Console)
+        """
+        start = default_timer()
+        while True:
+            console, previous = self.take(owner)
+            if console is None:
+                console = self.start(owner)
+            try:
+                self.switch(console, previous, owner)
+                break
+            except pexpect.EOF:
+                self.discard(console)
+
+        with self.changed:
+            self.leases += 1
+            self.latencies.append(default_timer() - start)
+        os.set_blocking(console.session.child.child_fd, False)
+        return console
+
+    def take(self, owner):
+        """Pick the console to lend to `owner`
+
+        In order of preference: the console that has its state already, a
+        console without state, a console that isn't started yet, and the
+        console that was used least recently.
+
+        Returns:
+            (Console or None, Owner or None): None instead of a console if
+            one should be started, and whose state the console has
+        """
+        with self.changed:
+            self.queued += 1
+            try:
+                while True:
+                    idle = [c for c in self.consoles if not c.busy]
+                    choices = [c for c in idle if c.owner is owner]
+                    choices = choices or [c for c in idle if c.owner is None]
+                    if not choices:
+                        if len(self.consoles) + self.starting < self.size:
+                            self.starting += 1
+                            return None, None
+                        choices = sorted(idle, key=lambda c: c.last_used)
+                    if choices:
+                        console = choices[0]
+                        previous = console.owner
+                        console.busy = True
+                        console.owner = owner
+                        return console, previous
+                    self.changed.wait()
+            finally:
+                self.queued -= 1
+
+    def start(self, owner):
+        try:
+            console = Console(self.spawn())
+        except BaseException:
+            with self.changed:
+                self.starting -= 1
+                self.changed.notify_all()
+            raise
+
+        console.owner = owner
+        with self.changed:
+            self.starting -= 1
+            self.consoles.append(console)
+        return console
+
+    def switch(self, console, previous, owner):
+        """Swap the state in the console for that of `owner`"""
+        session = console.session
+        if previous is owner:
+            return
+
+        if previous is not None:
+            try:
+                quietly(
+                    session, '_StataKernelPark save `"{}"\''.format(
+                        previous.path))
+            except pexpect.EOF:
+                previous.lost = exit_status(session)
+                raise
+            previous.parked = True
+        if console.dirty:
+            quietly(session, 'clear all\nmacro drop _all')
+        if owner.parked:
+            quietly(
+                session, '_StataKernelPark restore `"{}"\''.format(owner.path))
+            owner.parked = False
+
+        # Output left from the broker's commands is skipped by the kernel
+        session.child.buffer = ''
+
+    def release(self, console):
+        """Take the console back after an execution; its state stays in it"""
+        os.set_blocking(console.session.child.child_fd, True)
+        with self.changed:
+            console.busy = False
+            console.dirty = True
+            console.last_used = default_timer()
+            self.changed.notify_all()
+
+    def discard(self, console, exited=False):
+        """Stop using a console whose Stata exited or was left busy
+
+        Args:
+            exited (bool): whether Stata is exiting, so that it can be waited
+                for instead of being killed
+
+        Returns:
+            (dict): exit status of the console
+        """
+        with self.changed:
+            if console in self.consoles:
+                self.consoles.remove(console)
+            self.changed.notify_all()
+        if exited:
+            console.session.child.wait()
+        console.session.child.close(force=True)
+        return exit_status(console.session)
+
+    def forget(self, owner):
+        """Free the consoles of a kernel that disconnected"""
+        busy = []
+        with self.changed:
+            for console in self.consoles:
+                if console.owner is not owner:
+                    continue
+                if console.busy:
+                    # It may still be running the kernel's code
+                    busy.append(console)
+                else:
+                    console.owner = None
+            self.changed.notify_all()
+        for console in busy:
+            self.discard(console)
+        owner.forget()
+
+    def stats(self):
+        with self.changed:
+            latencies = list(self.latencies)
+            stats = {
+                'size': self.size,
+                'running': len(self.consoles),
+                'leased': sum(c.busy for c in self.consoles),
+                'queued': self.queued,
+                'leases': self.leases,
+                'lease_latency': None}
+        if latencies:
+            stats['lease_latency'] = {
+                'last': latencies[-1],
+                'mean': sum(latencies) / len(latencies),
+                'max': max(latencies)}
+        return stats
+
+
+class BrokerHandler(AgentHandler):
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if not self.authenticate(sock):
+            return
+
+        owner = Owner(str(self.server.park_dir / uuid4().hex))
+        try:
+            # The kernel waits for a prompt before it sends anything
+            sock.sendall(output_frame(self.server.banner.encode('utf-8')))
+            self.relay(sock, owner)
+        except OSError:
+            # The kernel disconnected
+            pass
+        finally:
+            self.server.pool.forget(owner)
+
+    def relay(self, sock, owner):
+        pool = self.server.pool
+        received = bytearray()
+        to_console = bytearray()
+        console = fd = None
+        while True:
+            readers = [sock]
+            writers = []
+            if console is not None:
+                readers.append(fd)
+                if to_console:
+                    writers.append(fd)
+            readable, writable, _ = select.select(readers, writers, [])
+            if (fd is not None) and (fd in writable):
+                try:
+                    del to_console[:os.write(fd, to_console)]
+                except BlockingIOError:
+                    pass
+
+            if (fd is not None) and (fd in readable):
+                batch, ended = self.read_batch(fd)
+                if batch:
+                    sock.sendall(output_frame(batch))
+                if ended:
+                    status = pool.discard(console, exited=True)
+                    sock.sendall(exit_frame(**status))
+                    return
+
+            if sock not in readable:
+                continue
+            data = sock.recv(1 << 16)
+            if not data:
+                return
+            received += data
+            for kind, payload in unframe(received):
+                if kind == STATS:
+                    stats = json.dumps(pool.stats()).encode('utf-8')
+                    sock.sendall(frame(STATS, stats))
+                elif kind == INPUT:
+                    if console is None:
+                        if owner.lost is not None:
+                            sock.sendall(exit_frame(**owner.lost))
+                            return
+                        console = pool.acquire(owner)
+                        fd = console.session.child.child_fd
+                    to_console += payload
+                elif (kind == DONE) and (console is not None):
+                    to_console.clear()
+                    pool.release(console)
+                    console = fd = None
+
+
+class Broker(Agent):
+    """Server that lends a pool of consoles to the kernels that connect
+
+    Args:
+        token (str): secret that kernels have to send before anything else
+        size (int): most consoles to run at once
+        address (Tuple[str, int]): host and port to listen on
+    """
+
+    handler = BrokerHandler
+
+    def __init__(
+            self, token, size=2, address=('127.0.0.1', 0), batch_wait=0.005):
+        super(Broker, self).__init__(
+            config.get('stata_path'), token, address, batch_wait)
+        self.park_dir = config.get('cache_dir') / 'parked'
+        self.park_dir.mkdir(exist_ok=True)
+        self.banner = (
+            'stata_kernel broker: {} Stata consoles shared by all notebooks'
+            '\r\n. '.format(size))
+        self.started = 0
+        self.pool = Pool(self.start_console, size)
+
+    def start_console(self):
+        with self.pool.changed:
+            self.started += 1
+            name = 'console{}'.format(self.started)
+        return PooledSession(Quiet(), name=name)
+
+    def server_close(self):
+        super(Broker, self).server_close()
+        for console in self.pool.consoles:
+            console.session.child.close(force=True)
+
+
+def quietly(session, code):
+    cm = CodeManager(code)
+    text_to_run, md5, text_to_exclude = cm.get_text(session)
+    return session.do(
+        text_to_run, md5, text_to_exclude=text_to_exclude, display=False)
+
+
+def exit_status(session):
+    child = session.child
+    child.isalive()
+    return {'exitstatus': child.exitstatus, 'signalstatus': child.signalstatus}
+
+
+def stats(address, token, timeout=10):
+    """Ask the broker at `host:port` for its `Pool.stats`"""
+    host, _, port = address.strip().rpartition(':')
+    sock = socket.create_connection(
+        (host.strip('[]'), int(port)), timeout=timeout)
+    try:
+        sock.sendall(frame(HELLO, token.encode('utf-8')) + frame(STATS))
+        received = bytearray()
+        while True:
+            data = sock.recv(1 << 16)
+            if not data:
+                raise OSError('the broker closed the connection')
+            received += data
+            for kind, payload in unframe(received):
+                if kind == STATS:
+                    return json.loads(payload.decode('utf-8'))
+    finally:
+        sock.close()
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        prog='python -m stata_kernel.broker',
+        description=(
+            "Share a pool of Stata consoles among stata_kernel kernels. "
+            "Kernels connect with the remote_agent and remote_agent_token "
+            "settings. The token is read from ${}.".format(
+                TOKEN_ENVVAR_NAME)))
+    parser.add_argument(
+        '--host', default='127.0.0.1',
+        help="Address to listen on. The default only accepts connections "
+        "from this host, e.g. through an SSH tunnel.")
+    parser.add_argument(
+        '--port', type=int, default=8964, help="Port to listen on.")
+    parser.add_argument(
+        '--size', type=int, default=2,
+        help="Most Stata consoles to run at once.")
+    parser.add_argument(
+        '--stats', action='store_true',
+        help="Print the statistics of the broker at --host and --port.")
+    args = parser.parse_args(argv)
+
+    token = os.environ.get(TOKEN_ENVVAR_NAME)
+    if not token:
+        parser.error('${} must be set'.format(TOKEN_ENVVAR_NAME))
+
+    if args.stats:
+        address = '{}:{}'.format(args.host, args.port)
+        print(json.dumps(stats(address, token), indent=2))
+        return
+
+    broker = Broker(token, max(args.size, 1), (args.host, args.port))
+    print('Listening on {}:{}'.format(*broker.server_address), flush=True)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -31,6 +31,15 @@ base_graph_keywords = [
     r'tabodds', r'teffects\s+overlap', r'npgraph', r'grmap', r'pkexamine']
 
 
+def pdf_copy(graph_fmt):
+    """Whether graphs exported as `graph_fmt` are also exported as PDF"""
+    defaults = {'svg': 'True', 'png': 'False', 'eps': 'False'}
+    if graph_fmt not in defaults:
+        return False
+    setting = 'graph_{}_redundancy'.format(graph_fmt)
+    return config.get(setting, defaults[graph_fmt]).lower() == 'true'
+
+
 class CodeManager():
     """Class to deal with text before sending to Stata
     """
@@ -226,7 +235,8 @@ class CodeManager():
         code I sent it.
 
         Args:
-            stata: instance of Stata session
+            stata: instance of Stata session. Its cache directory is used for
+                the do file and graphs.
 
         Returns:
             (str, str, str):
@@ -264,18 +274,8 @@ class CodeManager():
         graph_scale = float(config.get('graph_scale', '1'))
         graph_width = int(config.get('graph_width', '600'))
         graph_height = config.get('graph_height')
-        cache_dir = config.get('cache_dir')
-        if graph_fmt == 'svg':
-            pdf_dup = config.get('graph_svg_redundancy', 'True')
-            pdf_dup = pdf_dup.lower() == 'true'
-        elif graph_fmt == 'png':
-            pdf_dup = config.get('graph_png_redundancy', 'False')
-            pdf_dup = pdf_dup.lower() == 'true'
-        elif graph_fmt == 'eps':
-            pdf_dup = config.get('graph_eps_redundancy', 'False')
-            pdf_dup = pdf_dup.lower() == 'true'
-        else:
-            pdf_dup = False
+        cache_dir = stata.cache_dir if stata else config.get('cache_dir')
+        pdf_dup = pdf_copy(graph_fmt)
 
         dim_str = " width({})".format(int(graph_width * graph_scale))
         if graph_height:
@@ -291,19 +291,27 @@ class CodeManager():
             cache_dir_str = re.sub(r'\\', '/', cache_dir_str)
         gph_cnt = 'stata_kernel_graph_counter'
 
+        # Export at the largest linesize, so that the note with the path of
+        # the graph doesn't wrap
         # yapf: disable
         if not pdf_dup:
             g_exp = dedent("""
             if _rc == 0 {{
+                global stata_kernel_linesize = `c(linesize)'
+                set linesize 255
                 noi gr export `"{0}/graph${1}.{2}"',{3} replace
+                set linesize $stata_kernel_linesize
                 global {1} = ${1} + 1
             }}\
             """.format(cache_dir_str, gph_cnt, graph_fmt, dim_str))
         else:
             g_exp = dedent("""
             if _rc == 0 {{
+                global stata_kernel_linesize = `c(linesize)'
+                set linesize 255
                 noi gr export `"{0}/graph${1}.{2}"',{3} replace
                 noi gr export `"{0}/graph${1}.pdf"', replace
+                set linesize $stata_kernel_linesize
                 global {1} = ${1} + 1
             }}\
             """.format(cache_dir_str, gph_cnt, graph_fmt, dim_str))
@@ -7,6 +7,10 @@ from .pygments._mata_builtins import mata_builtins
 from .config import config
 
 
+# Lists the locals of the top level, which a program can't see
+ALL_LOCALS = """mata : invtokens(st_dir("local", "macro", "*")')"""
+
+
 # NOTE: Add command completion (e.g. r<tab>; mata: st_<tab>)
 # NOTE: Add extended_fcn completions, `:<tab>
 # NOTE: Add sub-command completions for scalars and matrices?
@@ -14,6 +18,14 @@ class CompletionsManager():
     def __init__(self, kernel):
         self.kernel = kernel
 
+        # Whether Stata ran code since the suggestions were read; see
+        # `mark_stale`
+        self.stale = False
+
+        # Last listings of Mata objects and programs, which Stata can only
+        # print in full; see `parse_suggestions`
+        self.listings = {}
+
         # Path completion
         self.path_search = re.compile(
             r'^(?P<fluff>.*")(?P<path>[^"]*)\Z').search
@@ -102,10 +114,67 @@ class CompletionsManager():
         self.suggestions['magics_set'] = config.all_settings
 
     def refresh(self, kernel):
-        self.suggestions = self.get_suggestions(kernel)
+        self._run(self._refresh(kernel), kernel)
+
+    async def refresh_async(self, kernel):
+        """Same as `refresh`, without blocking the event loop"""
+        steps = self._refresh(kernel)
+        res = None
+        while True:
+            try:
+                code = steps.send(res)
+            except StopIteration:
+                return
+            res = await self.quickdo_async(code, kernel)
+
+    def _run(self, steps, kernel):
+        res = None
+        while True:
+            try:
+                code = steps.send(res)
+            except StopIteration as stop:
+                return stop.value
+            res = self.quickdo(code, kernel)
+
+    def _refresh(self, kernel):
+        # Yields the code to run in Stata and is sent back its output, so
+        # that `refresh` and `refresh_async` share the parsing.
+        self.suggestions = yield from self._get_suggestions()
         self.suggestions['magics'] = kernel.magics.available_magics
         self.suggestions['magics_set'] = config.all_settings
-        self.globals = self.get_globals(kernel)
+        self.globals = yield from self._get_globals()
+        self.stale = False
+
+    def update(self, kernel, completions, all_locals, macros):
+        """Same as `refresh`, from output that was already read
+
+        Args:
+            completions (str): output of `_StataKernelCompletions, changed`
+            all_locals (str): output of `ALL_LOCALS`
+            macros (str): output of `macro list` for all globals
+        """
+        self.suggestions = self.parse_suggestions(
+            self.matchall(completions), all_locals, self.suggestions)
+        self.suggestions['magics'] = kernel.magics.available_magics
+        self.suggestions['magics_set'] = config.all_settings
+        self.globals = self.parse_globals(macros)
+        self.stale = False
+
+    def mark_stale(self, logfiles=None):
+        """Note that Stata ran code since the suggestions were read
+
+        With `autocomplete_refresh = lazy`, or while more cells are queued,
+        they are read again when a completion needs them. The
+        open log files are kept up to date when listed, for
+        `StataKernel.cleanTail`.
+
+        Args:
+            logfiles (str or None): log files listed by `_StataKernelPostHook`
+        """
+        if logfiles is not None:
+            self.suggestions['logfiles'] = [
+                f for f in self.filelist.split(logfiles.strip()) if f]
+        self.stale = True
 
     def get_env(self, code, rdelimit, sc_delimit_mode, mata_mode):
         """Returns completions environment
@@ -439,24 +508,49 @@ class CompletionsManager():
         return sorted(results)
 
     def get_suggestions(self, kernel):
-        match = self.matchall(self.quickdo('_StataKernelCompletions', kernel))
+        return self._run(self._get_suggestions(), kernel)
+
+    def _get_suggestions(self):
+        match = self.matchall((yield '_StataKernelCompletions'))
+        all_locals = ''
+        if match:
+            all_locals = yield ALL_LOCALS
+        return self.parse_suggestions(match, all_locals)
+
+    def parse_suggestions(self, match, all_locals, previous=None):
+        """Suggestions from the output of `_StataKernelCompletions`
+
+        Args:
+            match (re.Match): `matchall` of the output
+            all_locals (str): output of `ALL_LOCALS`
+            previous (dict): the last suggestions. Lists that the output
+                marks `%unchanged%`, and Mata objects and programs listed
+                the same as last time, are kept from it instead of parsed.
+        """
         if match:
             suggestions = match.groupdict()
-            suggestions['mata'] = self._parse_mata_desc(suggestions['mata'])
-            suggestions['programs'] = self._parse_programs_desc(
-                suggestions['programs'])
             for k, v in suggestions.items():
-                if k in ['mata', 'programs']:
-                    continue
+                if (previous is not None) and (
+                        (v.strip() == '%unchanged%') or
+                        (self.listings.get(k) == v)):
+                    suggestions[k] = previous.get(k, [])
+                elif k == 'mata':
+                    suggestions[k] = self._parse_mata_desc(v)
+                    self.listings[k] = v
+                elif k == 'programs':
+                    suggestions[k] = self._parse_programs_desc(v)
+                    self.listings[k] = v
                 elif k in ['logfiles']:
                     suggestions[k] = [
                         f for f in self.filelist.split(v.strip()) if f]
                 else:
                     suggestions[k] = self.varlist.findall(self.varclean('', v))
+                    if k == 'globals':
+                        suggestions[k] = [
+                            x for x in suggestions[k]
+                            if x != 'stata_kernel_graph_counter']
 
-            all_locals = """mata : invtokens(st_dir("local", "macro", "*")')"""
-            res = '\r\n'.join(
-                re.split(r'[\r\n]{1,2}', self.quickdo(all_locals, kernel)))
+            res = '\r\n'.join(re.split(r'[\r\n]{1,2}', all_locals))
             if res.strip():
                 suggestions['locals'] = self.varlist.findall(
                     self.varclean('', res))
@@ -472,14 +566,15 @@ class CompletionsManager():
                 'programs': [],
                 'locals': []}
 
-        suggestions['globals'] = [
-            x for x in suggestions['globals']
-            if x != 'stata_kernel_graph_counter']
-
         return suggestions
 
     def get_globals(self, kernel):
-        res = self.quickdo("macro list `:all globals'", kernel)
+        return self._run(self._get_globals(), kernel)
+
+    def _get_globals(self):
+        return self.parse_globals((yield "macro list `:all globals'"))
+
+    def parse_globals(self, res):
         vals = re.split(r'^(\w+):', res, flags=re.MULTILINE)
         # TODO: Check if leading line in output
         if not vals[0].strip():
@@ -492,7 +587,17 @@ class CompletionsManager():
         cm = CodeManager(code)
         text_to_run, md5, text_to_exclude = cm.get_text()
         rc, res = kernel.stata.do(
-            text_to_run, md5, text_to_exclude=text_to_exclude, display=False)
+            text_to_run, md5, text_to_exclude=text_to_exclude, display=False,
+            wide=True)
+        return res
+
+    async def quickdo_async(self, code, kernel):
+        code = kernel.stata._mata_escape(code)
+        cm = CodeManager(code)
+        text_to_run, md5, text_to_exclude = cm.get_text()
+        rc, res = await kernel.stata.do_async(
+            text_to_run, md5, interrupt=kernel.interrupt,
+            text_to_exclude=text_to_exclude, display=False, wide=True)
         return res
 
     def _parse_programs_desc(self, desc):
@@ -522,10 +627,7 @@ class CompletionsManager():
             items = items[:-1]
 
         # Remove stata-kernel ado files
-        files = [
-            '_StataKernelCompletions', '_StataKernelHead', '_StataKernelLog',
-            '_StataKernelTail']
-        items = [x for x in items if x not in files]
+        items = [x for x in items if not x.startswith('_StataKernel')]
 
         # Remove if period in name
         items = [x for x in items if '.' not in x]
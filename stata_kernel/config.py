@@ -19,7 +19,11 @@ USER_PATH_ENVVAR_NAME = 'STATA_KERNEL_USER_CONFIG_PATH'
 class Config():
     all_settings = [
         'autocomplete_closing_symbol',
+        'autocomplete_refresh',
+        'auto_restart',
         'cache_directory',
+        'cell_timeout',
+        'console_output',
         'execution_mode',
         'graph_format',
         'graph_height',
@@ -28,9 +32,36 @@ class Config():
         'graph_scale',
         'graph_svg_redundancy',
         'graph_width',
+        'output_flush_bytes',
+        'output_flush_interval',
+        'output_max_bytes',
+        'pager',
+        'parallel_pool_size',
+        'remote_agent',
+        'remote_agent_token',
+        'standby_session',
         'stata_path',
         'user_graph_keywords', ]  # yapf: ignore
 
+    # Settings that must parse as numbers, and the type to parse them with
+    numeric_settings = {
+        'cell_timeout': float,
+        'output_flush_bytes': int,
+        'output_flush_interval': float,
+        'output_max_bytes': int,
+        'parallel_pool_size': int, }  # yapf: ignore
+
+    # Settings that must be true or false
+    boolean_settings = [
+        'auto_restart',
+        'pager',
+        'standby_session', ]  # yapf: ignore
+
+    # Settings that must be one of a few values
+    choice_settings = {
+        'autocomplete_refresh': ['eager', 'lazy'],
+        'console_output': ['pty', 'log'], }  # yapf: ignore
+
     def __init__(self):
         """
         Load config both from a potential system-wide config file or from a
@@ -84,8 +115,10 @@ class Config():
         self._cache_temp_dir = TemporaryDirectory(dir=str(cache_par_dir))
         cache_dir = Path(self._cache_temp_dir.name)
 
-        stata_path = self.get('stata_path', find_path())
-        if not stata_path:
+        # Stata isn't needed on this host when it runs through an agent
+        remote = bool(self.get('remote_agent'))
+        stata_path = self.get('stata_path', find_path()) or ''
+        if not (stata_path or remote):
             self.raise_config_error('stata_path')
 
         if platform.system() == 'Darwin':
@@ -102,12 +135,49 @@ class Config():
         self.set('cache_dir', cache_dir)
         self.set('stata_path', stata_path)
         self.set('execution_mode', execution_mode)
-        if not self.get('stata_path'):
+        if not (self.get('stata_path') or remote):
             self.raise_config_error('stata_path')
 
     def get(self, key, backup=None):
         return self.env.get(key, backup)
 
+    def get_number(self, key, backup):
+        """Get a numeric setting
+
+        Values that don't parse (e.g. from a hand-edited config file) fall
+        back to `backup` instead of breaking every later execution.
+        """
+        try:
+            return self.numeric_settings[key](self.env.get(key, backup))
+        except (TypeError, ValueError):
+            return backup
+
+    def get_bool(self, key, backup):
+        """Get a setting that is true or false
+
+        Values are read from the config file as strings, so `False` must not
+        count as true just because it isn't empty.
+        """
+        val = self.env.get(key, backup)
+        if isinstance(val, str):
+            return val.strip().lower() in ['true', 'yes', 'on', '1']
+        return bool(val)
+
+    def is_valid(self, key, val):
+        """Whether `val` is an acceptable value for setting `key`"""
+        if key in self.boolean_settings:
+            return val.strip().lower() in [
+                'true', 'false', 'yes', 'no', 'on', 'off', '1', '0']
+        if key in self.choice_settings:
+            return val in self.choice_settings[key]
+        if key not in self.numeric_settings:
+            return True
+
+        try:
+            return self.numeric_settings[key](val) >= 0
+        except ValueError:
+            return False
+
     def set(self, key, val, permanent=False):
         if key.startswith('cache_dir'):
             val = Path(val).expanduser()
@@ -1,24 +1,45 @@
 import os
 import re
 import base64
+import signal
+import asyncio
+import threading
 import shutil
 import platform
 import html
+import pexpect
 
 from PIL import Image
 from pathlib import Path
 from textwrap import dedent
 from datetime import datetime
+from contextlib import contextmanager
 from xml.etree import ElementTree as ET
 from importlib.resources import files
 from ipykernel.kernelbase import Kernel
 
 from .config import config
-from .completions import CompletionsManager
+from .completions import ALL_LOCALS, CompletionsManager
 from .code_manager import CodeManager
+from .pool import SessionPool
 from .stata_session import StataSession
 from .stata_magics import StataMagics
 
+# Run after each cell; see `_StataKernelPostHook.ado`. The second one only
+# reads the linesize, working directory and log files.
+POST_HOOK = '\n'.join([
+    '_StataKernelPostHook begin', ALL_LOCALS,
+    '_StataKernelPostHook end completions'])
+POST_HOOK_LAZY = '\n'.join([
+    '_StataKernelPostHook begin', '_StataKernelPostHook end'])
+
+# Sections of its output, each after a line with its name
+post_hook = re.compile(
+    r'%locals%(?P<locals>.*?)^%linesize%\s*?^(?P<linesize>\d+)\s*?'
+    r'^%pwd%\s*?^(?P<pwd>.*?)\s*?'
+    r'(^%macros%(?P<macros>.*?)(?P<completions>^%mata%.*)'
+    r'|^%logfiles%(?P<logfiles>.*))\Z', flags=re.DOTALL + re.MULTILINE).search
+
 
 class StataKernel(Kernel):
     implementation = 'stata_kernel'
@@ -35,6 +56,10 @@ class StataKernel(Kernel):
         {'text': 'Stata Help', 'url': 'https://www.stata.com/features/documentation/'}
     ]  # yapf: disable
 
+    # Characters of a cell's output kept after it is sent to the front end,
+    # for trimming the end of Mata output
+    output_keep = 65536
+
     def __init__(self, *args, **kwargs):
         # Copy syntax highlighting files
         from_paths = [
@@ -72,9 +97,16 @@ class StataKernel(Kernel):
         self.language_version = self.stata.stata_version
         self.magics = StataMagics(self)
         self.completions = CompletionsManager(self)
-        self.quickdo('cap di "Set _rc to 0 initially"')
+        self.pool = SessionPool(self)
+        self.interrupt = None
+        self.post_hook_task = None
 
-    def do_execute(
+        cm = CodeManager('cap di "Set _rc to 0 initially"')
+        text_to_run, md5, text_to_exclude = cm.get_text()
+        self.stata.do(
+            text_to_run, md5, text_to_exclude=text_to_exclude, display=False)
+
+    async def do_execute(
             self, code, silent, store_history=True, user_expressions=None,
             allow_stdin=False):
         """Execute user code.
@@ -82,6 +114,11 @@ class StataKernel(Kernel):
         This is the function that Jupyter calls to run code. Must return a
         dictionary as described here:
         https://jupyter-client.readthedocs.io/en/stable/messaging.html#execution-results
+
+        Stata is run without blocking the event loop, so other messages are
+        handled while it runs. Magics still block. The post-hook is left to
+        run after the reply has been sent; see `settle`. While more requests
+        are queued, as with Run All, it waits for the last of them.
         """
         invalid_input_msg = """\
         stata_kernel error: code entered was incomplete.
@@ -105,6 +142,9 @@ class StataKernel(Kernel):
                 'traceback': [''],
                 'execution_count': self.execution_count}
 
+        # Magics can run code in Stata too
+        await self.settle()
+
         # Search for magics in the code
         code = self.magics.magic(code, self)
 
@@ -118,13 +158,29 @@ class StataKernel(Kernel):
         text_to_run, md5, text_to_exclude = cm.get_text(self.stata)
 
         # Execute code chunk
-        rc, res = self.stata.do(
-            text_to_run, md5, text_to_exclude=text_to_exclude)
-        res = self.stata._mata_restart(rc, res)
+        with self.interrupt_on_sigint():
+            try:
+                rc, res = await self.stata.do_async(
+                    text_to_run, md5, interrupt=self.interrupt,
+                    text_to_exclude=text_to_exclude, keep=self.output_keep,
+                    timeout=self.cell_timeout())
+            except pexpect.EOF as e:
+                rc = self.stata_exited(e)
+                # The cell didn't finish, so the delimiter didn't change
+                cm.ends_sc = self.sc_delimit_mode
+            else:
+                res = self.stata._mata_restart(rc, res)
 
-        # Post magic results, if applicable
-        self.magics.post(self)
-        self.post_do_hook()
+                # Post magic results, if applicable
+                self.magics.post(self)
+
+                # ipykernel sends the reply as soon as this returns, before
+                # the task gets to run. While more cells are queued, only
+                # what they need is read: the linesize, which their echo is
+                # matched at, the working directory and the logs.
+                completions = False if self.requests_queued() else None
+                self.post_hook_task = asyncio.ensure_future(
+                    self.post_do_hook(completions))
 
         # Alert if delimiter changed. NOTE: This compares the delimiter at the
         # end of the code block with that at the end of the previous code block.
@@ -149,37 +205,132 @@ class StataKernel(Kernel):
             return_obj['user_expressions'] = {}
         return return_obj
 
-    def post_do_hook(self):
-        """Things to do after running commands in Stata
-        """
+    def cell_timeout(self):
+        """Seconds the current cell may run, from `%timeout` or `cell_timeout`
 
-        store_rc = """\
-        tempname __user_rc
-        local `__user_rc' = _rc
+        Returns:
+            (float or None): None if the cell may run indefinitely
         """
-        self.quickdo(dedent(store_rc))
-        _rc, _res = self.cleanLogs("off")
+        if self.magics.timeout:
+            return self.magics.timeout
+        return config.get_number('cell_timeout', 0) or None
+
+    def stata_exited(self, error):
+        """Tell the user that Stata exited, and start it again
 
-        self.stata.linesize = int(self.quickdo("di `c(linesize)'"))
-        self.stata.cwd = self.quickdo("pwd")
-        self.completions.refresh(self)
+        With `auto_restart` off, Stata stays stopped, and cells fail the same
+        way until `%restart`.
+
+        Returns:
+            (int): return code for the cell
+        """
+        msg = '{}\n'.format(error)
+        if config.get_bool('auto_restart', True):
+            self.stata.restart()
+            self.sc_delimit_mode = False
+            self.completions.refresh(self)
+            msg += 'Stata was restarted; data and settings were lost.\n'
+        else:
+            msg += 'Use %restart to start it again.\n'
+
+        self.send_response(
+            self.iopub_socket, 'stream', {
+                'text': msg,
+                'name': 'stderr'})
+        return 1
+
+    @contextmanager
+    def interrupt_on_sigint(self):
+        """Turn SIGINT into setting `self.interrupt`
+
+        Jupyter interrupts the kernel with SIGINT, and ipykernel's handler
+        raises KeyboardInterrupt wherever the main thread happens to be,
+        which while awaiting Stata is inside the event loop. Like
+        `IPythonKernel`, only schedule a callback on the loop instead. The
+        break is then sent to Stata from the loop, by `StataSession.expect`.
+        """
+        loop = asyncio.get_running_loop()
+        self.interrupt = asyncio.Event()
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+
+        def handle_sigint(*args):
+            loop.call_soon_threadsafe(self.interrupt.set)
+
+        save_sigint = signal.signal(signal.SIGINT, handle_sigint)
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGINT, save_sigint)
+
+    def requests_queued(self):
+        """Whether more shell requests are waiting to be handled
+
+        Requests that reached the shell socket are moved to ipykernel's queue
+        first.
+        """
+        if self.shell_stream is not None:
+            self.shell_stream.flush()
+        queue = getattr(self, 'msg_queue', None)
+        return (queue is not None) and not queue.empty()
 
-        _rc, _res = self.cleanLogs("on")
+    async def settle(self):
+        """Wait for the post-hook of the last cell to finish
 
-        # Restore _rc
-        restore_rc = """\
-        _StataKernelResetRC, num(``__user_rc'')
-        macro drop _`__user_rc'
-        macro drop ___user_rc
+        Until it does, completions are served from the previous snapshot.
+        Anything else that runs code in Stata waits for it first.
         """
-        self.quickdo(dedent(restore_rc))
+        task, self.post_hook_task = self.post_hook_task, None
+        if task is None:
+            return
+        try:
+            await task
+        except pexpect.EOF:
+            # The next command finds Stata gone and says so
+            pass
+
+    async def post_do_hook(self, completions=None):
+        """Things to do after running commands in Stata
+
+        `_StataKernelPostHook` reads everything in one execution, with the
+        user's logs off and `_rc` kept. See `post_hook` for its output.
 
-    def quickdo(self, code):
+        Args:
+            completions (bool or None): whether to read the completions too,
+                instead of marking them stale until they are needed. None
+                goes by `autocomplete_refresh`.
+        """
+        if completions is None:
+            completions = config.get('autocomplete_refresh', 'eager') == 'eager'
+        res = await self.quickdo(POST_HOOK if completions else POST_HOOK_LAZY)
+        match = post_hook(res or '')
+        if match is None:
+            # List the completions in full next time, as they may not have
+            # been read
+            await self.quickdo('macro drop stata_kernel_signatures')
+            return
+
+        # Logs are on again for the linesize being set back
+        self.cleanTail(
+            self.stata._mata_escape('_StataKernelPostHook begin'),
+            self.stata.prompt_dot, trailing=100)
+        self.stata.linesize = int(match.group('linesize'))
+        self.stata.cwd = match.group('pwd')
+        if match.group('completions') is None:
+            self.completions.mark_stale(match.group('logfiles'))
+            return
+        self.completions.update(
+            self, match.group('completions'), match.group('locals'),
+            match.group('macros'))
+
+    async def quickdo(self, code, wide=True):
         code = self.stata._mata_escape(code)
         cm = CodeManager(code)
         text_to_run, md5, text_to_exclude = cm.get_text()
-        rc, res = self.stata.do(
-            text_to_run, md5, text_to_exclude=text_to_exclude, display=False)
+        rc, res = await self.stata.do_async(
+            text_to_run, md5, interrupt=self.interrupt,
+            text_to_exclude=text_to_exclude, display=False, wide=wide)
 
         if not rc:
             # Remove rmsg lines when rmsg is on
@@ -195,27 +346,21 @@ class StataKernel(Kernel):
 
             return res
 
-    def cleanLogs(self, what):
-        code = self.stata._mata_escape("_StataKernelLog {0}".format(what))
-        cm = CodeManager(code)
-        text_to_run, md5, text_to_exclude = cm.get_text()
-        rc, res = self.stata.do(
-            text_to_run, md5, text_to_exclude=text_to_exclude, display=False)
-
-        if what == 'off':
-            code = self.stata._mata_escape('_StataKernelLog {0}'.format(what))
-            self.cleanTail(code, self.stata.prompt_dot)
-        return rc, res
-
-    def send_image(self, graph_paths):
-        """Load graph and send to frontend
+    def graph_messages(self, graph_paths):
+        """Load graph and make the messages that display it in the frontend
 
         This supports SVG, PNG, and PDF formats. While PDF display isn't
         supported in Atom or Jupyter, the data can be stored within the Jupyter
         Notebook file and makes exporting images to PDF through LaTeX easier.
 
+        Graphs are loaded in a worker thread while Stata's output is read (see
+        `OutputBuffer.add_display`), so this must not send anything itself.
+
         Args:
             graph_paths (List[str]): path to exported graph
+
+        Returns:
+            (List[dict]): content of each `display_data` message
         """
 
         no_display_msg = 'This front-end cannot display the desired image type.'
@@ -320,14 +465,15 @@ class StataKernel(Kernel):
         """
         msg = dedent(msg)
         warn_setting = config.get('graph_redundancy_warning', 'True')
+        messages = []
         if warn and (warn_setting.lower() == 'true'):
-            self.send_response(
-                self.iopub_socket, 'display_data', {
-                    'data': {
-                        'text/plain': msg,
-                        'text/markdown': msg},
-                    'metadata': {}})
-        self.send_response(self.iopub_socket, 'display_data', content)
+            messages.append({
+                'data': {
+                    'text/plain': msg,
+                    'text/markdown': msg},
+                'metadata': {}})
+        messages.append(content)
+        return messages
 
     def do_shutdown(self, restart):
         """Shutdown the Stata session
@@ -336,6 +482,9 @@ class StataKernel(Kernel):
         kernel machinery will take care of cleaning up its own things before
         stopping.
         """
+        if self.post_hook_task is not None:
+            self.post_hook_task.cancel()
+        self.pool.shutdown()
         self.stata.shutdown()
         return {'restart': restart}
 
@@ -346,13 +495,19 @@ class StataKernel(Kernel):
 
         return {'status': 'incomplete', 'indent': '    '}
 
-    def do_complete(self, code, cursor_pos):
+    async def do_complete(self, code, cursor_pos):
         """Provide context-aware suggestions
         """
         env, pos, chunk, rcomp = self.completions.get_env(
             code[:cursor_pos], code[cursor_pos:(cursor_pos + 2)],
             self.sc_delimit_mode, self.stata.mata_mode)
 
+        # Magics don't need anything from Stata. While the last cell's
+        # post-hook runs, the previous snapshot is used unless it is stale.
+        if self.completions.stale and (env >= 0):
+            await self.settle()
+            await self.post_do_hook(completions=True)
+
         return {
             'metadata': {},
             'status': 'ok',
@@ -364,7 +519,7 @@ class StataKernel(Kernel):
         return CodeManager(
             code, self.sc_delimit_mode, self.stata.mata_mode).is_complete
 
-    def cleanTail(self, tail, rprompt):
+    def cleanTail(self, tail, rprompt, trailing=0):
         """
         Search from the end of all open log files for a kernel marker
         specified by tail, typically
@@ -374,7 +529,8 @@ class StataKernel(Kernel):
         rprompt is a regex for the prompt, typically a dot but it could
         be a `>` or a `:` (e.g. in mata). We only search up to 10 chars
         past the length of the marker for log files (unless it is a smcl
-        file, in which case we search up to 100 chars back).
+        file, in which case we search up to 100 chars back). `trailing` is
+        the most characters the marker's output can add after it.
         """
         ltail = len(tail)
         rtail = re.escape(tail[::-1]) + ' {0,2}'
@@ -386,11 +542,11 @@ class StataKernel(Kernel):
                 pos = fh.tell() - 1
                 # Note the search is inverted because we read from the end
                 if fext == '.smcl':
-                    maxread = pos - ltail - 100
+                    maxread = pos - ltail - 100 - trailing
                     rfind = rtail + '({0}|}}moc{{|[\\r\\n])'.format(rprompt)
                 else:
                     rfind = rtail + rprompt
-                    maxread = pos - ltail - 10
+                    maxread = pos - ltail - 10 - trailing
                 while (pos > maxread) and (re.search(rfind, lcmp) is None):
                     lcmp += fh.read(1)
                     pos -= 1
@@ -400,7 +556,42 @@ class StataKernel(Kernel):
                     fh.seek(pos + 1, os.SEEK_SET)
                     fh.truncate()
 
-    def do_inspect(self, code, cursor_pos, detail_level=0, metadata={}):
+    def cleanHead(self, sizes, marker):
+        """
+        Remove the lines the kernel sends before the user's code from log
+        files: everything from where each file ended before the code was
+        sent, as given by `sizes`, up to the end of the line with the
+        marker's output. The rest of the file is moved up in its place.
+        """
+        marker = marker.encode('utf-8')
+        for logfile, start in sizes.items():
+            try:
+                fh = open(logfile, 'r+b')
+            except OSError:
+                continue
+            with fh:
+                fh.seek(start)
+                head = fh.read(4096)
+                pos = head.find(marker)
+                eol = head.find(b'\n', pos + len(marker))
+                if (pos < 0) or (eol < 0):
+                    continue
+
+                read = start + eol + 1
+                write = start
+                while True:
+                    fh.seek(read)
+                    chunk = fh.read(1 << 20)
+                    if not chunk:
+                        break
+                    fh.seek(write)
+                    fh.write(chunk)
+                    read += len(chunk)
+                    write += len(chunk)
+                fh.truncate(write)
+
+    async def do_inspect(
+            self, code, cursor_pos, detail_level=0, metadata={}):
         inspect_keyword = re.compile(
             r'\b(?P<keyword>\w+)\(?\s*$', flags=re.MULTILINE).search
 
@@ -429,9 +620,10 @@ class StataKernel(Kernel):
             if ismata:
                 keyword = 'mf_' + keyword
 
+            await self.settle()
             cm = CodeManager('help ' + keyword)
             text_to_run, md5, text_to_exclude = cm.get_text()
-            rc, res = self.stata.do(
+            rc, res = await self.stata.do_async(
                 text_to_run, md5, text_to_exclude=text_to_exclude,
                 display=False)
 
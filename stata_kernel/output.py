@@ -0,0 +1,340 @@
+import re
+
+from uuid import uuid4
+from timeit import default_timer
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .config import config
+
+# Regex from: https://stackoverflow.com/a/45448194
+ansi_regex = r'\x1b(' \
+             r'(\[\??\d+[hl])|' \
+             r'([=<>a-kzNM78])|' \
+             r'([\(\)][a-b0-2])|' \
+             r'(\[\d{0,2}[ma-dgkjqi])|' \
+             r'(\[\d+;\d+[hfy]?)|' \
+             r'(\[;?[hf])|' \
+             r'(#[3-68])|' \
+             r'([01356]n)|' \
+             r'(O[mlnp-z]?)|' \
+             r'(/Z)|' \
+             r'(\d+)|' \
+             r'(\[\?\d;\d0c)|' \
+             r'(\d;\dR))'
+ansi_escape = re.compile(ansi_regex, flags=re.IGNORECASE)
+
+# Loads and encodes graphs while the console's output keeps being read
+graph_worker = ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix='stata_kernel_graphs')
+
+
+def normalize(lines, ansi=True):
+    """Text shown for lines of console output
+
+    Gives the same text as removing escape sequences from each line, adding
+    a newline and replacing `\\r\\n` with `\\n`, but works on all the
+    lines at once. No escape sequence contains a newline, so removing them
+    from the joined lines removes the same ones, and the regex isn't run at
+    all on the usual output that has none.
+
+    Args:
+        lines (List[str]): lines without their end of line characters
+        ansi (bool): whether to remove terminal escape sequences, which only
+            the console shows
+
+    Returns:
+        (str)
+    """
+    text = '\n'.join(lines) + '\n'
+    if ansi and ('\x1b' in text):
+        text = ansi_escape.sub('', text)
+    if '\r' in text:
+        text = text.replace('\r\n', '\n')
+    return text
+
+
+class OutputBuffer():
+    """Coalesce console output before sending it to the front end
+
+    `StataSession.expect` reads Stata's output one line at a time. Sending
+    each line as its own IOPub message floods the front end when a command
+    prints many lines (e.g. `list` on a large dataset), so lines are collected
+    here and sent as a single `stream` message once the buffer holds
+    `output_flush_bytes` characters or `output_flush_interval` milliseconds
+    have passed since the last flush.
+
+    Console lines given to `write_line` are held until `end_lines`, and then
+    cleaned up together with `normalize`, so that the cost per line stays
+    small for output-heavy cells.
+
+    Lines that are only whitespace are held back until a non-blank line
+    arrives, so that blank lines at the start and end of the output are
+    treated exactly as they were when each line was sent separately. Whether
+    anything but whitespace has been seen is tracked as lines arrive, so the
+    cost of each write doesn't depend on how much output came before it.
+
+    Everything written is also kept, to be returned as the result of the
+    command. With `keep` set, only about the last `keep` characters are, so
+    that memory use stays flat no matter how much a command prints.
+
+    At most `output_max_bytes` characters of a cell's output are sent. Past
+    90% of that, the output is written to a file in `cache_dir` instead, and
+    at the end of the cell the front end is told where that file is and sent
+    the last 10%.
+
+    Graphs given to `add_display` are loaded by a worker thread. Messages after
+    one wait in `queue` until the graph is ready, so that the front end gets
+    everything in order.
+    """
+
+    # Most lines held by `write_line` before they are cleaned up
+    max_lines = 512
+
+    def __init__(
+            self, kernel, display=True, name='stdout', keep=None,
+            cache_dir=None, ansi=False):
+        self.kernel = kernel
+        self.ansi = ansi
+        self.display = display
+        self.name = name
+        self.kept = Tail(keep)
+        self.cache_dir = cache_dir or config.get('cache_dir')
+        self.max_bytes = config.get_number('output_max_bytes', 5000000)
+        self.head = []
+        self.sent = 0
+        self.spill = None
+        self.tail = Tail(self.max_bytes // 10)
+        self.flush_bytes = config.get_number('output_flush_bytes', 65536)
+        self.flush_interval = config.get_number(
+            'output_flush_interval', 100) / 1000
+
+        self.lines = []
+        self.queue = deque()
+        self.buffer = []
+        self.size = 0
+        self.blank = []
+        self.any_disp = False
+        self.last_flush = default_timer()
+        self.messages = 0
+
+    def write_line(self, line):
+        """Add a line of console output, without its end of line"""
+        self.lines.append(line)
+        if len(self.lines) >= self.max_lines:
+            self.end_lines()
+
+    def end_lines(self):
+        """Write the lines given to `write_line` since the last call"""
+        if self.lines:
+            text = normalize(self.lines, self.ansi)
+            self.lines = []
+            self.write(text)
+
+    def write(self, text):
+        """Add text to the buffer, flushing if it is due"""
+        self.kept.append(text)
+        body = text.rstrip()
+        if not body:
+            self.blank.append(text)
+            return
+
+        # Hold back blank lines at the end as if they came on their own
+        cut = text.find('\n', len(body)) + 1 or len(text)
+        trailing = text[cut:]
+        text = text[:cut]
+        self.any_disp = True
+        if self.blank:
+            self.blank.append(text)
+            text = ''.join(self.blank)
+            self.blank = []
+        if trailing:
+            self.blank.append(trailing)
+
+        self.buffer.append(text)
+        self.size += len(text)
+        if (self.size >= self.flush_bytes) or (self.timeout() == 0):
+            self.flush()
+
+    def text(self):
+        """Text written so far, or its last `keep` characters"""
+        self.end_lines()
+        return self.kept.text()
+
+    def timeout(self):
+        """Seconds until the buffered text is due to be sent
+
+        Returns:
+            (float or None): None if there is nothing waiting to be sent.
+        """
+        if not (self.buffer or self.lines or self.queue):
+            return None
+
+        elapsed = default_timer() - self.last_flush
+        return max(self.flush_interval - elapsed, 0)
+
+    def flush(self):
+        """Send all buffered text to the front end"""
+        self.end_lines()
+        self.last_flush = default_timer()
+        self.ready()
+        if not self.buffer:
+            return
+
+        text = ''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        self.send(text)
+
+    def add_display(self, future):
+        """Send the display messages that `future` makes once it is done
+
+        Text written before is sent first, and messages after wait for these.
+
+        Args:
+            future (concurrent.futures.Future): gives a list of contents of
+                `display_data` messages
+        """
+        self.flush()
+        self.queue.append(future)
+        self.ready()
+
+    def ready(self, wait=False):
+        """Send the messages that no longer wait for a display
+
+        Args:
+            wait (bool): whether to wait for all displays to be done
+
+        Returns:
+            (concurrent.futures.Future or None): the display that the rest
+            still waits for
+        """
+        while self.queue:
+            item = self.queue[0]
+            if isinstance(item, Future):
+                if not (wait or item.done()):
+                    return item
+                self.queue.popleft()
+                for content in item.result():
+                    self.kernel.send_response(
+                        self.kernel.iopub_socket, 'display_data', content)
+            else:
+                self.queue.popleft()
+                self.kernel.send_response(self.kernel.iopub_socket, *item)
+        return None
+
+    def emit(self, msg_type, content):
+        """Send a message after the displays that are still being made"""
+        if self.queue:
+            self.queue.append((msg_type, content))
+        else:
+            self.kernel.send_response(
+                self.kernel.iopub_socket, msg_type, content)
+
+    def close(self):
+        """Flush at the end of the cell
+
+        Trailing blank lines are sent without their final newline, and only
+        if something other than whitespace was displayed.
+        """
+        self.flush()
+        blank = ''.join(self.blank)
+        blank = blank[:-1] if blank.endswith('\n') else blank
+        self.blank = []
+        if blank and self.any_disp:
+            self.send(blank)
+        if self.spill is not None:
+            self.close_spill()
+        self.ready(wait=True)
+
+    def send(self, text):
+        if not self.display:
+            return
+
+        if self.max_bytes and (self.spill is None):
+            room = self.max_bytes - self.tail.limit - self.sent
+            if len(text) > room:
+                # End the part that is shown at a line break if possible
+                cut = text.rfind('\n', 0, room) + 1
+                self.post(text[:cut])
+                self.open_spill()
+                text = text[cut:]
+
+        if self.spill is None:
+            self.post(text)
+        else:
+            self.spill.write(text)
+            self.tail.append(text)
+
+    def post(self, text):
+        if not text:
+            return
+
+        if self.max_bytes:
+            self.head.append(text)
+            self.sent += len(text)
+        self.messages += 1
+        self.emit('stream', {'text': text, 'name': self.name})
+
+    def open_spill(self):
+        """Start writing output to a file, beginning with what was sent"""
+        path = self.cache_dir / 'output-{}.log'.format(uuid4().hex[:8])
+        self.spill = path.open('w', encoding='utf-8')
+        self.spill.write(''.join(self.head))
+        self.head = []
+
+    def close_spill(self):
+        """Say where the full output is and send its last lines"""
+        self.spill.close()
+        # Getting the text can drop more of it
+        tail = self.tail.text()
+        omitted = self.tail.dropped
+        if omitted and ('\n' in tail):
+            cut = tail.index('\n') + 1
+            omitted += cut
+            tail = tail[cut:]
+
+        msg = (
+            '... {:,} characters of output not shown (output_max_bytes = {}).'
+            '\nThe full output is in {}\n').format(
+                omitted, self.max_bytes, self.spill.name)
+        self.messages += 2
+        self.emit('display_data', {'data': {'text/plain': msg}, 'metadata': {}})
+        self.emit('stream', {'text': tail, 'name': self.name})
+
+
+class Tail():
+    """The last `size` characters of text added in pieces
+
+    Pieces are dropped from the front as new ones arrive, so each `append`
+    takes constant time and at most one piece more than `size` is held.
+
+    Args:
+        size (int or None): characters to keep; None keeps everything
+    """
+
+    def __init__(self, size=None):
+        self.limit = size
+        self.pieces = deque()
+        self.size = 0
+        self.dropped = 0
+
+    def append(self, text):
+        self.pieces.append(text)
+        self.size += len(text)
+        if self.limit is None:
+            return
+
+        while self.size - len(self.pieces[0]) >= self.limit:
+            piece = self.pieces.popleft()
+            self.size -= len(piece)
+            self.dropped += len(piece)
+
+    def text(self):
+        text = ''.join(self.pieces)
+        if (self.limit is not None) and (len(text) > self.limit):
+            self.dropped += len(text) - self.limit
+            text = text[len(text) - self.limit:]
+            self.pieces = deque([text])
+            self.size = len(text)
+        return text
@@ -0,0 +1,227 @@
+import html
+import asyncio
+import pexpect
+
+from uuid import uuid4
+from timeit import default_timer
+
+from .config import config
+from .output import Tail
+from .code_manager import CodeManager
+from .stata_session import StataSession
+
+
+class SessionPool():
+    """Stata sessions that run `%parallel` cells next to the main session
+
+    Workers are started when first needed, up to `parallel_pool_size`, and
+    each has its own cache directory for do files and graphs. They don't
+    share anything with the main session or with each other, so code run in
+    them has to load its own data.
+    """
+
+    def __init__(self, kernel):
+        self.kernel = kernel
+        self.workers = []
+        self.idle = []
+        self.starting = 0
+        self.started = 0
+        self.released = None
+        self.tasks = set()
+
+    @property
+    def size(self):
+        return max(int(config.get_number('parallel_pool_size', 2)), 1)
+
+    def submit(self, code):
+        """Run code on the next idle worker without waiting for it
+
+        Output is shown in a display in the current cell, which is updated
+        as the worker sends output.
+        """
+        cell = ParallelCell(self.kernel)
+        task = asyncio.ensure_future(self.run(code, cell))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def run(self, code, cell):
+        worker = await self.acquire()
+        exited = False
+        try:
+            cell.start(worker.name)
+            worker.kernel = cell
+            cm = CodeManager(code)
+            text_to_run, md5, text_to_exclude = cm.get_text(worker)
+            rc, res = await worker.do_async(
+                text_to_run, md5, text_to_exclude=text_to_exclude,
+                keep=self.kernel.output_keep)
+        except pexpect.EOF as e:
+            exited = True
+            cell.send_response(
+                None, 'stream', {
+                    'text': '{}\n'.format(e),
+                    'name': 'stderr'})
+            rc, res = 1, ''
+        finally:
+            if exited:
+                self.discard(worker)
+            else:
+                self.release(worker)
+
+        cell.finish(rc)
+        return rc, res
+
+    async def acquire(self):
+        # Created here so that it belongs to the running loop
+        if self.released is None:
+            self.released = asyncio.Condition()
+
+        async with self.released:
+            while True:
+                if self.idle:
+                    return self.idle.pop()
+                if len(self.workers) + self.starting < self.size:
+                    break
+                await self.released.wait()
+            self.starting += 1
+            self.started += 1
+            name = 'worker{}'.format(self.started)
+
+        # Starting Stata blocks until it has run the init do-file
+        loop = asyncio.get_running_loop()
+        try:
+            worker = await loop.run_in_executor(
+                None, StataSession, self.kernel, name)
+        except BaseException:
+            self.notify()
+            raise
+        finally:
+            self.starting -= 1
+        self.workers.append(worker)
+        return worker
+
+    def release(self, worker):
+        self.idle.append(worker)
+        self.notify()
+
+    def discard(self, worker):
+        """Drop a worker whose Stata exited; a new one starts when needed"""
+        self.workers.remove(worker)
+        worker.shutdown()
+        self.notify()
+
+    def notify(self):
+        async def notify():
+            async with self.released:
+                self.released.notify()
+
+        asyncio.ensure_future(notify())
+
+    def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+        for worker in self.workers:
+            worker.shutdown()
+        self.workers = []
+        self.idle = []
+
+
+class ParallelCell():
+    """Stand-in for the kernel that shows a worker's output in its cell
+
+    The `%parallel` cell has finished by the time the worker sends output, so
+    frontends no longer route messages for it to the cell. Instead, the cell
+    gets one display when it runs, and the worker's text and graphs are
+    shown by updating that display (`update_display_data`).
+
+    Each update replaces the whole display, so updates are sent at most once
+    per `output_flush_interval`, and the display only shows the last
+    `output_max_bytes / 10` characters of text, as the worker's own output
+    buffer does once a cell prints too much.
+    """
+
+    def __init__(self, kernel):
+        self.kernel = kernel
+        self.iopub_socket = kernel.iopub_socket
+        self.graph_formats = kernel.graph_formats
+        self.implementation_version = kernel.implementation_version
+        self.display_id = uuid4().hex
+        self.status = '(queued)'
+        self.text = Tail(
+            config.get_number('output_max_bytes', 5000000) // 10 or None)
+        self.images = []
+        self.html = []
+        self.interval = config.get_number('output_flush_interval', 100) / 1000
+        self.last_update = 0
+        self.pending = None
+        self.send('display_data')
+
+    def start(self, name):
+        self.status = '(running on {})'.format(name)
+        self.update()
+
+    def finish(self, rc):
+        self.status = '(finished with r({}))'.format(rc) if rc else ''
+        self.update(now=True)
+
+    def send_response(self, stream, msg_type, content):
+        if msg_type == 'stream':
+            self.text.append(content['text'])
+        elif msg_type == 'display_data':
+            data = content['data']
+            if 'text/html' in data:
+                self.html.append(data['text/html'])
+            elif 'image/png' in data:
+                self.html.append('<img src="data:image/png;base64,{}">'.format(
+                    data['image/png']))
+            elif 'image/svg+xml' in data:
+                self.html.append(data['image/svg+xml'])
+            else:
+                # Such as where the full output is
+                self.text.append(data['text/plain'] + '\n')
+            self.images.append(data)
+        self.update()
+
+    def graph_messages(self, graph_paths):
+        return type(self.kernel).graph_messages(self, graph_paths)
+
+    def update(self, now=False):
+        """Show the output so far, or as soon as the interval has passed"""
+        if self.pending is not None:
+            if not now:
+                return
+            self.pending.cancel()
+            self.pending = None
+
+        wait = self.last_update + self.interval - default_timer()
+        if now or (wait <= 0):
+            self.send('update_display_data')
+        else:
+            self.pending = asyncio.get_running_loop().call_later(
+                wait, self.send_pending)
+
+    def send_pending(self):
+        self.pending = None
+        self.send('update_display_data')
+
+    def send(self, msg_type):
+        self.last_update = default_timer()
+        text = self.text.text()
+        if self.text.dropped:
+            # Start at a line
+            cut = text.find('\n') + 1
+            text = '... {:,} characters of output not shown\n{}'.format(
+                self.text.dropped + cut, text[cut:])
+        if self.status:
+            text += '\n' + self.status
+        parts = ['<pre>{}</pre>'.format(html.escape(text))] + self.html
+
+        self.kernel.send_response(
+            self.iopub_socket, msg_type, {
+                'data': {
+                    'text/plain': text,
+                    'text/html': '\n'.join(parts)},
+                'metadata': {},
+                'transient': {
+                    'display_id': self.display_id}})
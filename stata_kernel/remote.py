@@ -0,0 +1,391 @@
+"""Stata console on another host, run by a small agent
+
+Stata licenses are often tied to one compute node while notebooks run
+somewhere else. On the Stata host, run the agent:
+
+    STATA_KERNEL_AGENT_TOKEN=... python -m stata_kernel.remote /path/to/stata-mp
+
+and set `remote_agent` (`host:port`) and `remote_agent_token` in the kernel's
+configuration. Each connection gets its own console, which the agent runs in
+a pty like the kernel does locally, and which is killed when the connection
+closes.
+
+Both directions send frames: a byte for the kind of frame, the length of the
+payload as a 4-byte unsigned integer in network byte order, and the payload.
+The kernel first sends `HELLO` with the agent's token, then `INPUT` with
+what to write to the console, and `DONE` whenever an execution has finished.
+The agent sends the console's output in batches, as `OUTPUT` (compressed with
+zlib) or `RAW_OUTPUT` (when compressing doesn't help), and `EXIT` with the
+exit status as JSON when the console exits. A broker (see `broker.py`) speaks
+the same protocol, and also answers `STATS`.
+"""
+
+import os
+import hmac
+import json
+import zlib
+import select
+import socket
+import struct
+import secrets
+import socketserver
+import pexpect
+
+from pathlib import Path
+from argparse import ArgumentParser
+from timeit import default_timer
+from importlib.resources import files
+from pexpect.spawnbase import SpawnBase
+
+TOKEN_ENVVAR_NAME = 'STATA_KERNEL_AGENT_TOKEN'
+
+HELLO = b'H'
+INPUT = b'I'
+OUTPUT = b'O'
+RAW_OUTPUT = b'R'
+EXIT = b'X'
+DONE = b'D'
+STATS = b'S'
+
+HEADER = struct.Struct('!cI')
+MAX_FRAME = 1 << 26
+
+
+def frame(kind, payload=b''):
+    return HEADER.pack(kind, len(payload)) + payload
+
+
+def output_frame(data, compress_from=512):
+    """Frame a batch of output, compressed unless that doesn't help"""
+    if len(data) >= compress_from:
+        packed = zlib.compress(data, 1)
+        if len(packed) < len(data):
+            return frame(OUTPUT, packed)
+    return frame(RAW_OUTPUT, data)
+
+
+def exit_frame(exitstatus, signalstatus):
+    status = {'exitstatus': exitstatus, 'signalstatus': signalstatus}
+    return frame(EXIT, json.dumps(status).encode('utf-8'))
+
+
+def unframe(buffer):
+    """Take the complete frames off the start of `buffer`
+
+    Args:
+        buffer (bytearray): bytes received so far; complete frames are
+            removed from it
+
+    Returns:
+        (List[Tuple[bytes, bytes]]): kind and payload of each frame
+
+    Raises:
+        ValueError: a frame is larger than any frame sent by the other side
+    """
+    frames = []
+    start = 0
+    while len(buffer) - start >= HEADER.size:
+        kind, size = HEADER.unpack_from(buffer, start)
+        if size > MAX_FRAME:
+            raise ValueError('frame of {} bytes is too large'.format(size))
+        end = start + HEADER.size + size
+        if len(buffer) < end:
+            break
+        frames.append((kind, bytes(buffer[start + HEADER.size:end])))
+        start = end
+    del buffer[:start]
+    return frames
+
+
+class RemoteConsole(SpawnBase):
+    """Console run by an agent, with the interface of `pexpect.spawn`
+
+    The socket takes the place of the pty: the event loop waits for it to be
+    readable, and `read_nonblocking` returns output as it is decoded from
+    the agent's batches. Breaks are sent as the control characters a
+    terminal would send.
+
+    Args:
+        address (str): `host:port` of the agent
+        token (str): the agent's token
+    """
+
+    def __init__(
+            self, address, token, timeout=30, encoding='utf-8',
+            codec_errors='replace'):
+        super(RemoteConsole, self).__init__(
+            timeout=timeout, encoding=encoding, codec_errors=codec_errors)
+        host, _, port = address.strip().rpartition(':')
+        self.sock = socket.create_connection(
+            (host.strip('[]'), int(port)), timeout=timeout)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.child_fd = self.sock.fileno()
+        self.name = '<stata_kernel agent at {}>'.format(address)
+        self.received = bytearray()
+        self.pending = []
+        self.closed = False
+        self.terminated = False
+        self.sock.sendall(frame(HELLO, token.encode('utf-8')))
+
+    def read_nonblocking(self, size=1, timeout=-1):
+        """Return the output received so far, waiting for some if needed
+
+        Unlike a pty, this can return more than `size` characters. Output
+        arrives in batches, and all of a batch is returned at once, so that
+        more output is waiting exactly when the socket is readable.
+
+        Raises:
+            pexpect.TIMEOUT: no output arrived within `timeout`
+            pexpect.EOF: the console exited or the connection was lost
+        """
+        if timeout == -1:
+            timeout = self.timeout
+        deadline = None if timeout is None else default_timer() + timeout
+        while not self.pending:
+            if self.terminated:
+                self.flag_eof = True
+                raise pexpect.EOF('The remote Stata console exited.')
+            wait = None
+            if deadline is not None:
+                wait = max(deadline - default_timer(), 0)
+            if not select.select([self.child_fd], [], [], wait)[0]:
+                raise pexpect.TIMEOUT('Timeout exceeded.')
+            self._receive()
+
+        text = ''.join(self.pending)
+        self.pending = []
+        return text
+
+    def _receive(self):
+        try:
+            data = self.sock.recv(1 << 18)
+        except OSError:
+            data = b''
+        if not data:
+            self.terminated = True
+            return
+
+        self.received += data
+        for kind, payload in unframe(self.received):
+            if kind == EXIT:
+                status = json.loads(payload.decode('utf-8'))
+                self.exitstatus = status['exitstatus']
+                self.signalstatus = status['signalstatus']
+                self.terminated = True
+                continue
+            if kind == OUTPUT:
+                payload = zlib.decompress(payload)
+            text = self._decoder.decode(payload, final=False)
+            self._log(text, 'read')
+            self.pending.append(text)
+
+    def send(self, s):
+        s = self._coerce_send_string(s)
+        self._log(s, 'send')
+        b = self._encoder.encode(s, final=False)
+        self.send_frame(INPUT, b)
+        return len(b)
+
+    def sendline(self, s=''):
+        return self.send(s + self.linesep)
+
+    def sendcontrol(self, char):
+        return self.send(chr(ord(char.lower()) & 0x1f))
+
+    def done(self):
+        """Tell the agent that the execution has finished
+
+        A broker may then lend the console to another kernel until this one
+        sends more input.
+        """
+        self.send_frame(DONE)
+
+    def send_frame(self, kind, payload=b''):
+        try:
+            self.sock.sendall(frame(kind, payload))
+        except OSError:
+            # The agent is gone; reading reports the end of the output
+            self.terminated = True
+
+    def isalive(self):
+        """Whether the console runs, as far as the output read so far says"""
+        return not self.terminated
+
+    def close(self, force=True):
+        """Disconnect, which makes the agent kill the console"""
+        if not self.closed:
+            self.sock.close()
+            self.child_fd = -1
+            self.closed = True
+            self.terminated = True
+
+
+class AgentHandler(socketserver.BaseRequestHandler):
+    max_batch = 1 << 20
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if not self.authenticate(sock):
+            return
+
+        child = pexpect.spawn(self.server.command)
+        self.server.consoles.add(child)
+
+        # The kernel adds its own copy of the ado files, which may not exist
+        # on this host
+        adodir = Path(files('stata_kernel').joinpath('ado')).resolve()
+        child.sendline('adopath + `"{}"\''.format(adodir))
+        try:
+            self.relay(sock, child)
+        except OSError:
+            # The kernel disconnected
+            pass
+        finally:
+            child.close(force=True)
+            self.server.consoles.discard(child)
+
+    def authenticate(self, sock):
+        sock.settimeout(10)
+        try:
+            header = self.receive(sock, HEADER.size)
+            kind, size = HEADER.unpack(header)
+            if (kind != HELLO) or (size > 1024):
+                return False
+            token = self.receive(sock, size)
+        except (OSError, struct.error):
+            return False
+        sock.settimeout(None)
+        return hmac.compare_digest(token, self.server.token)
+
+    def receive(self, sock, size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise OSError('connection closed')
+            data += chunk
+        return data
+
+    def relay(self, sock, child):
+        fd = child.child_fd
+        os.set_blocking(fd, False)
+        received = bytearray()
+        to_console = bytearray()
+        while True:
+            writers = [fd] if to_console else []
+            readable, writable, _ = select.select([sock, fd], writers, [])
+            if fd in writable:
+                try:
+                    del to_console[:os.write(fd, to_console)]
+                except BlockingIOError:
+                    pass
+
+            if fd in readable:
+                batch, ended = self.read_batch(fd)
+                if batch:
+                    sock.sendall(output_frame(batch))
+                if ended:
+                    break
+
+            if sock in readable:
+                data = sock.recv(1 << 16)
+                if not data:
+                    return
+                received += data
+                for kind, payload in unframe(received):
+                    if kind == INPUT:
+                        to_console += payload
+
+        child.wait()
+        sock.sendall(exit_frame(child.exitstatus, child.signalstatus))
+
+    def read_batch(self, fd):
+        """Read output until the console pauses, or up to `max_batch` bytes
+
+        Returns:
+            (bytes, bool): the output, and whether the console has exited
+        """
+        chunks = []
+        size = 0
+        ended = False
+        while size < self.max_batch:
+            try:
+                chunk = os.read(fd, 65536)
+            except BlockingIOError:
+                break
+            except OSError:
+                # Linux reports the end of a pty with EIO
+                chunk = b''
+            if not chunk:
+                ended = True
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+            if not select.select([fd], [], [], self.server.batch_wait)[0]:
+                break
+        return b''.join(chunks), ended
+
+
+class Agent(socketserver.ThreadingTCPServer):
+    """Server that runs a Stata console for each kernel that connects
+
+    Args:
+        command (str): command that starts the Stata console
+        token (str): secret that kernels have to send before anything else
+        address (Tuple[str, int]): host and port to listen on
+        batch_wait (float): seconds to wait for more output before sending
+            what the console wrote
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+    handler = AgentHandler
+
+    def __init__(
+            self, command, token, address=('127.0.0.1', 0), batch_wait=0.005):
+        self.command = command
+        self.token = token.encode('utf-8')
+        self.batch_wait = batch_wait
+        # Consoles currently running, one for each connection
+        self.consoles = set()
+        super(Agent, self).__init__(address, self.handler)
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        prog='python -m stata_kernel.remote',
+        description=(
+            "Run Stata consoles on this host for stata_kernel. Kernels "
+            "connect with the remote_agent and remote_agent_token settings. "
+            "The token is read from ${}, or made up and printed.".format(
+                TOKEN_ENVVAR_NAME)))
+    parser.add_argument(
+        'stata_path', help="Stata console to run, e.g. /usr/local/stata17/"
+        "stata-mp")
+    parser.add_argument(
+        '--host', default='127.0.0.1',
+        help="Address to listen on. The default only accepts connections "
+        "from this host, e.g. through an SSH tunnel.")
+    parser.add_argument(
+        '--port', type=int, default=8964, help="Port to listen on.")
+    args = parser.parse_args(argv)
+
+    token = os.environ.get(TOKEN_ENVVAR_NAME)
+    if not token:
+        token = secrets.token_urlsafe(24)
+        print('Token: {}'.format(token))
+
+    agent = Agent(args.stata_path, token, (args.host, args.port))
+    print('Listening on {}:{}'.format(*agent.server_address), flush=True)
+    try:
+        agent.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        agent.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,490 @@
+import re
+import asyncio
+import pexpect
+import concurrent.futures
+
+from time import sleep
+from collections import deque
+from timeit import default_timer
+
+from .remote import RemoteConsole
+
+MD5 = 0
+ERROR = 1
+GRAPH = 2
+MORE = 3
+EOL = 4
+EOF = 5
+
+# What a step generator (see `run`) yields when it has to wait
+READ = 'read'
+SLEEP = 'sleep'
+WAIT = 'wait'
+
+# Children that are Stata's console, here or through an agent. They show
+# terminal escape sequences, and the event loop can wait for their output.
+CONSOLES = (pexpect.spawn, RemoteConsole)
+
+
+class CellTimeout(Exception):
+    """The cell ran past its timeout"""
+
+
+class LineScanner():
+    """Read console output in large chunks and classify it line by line
+
+    `pexpect`'s `expect` runs every pattern in its list against the buffer
+    each time it is called, so calling it once per output line with several
+    patterns dominates the cost of output-heavy cells. Instead, this reads
+    whatever the child has available (up to `maxread` characters), splits it
+    into lines once and classifies each line with a single precompiled regex.
+
+    The scanner never reads from the child itself. Methods that may have to
+    wait for more output are generators: they yield `(READ, deadline)` and
+    are sent the next chunk of output, or have `pexpect.TIMEOUT` or
+    `pexpect.EOF` thrown in. Call them with `yield from`, and drive the
+    outermost generator with `run` (blocking) or `run_async` (on an event
+    loop).
+
+    The scanner takes over anything left in the child's buffer when it is
+    created. Call `release` when done so that text that was read but not
+    consumed is handed back to the child for later `child.expect` calls.
+
+    With `deadline` set (a `default_timer` time), any read past it raises
+    `CellTimeout` instead of waiting, whichever method it is waiting for.
+
+    Args:
+        child (pexpect.spawn or fdpexpect.fdspawn): pty or log file to read
+        patterns (Dict[int, str]): regex for each of `MD5`, `ERROR` and
+            `GRAPH`. The `ERROR` regex must capture the return code in a group
+            named `rc`.
+    """
+
+    more = '--more--'
+
+    # What the console writes to erase the pager prompt once a key is pressed
+    erase_more = re.compile(r'^[\r\x08]*(?: +[\r\x08]+)?')
+
+    def __init__(self, child, patterns):
+        self.child = child
+        self.erasing = False
+        self.lines = deque()
+        self.last_read = default_timer()
+        self.deadline = None
+        self.partial = child.buffer
+        self._set_buffer('')
+        self._split()
+
+        self.kinds = {}
+        regex = []
+        for kind in [MD5, ERROR, GRAPH]:
+            name = 'k{}'.format(kind)
+            self.kinds[name] = kind
+            regex.append('(?P<{}>{})'.format(name, patterns[kind]))
+        self.regex = re.compile('|'.join(regex)).search
+
+    def next(self, timeout=None):
+        """Return the next line of output and what kind of line it is
+
+        Args:
+            timeout (float or None): Seconds to wait for a complete line.
+                None waits indefinitely.
+
+        Returns:
+            (int, str, re.Match or None): Kind of line, the line without its
+            end of line characters, and the match for `MD5`, `ERROR` or
+            `GRAPH` lines. For `GRAPH` lines, the line starts where the match
+            starts. `MORE` is returned as soon as the pager prompt shows up,
+            without waiting for a newline; `EOF` is returned when the child
+            has no more output.
+
+        Raises:
+            pexpect.TIMEOUT: no complete line arrived within `timeout`.
+        """
+        line = yield from self.readline(timeout)
+        if line is None:
+            if self.at_more():
+                self.partial = ''
+                return MORE, self.more, None
+            return EOF, '', None
+
+        if line.startswith(self.more):
+            return MORE, line, None
+
+        match = self.regex(line)
+        if match is None:
+            return EOL, line, None
+
+        kind = self.kinds[match.lastgroup]
+        if kind == GRAPH:
+            line = line[match.start():]
+        return kind, line, match
+
+    def readline(self, timeout=None):
+        """Return the next complete line without its end of line characters
+
+        Returns None instead of waiting if the pager prompt shows up or the
+        child reaches the end of its output.
+        """
+        deadline = None if timeout is None else default_timer() + timeout
+        while not self.lines:
+            if self.at_more():
+                return None
+            if not (yield from self.fill(deadline)):
+                return None
+
+        return self.lines.popleft()
+
+    def readuntil(self, regex):
+        """Read up to and including the first match of `regex`
+
+        Unlike the other methods, this searches the raw output, end of line
+        characters included, like `child.expect` does.
+
+        Returns:
+            (str, re.Match or None): Output before the match, and the match.
+            The match is None if the child reached the end of its output;
+            what was read is then kept for the next call.
+        """
+        search = re.compile(regex).search
+        text = ''.join(line + '\r\n' for line in self.lines) + self.partial
+        self.lines = deque()
+        self.partial = ''
+        while True:
+            match = search(text)
+            if match:
+                self.partial = text[match.end():]
+                self._split()
+                return text[:match.start()], match
+
+            self.check_deadline()
+            try:
+                text += yield READ, self.deadline
+                self.last_read = default_timer()
+            except pexpect.EOF:
+                self.partial = text
+                self._split()
+                return text, None
+            except pexpect.TIMEOUT:
+                self.check_deadline()
+
+    def has_lines(self):
+        """Whether complete lines were read but not returned yet"""
+        return bool(self.lines)
+
+    def at_more(self):
+        """Whether output stopped at the pager prompt"""
+        return not self.lines and self.partial.startswith(self.more)
+
+    def resume(self):
+        """Press a key at the pager prompt so that the output goes on
+
+        The prompt, and whatever erases it, isn't returned as output.
+        """
+        if self.at_more():
+            self.partial = ''
+        self.child.send(' ')
+        self.erasing = True
+
+    def unread(self, line):
+        """Put a line back so that it is returned next"""
+        self.lines.appendleft(line)
+
+    def continues(self, prefix='> '):
+        """Whether the next line starts with `prefix`, without consuming it"""
+        while not self.lines and len(self.partial) < len(prefix):
+            if not (yield from self.fill(None)):
+                break
+
+        if self.lines:
+            return self.lines[0].startswith(prefix)
+        return self.partial.startswith(prefix)
+
+    def fill(self, deadline):
+        """Wait for the next chunk of output from the child
+
+        Returns:
+            (bool): False if the child reached the end of its output.
+
+        Raises:
+            pexpect.TIMEOUT: nothing was read before `deadline`.
+            CellTimeout: the scanner's `deadline` passed.
+        """
+        self.check_deadline()
+        if (self.deadline is not None) and (
+                (deadline is None) or (self.deadline < deadline)):
+            deadline = self.deadline
+        try:
+            chunk = yield READ, deadline
+        except pexpect.EOF:
+            return False
+        except pexpect.TIMEOUT:
+            self.check_deadline()
+            raise
+
+        self.last_read = default_timer()
+        self.partial += chunk
+        if self.erasing:
+            self.partial = self.erase_more.sub('', self.partial)
+            self.erasing = not self.partial.strip(' \r\x08')
+        self._split()
+        return True
+
+    def check_deadline(self):
+        """Raise `CellTimeout` if the scanner's `deadline` has passed"""
+        if (self.deadline is not None) and (default_timer() >= self.deadline):
+            raise CellTimeout()
+
+    def _split(self):
+        if '\n' not in self.partial:
+            return
+
+        lines = self.partial.split('\n')
+        self.partial = lines.pop()
+        self.lines.extend(
+            line[:-1] if line.endswith('\r') else line for line in lines)
+
+    def release(self, unread=''):
+        """Give unconsumed output back to the child
+
+        Args:
+            unread (str): text to put back in front of the unconsumed output,
+                e.g. the rest of the last line returned.
+        """
+        lines = ''.join(line + '\r\n' for line in self.lines)
+        self._set_buffer(unread + lines + self.partial + self.child.buffer)
+        self.lines = deque()
+        self.partial = ''
+
+    def _set_buffer(self, text):
+        self.child.buffer = text
+        # pexpect >= 4.7 also keeps unmatched output in `_before`, which the
+        # next `expect` searches instead of the buffer when it is longer
+        if hasattr(self.child, '_before'):
+            self.child._before = self.child.buffer_type()
+            self.child._before.write(text)
+
+
+class LogTail():
+    """Log file written by the console, read in place of its pty
+
+    With `console_output = log`, Stata's output is read from a text log that
+    the session keeps open with `log using`, so it has no terminal escape
+    sequences or line noise. It has the same interface as the pty for
+    `LineScanner`, `run` and `run_async`; commands and breaks are still sent
+    through the pty.
+
+    The pty is read too, but only so that the console never blocks on a full
+    terminal. What it shows is thrown away, except for the pager prompt,
+    which Stata doesn't write to logs. Whenever the pty shows something that
+    isn't in the log yet, the log is checked again every `poll` seconds until
+    it is, in case Stata writes the log after the terminal.
+
+    Args:
+        path (Path): log file, already opened by Stata
+        child (pexpect.spawn): console pty
+    """
+
+    more = LineScanner.more
+
+    def __init__(self, path, child, poll=0.01):
+        self.path = path
+        self.child = child
+        self.child_fd = child.child_fd
+        self.poll = poll
+        self.buffer = ''
+        self.shown = ''
+        self.lagging = False
+        self.file = open(path, encoding='utf-8', errors='replace', newline='')
+        self.file.seek(0, 2)
+
+    def read_nonblocking(self, size=1, timeout=None):
+        """Read what Stata has added to the log
+
+        Raises:
+            pexpect.TIMEOUT: nothing was added before `timeout`.
+            pexpect.EOF: the console exited.
+        """
+        deadline = None if timeout is None else default_timer() + timeout
+        while True:
+            text = self.file.read(size)
+            if text:
+                self.lagging = False
+                return text
+            if self.shown.endswith(self.more):
+                self.shown = ''
+                self.lagging = False
+                return self.more
+
+            wait = self.poll if self.lagging else None
+            if deadline is not None:
+                remaining = max(deadline - default_timer(), 0)
+                wait = remaining if wait is None else min(wait, remaining)
+            try:
+                shown = self.child.read_nonblocking(65536, wait)
+            except pexpect.TIMEOUT:
+                if (deadline is not None) and (default_timer() >= deadline):
+                    raise
+                continue
+
+            self.shown = (self.shown + shown)[-len(self.more):]
+            self.lagging = True
+
+    def send(self, s):
+        return self.child.send(s)
+
+    def sendline(self, s=''):
+        return self.child.sendline(s)
+
+    def sendcontrol(self, char):
+        return self.child.sendcontrol(char)
+
+    def close(self):
+        self.file.close()
+
+
+def wait(seconds):
+    """Step that pauses for `seconds`, e.g. until a log file is written to"""
+    yield SLEEP, seconds
+
+
+def wait_future(future):
+    """Step that waits for a `concurrent.futures.Future` to be done"""
+    yield WAIT, future
+
+
+def run(steps, child, maxread=65536):
+    """Run a step generator, blocking while the child has no output
+
+    A `KeyboardInterrupt` while waiting is thrown into the generator, so that
+    it can break Stata out of the current command before giving up.
+
+    Args:
+        steps (generator): yields `(READ, deadline)`, `(SLEEP, seconds)` or
+            `(WAIT, future)`
+        child (pexpect.spawn or fdpexpect.fdspawn): pty or log file to read
+
+    Returns:
+        The generator's return value.
+    """
+    value = exc = None
+    while True:
+        try:
+            kind, arg = steps.send(value) if exc is None else steps.throw(exc)
+        except StopIteration as stop:
+            return stop.value
+
+        value = exc = None
+        try:
+            if kind == SLEEP:
+                sleep(arg)
+                continue
+            if kind == WAIT:
+                concurrent.futures.wait([arg])
+                continue
+
+            timeout = None if arg is None else max(arg - default_timer(), 0)
+            value = child.read_nonblocking(maxread, timeout)
+        except (pexpect.TIMEOUT, pexpect.EOF, KeyboardInterrupt) as e:
+            exc = e
+
+
+async def run_async(steps, child, interrupt=None, maxread=65536):
+    """Run a step generator on the running event loop
+
+    Same as `run`, but instead of blocking in `select`, the pty is watched
+    with `loop.add_reader`, so the loop keeps handling other messages while
+    Stata is busy and nothing runs until Stata writes something. Log files
+    (automation mode) can't be watched this way; they are always readable and
+    the generator asks to sleep at their end, which here is `asyncio.sleep`.
+    A `LogTail` is woken up by its console's pty instead, and a
+    `RemoteConsole` by its socket.
+
+    Args:
+        interrupt (asyncio.Event): when set while waiting, the event is
+            cleared and `KeyboardInterrupt` is thrown into the generator
+    """
+    loop = asyncio.get_running_loop()
+    fd = None
+    if isinstance(child, CONSOLES + (LogTail, )):
+        fd = child.child_fd
+    value = exc = None
+    while True:
+        try:
+            kind, arg = steps.send(value) if exc is None else steps.throw(exc)
+        except StopIteration as stop:
+            return stop.value
+
+        if kind in (SLEEP, WAIT):
+            if kind == SLEEP:
+                await _wait(loop, None, interrupt, arg)
+            else:
+                await _wait(loop, None, interrupt, None, future=arg)
+            value, exc = None, _interrupted(interrupt)
+            continue
+
+        while True:
+            if fd is not None:
+                timeout = None
+                if arg is not None:
+                    timeout = max(arg - default_timer(), 0)
+                if isinstance(child, LogTail) and child.lagging:
+                    timeout = min(timeout or child.poll, child.poll)
+                await _wait(loop, fd, interrupt, timeout)
+
+            value, exc = None, _interrupted(interrupt)
+            if exc is not None:
+                break
+            try:
+                value = child.read_nonblocking(maxread, 0)
+                break
+            except pexpect.EOF as e:
+                exc = e
+                break
+            except pexpect.TIMEOUT as e:
+                # Only time out once the deadline has passed
+                if (fd is None) or (
+                        (arg is not None) and (default_timer() >= arg)):
+                    exc = e
+                    break
+
+
+def _interrupted(interrupt):
+    if (interrupt is None) or not interrupt.is_set():
+        return None
+
+    interrupt.clear()
+    return KeyboardInterrupt()
+
+
+async def _wait(loop, fd, interrupt, timeout, future=None):
+    """Wait until `fd` is readable, `interrupt` is set, `future` is done or
+    `timeout` passes"""
+    waiter = loop.create_future()
+
+    def wake(*args):
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def done(watched):
+        # Its exception is raised from `future` itself, not from here
+        if not watched.cancelled():
+            watched.exception()
+        wake()
+
+    if fd is not None:
+        loop.add_reader(fd, wake)
+    if future is not None:
+        asyncio.wrap_future(future, loop=loop).add_done_callback(done)
+    if interrupt is not None:
+        interrupted = loop.create_task(interrupt.wait())
+        interrupted.add_done_callback(wake)
+    try:
+        await asyncio.wait_for(waiter, timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        if fd is not None:
+            loop.remove_reader(fd)
+        if interrupt is not None:
+            interrupted.cancel()
@@ -1,3 +1,4 @@
+import os
 import sys
 import re
 import urllib
@@ -142,12 +143,35 @@ class MagicParsers():
             description="Display the last N rows of the dataset in memory.")
         self.tail.add_argument('code', nargs='*', type=str, help=SUPPRESS)
 
+        self.checkpoint = StataParser(
+            prog='%checkpoint', kernel=kernel,
+            usage='%(prog)s [-h] [PATH]',
+            description=(
+                "Save the data in all frames, globals, scalars, matrices and "
+                "estimates to the directory PATH, by default in the cache "
+                "directory."))
+        self.checkpoint.add_argument('path', nargs='*', help=SUPPRESS)
+
+        self.restore = StataParser(
+            prog='%restore', kernel=kernel,
+            usage='%(prog)s [-h] [PATH]',
+            description="Load back what %checkpoint saved to PATH.")
+        self.restore.add_argument('path', nargs='*', help=SUPPRESS)
+
         #######################################################################
         #                                                                     #
         #                             %set magic                              #
         #                                                                     #
         #######################################################################
 
+        self.timeout = StataParser(
+            prog='%timeout', kernel=kernel,
+            usage='%(prog)s [-h] SECONDS code',
+            description="Stop the code if it runs longer than SECONDS.")
+        self.timeout.add_argument(
+            'seconds', type=float, metavar='SECONDS',
+            help="Seconds after which to stop the code")
+
         self.set = StataParser(
             prog='%set', kernel=kernel, description='Set configuration value.')
         self.set.add_argument('key', type=str, help='Configuration key name.')
@@ -181,6 +205,7 @@ class StataMagics():
 
     available_magics = [
         'browse',
+        'checkpoint',
         'delimit',
         # 'exit',
         'globals',
@@ -190,11 +215,14 @@ class StataMagics():
         'html',
         'latex',
         'locals',
-        # 'restart',
+        'parallel',
+        'restart',
+        'restore',
         'set',
         'show_gui',
         'status',
-        'tail']
+        'tail',
+        'timeout']
     # 'time',
     # 'timeit'
 
@@ -211,6 +239,7 @@ class StataMagics():
         self.name = ''
         self.graphs = 1
         self.timeit = 0
+        self.timeout = None
         self.time_profile = None
         self.img_set = False
         self.parse = MagicParsers(kernel)
@@ -523,6 +552,15 @@ class StataMagics():
                 config._remove_unsafe('graph_width', permanent=perm)
                 config._remove_unsafe('graph_height', permanent=perm)
             else:
+                if not config.is_valid(key, value):
+                    if key in config.boolean_settings:
+                        msg = '{} must be True or False.'.format(key)
+                    elif key in config.choice_settings:
+                        msg = '{} must be one of {}.'.format(
+                            key, ', '.join(config.choice_settings[key]))
+                    else:
+                        msg = '{} must be a non-negative number.'.format(key)
+                    self.parse.set.error(msg)
                 config.set(key, value, permanent=perm)
 
         except:
@@ -552,6 +590,24 @@ class StataMagics():
         print_kernel("Magic timeit has not been implemented.", kernel)
         return code
 
+    def magic_timeout(self, code, kernel):
+        seconds, _, _code = code.partition('\n')
+        seconds, _, rest = seconds.strip().partition(' ')
+        try:
+            args = vars(self.parse.timeout.parse_args([seconds]))
+        except (ValueError, SystemExit):
+            self.status = -1
+            return ''
+
+        if args['seconds'] <= 0:
+            print_kernel(
+                "Magic timeout needs a positive number of seconds.", kernel)
+            self.status = -1
+            return ''
+
+        self.timeout = args['seconds']
+        return (rest + '\n' + _code).strip()
+
     def magic_help(self, code, kernel):
         self.status = -1
         self.graphs = 0
@@ -673,16 +729,55 @@ class StataMagics():
         print_kernel("Magic exit has not been implemented.", kernel)
         return code
 
+    def magic_parallel(self, code, kernel):
+        self.status = -1
+        self.graphs = 0
+        if code.strip() == '':
+            print_kernel("Magic parallel needs code to run.", kernel)
+            return ''
+        if config.get('execution_mode') != 'console':
+            print_kernel(
+                "Magic parallel only works in console execution mode.", kernel)
+            return ''
+
+        kernel.pool.submit(code)
+        return ''
+
     def magic_restart(self, code, kernel):
-        # magic['name']    = 'restart'
-        # magic['restart'] = True
-        # if code.strip() != '':
-        #     magic['name']   = ''
-        #     magic['status'] = -1
-        #     print("Magic restart must be called by itself.")
         self.status = -1
-        print_kernel("Magic restart has not been implemented.", kernel)
-        return code
+        self.graphs = 0
+        if code.strip() != '':
+            print_kernel("Magic restart must be called by itself.", kernel)
+            return ''
+
+        kernel.stata.restart()
+        kernel.sc_delimit_mode = False
+        kernel.completions.refresh(kernel)
+        print_kernel("Stata was restarted.", kernel)
+        return ''
+
+    def magic_checkpoint(self, code, kernel, what='save'):
+        parser = self.parse.checkpoint if what == 'save' else self.parse.restore
+        try:
+            args = vars(parser.parse_args(code.split()))
+        except (ValueError, SystemExit):
+            self.status = -1
+            return ''
+
+        path = ' '.join(args['path']).strip('"\'')
+        if path:
+            path = os.path.expanduser(path)
+        else:
+            path = str(config.get('cache_dir') / 'checkpoint')
+
+        # Run as the cell's code, so that it can be interrupted and the
+        # completions are refreshed afterwards
+        self.graphs = 0
+        code = '_StataKernelCheckpoint {} `"{}"\''.format(what, path)
+        return code + (';' if kernel.sc_delimit_mode else '')
+
+    def magic_restore(self, code, kernel):
+        return self.magic_checkpoint(code, kernel, what='restore')
 
     def magic_status(self, code, kernel):
         self.status = -1
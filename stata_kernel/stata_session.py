@@ -3,48 +3,76 @@ import re
 import pexpect
 import pexpect.fdpexpect
 import platform
+import threading
 import subprocess
 
 from time import sleep
-# from timeit import default_timer
+from uuid import uuid4
+from timeit import default_timer
 from pathlib import Path
+from collections import deque, namedtuple
 from textwrap import dedent
 from importlib.resources import files
 
 from .utils import check_stata_kernel_updated_version
 from .config import config
+from .code_manager import pdf_copy
+from .output import OutputBuffer, ansi_escape, graph_worker
+from .remote import RemoteConsole
+from .scanner import (
+    LineScanner, LogTail, CellTimeout, CONSOLES, MD5, ERROR, GRAPH, MORE, EOL,
+    EOF, run, run_async, wait, wait_future)
 
 if platform.system() == 'Windows':
     import win32com.client
     from pywintypes import com_error
 
-# Regex from: https://stackoverflow.com/a/45448194
-ansi_regex = r'\x1b(' \
-             r'(\[\??\d+[hl])|' \
-             r'([=<>a-kzNM78])|' \
-             r'([\(\)][a-b0-2])|' \
-             r'(\[\d{0,2}[ma-dgkjqi])|' \
-             r'(\[\d+;\d+[hfy]?)|' \
-             r'(\[;?[hf])|' \
-             r'(#[3-68])|' \
-             r'([01356]n)|' \
-             r'(O[mlnp-z]?)|' \
-             r'(/Z)|' \
-             r'(\d+)|' \
-             r'(\[\?\d;\d0c)|' \
-             r'(\d;\dR))'
-ansi_escape = re.compile(ansi_regex, flags=re.IGNORECASE)
+
+Sentinel = namedtuple(
+    'Sentinel', ['seq', 'text', 'begin', 'after', 'end', 'logs'])
+
+
+class Matchers():
+    """Compiled regexes that `expect` runs on output lines
+
+    They depend on the cache directory, the graph formats and the prompt
+    (Stata's or Mata's), which `key` holds. `StataSession.update_matchers`
+    only compiles them again when one of those changed.
+
+    Attributes:
+        not_found: `search` for Stata's note that a graph file wasn't found
+        graph_name: `search` for the name of a graph file that was written
+        prompt: `search` for the echo of code after the current prompt
+        stata_prompt: `search` for the echo of code after Stata's prompt
+    """
+
+    def __init__(
+            self, cache_dir_str, graph_formats, prompt_regex,
+            stata_prompt_regex):
+        self.key = (cache_dir_str, tuple(graph_formats), prompt_regex)
+        self.not_found = re.compile(
+            r'^\((note: )?file {}/graph\d+\.({}) not found\)'.format(
+                cache_dir_str, '|'.join(graph_formats))).search
+        self.graph_name = re.compile(
+            r'/(graph\d+\.\w+) (written|saved)').search
+        self.prompt = re.compile(prompt_regex).search
+        self.stata_prompt = re.compile(stata_prompt_regex).search
 
 
 class StataSession():
-    def __init__(self, kernel):
+    def __init__(self, kernel, name=None):
         """Initialize Session
         Args:
             kernel (ipykernel.kernelbase): Running instance of kernel
             config (ConfigParser): config class
+            name (str): Name of a secondary session, e.g. the standby for
+                `restart` or a `%parallel` worker. Secondary sessions keep
+                their files in a subdirectory of the cache directory and don't
+                check for updates.
         """
 
         self.kernel = kernel
+        self.name = name
         self.banner = 'stata_kernel {}\n'.format(kernel.implementation_version)
 
         # Mata switches
@@ -71,15 +99,32 @@ class StataSession():
         self.prompt = self.stata_prompt
         self.prompt_dot = self.stata_prompt_dot
         self.prompt_regex = self.stata_prompt_regex
+        self.matchers = None
 
-        msg = check_stata_kernel_updated_version(kernel.implementation_version)
-        if msg is not None:
-            self.banner += msg
+        if name is None:
+            msg = check_stata_kernel_updated_version(
+                kernel.implementation_version)
+            if msg is not None:
+                self.banner += msg
 
         # See https://github.com/kylebarron/stata_kernel/issues/177
         self.linesize = 80
+
+        # Longest wait, in seconds, for a log file to be written to
+        self.max_idle_wait = 0.5
         self.cwd = os.getcwd()
 
+        # Markers around each execution; see `sentinel`
+        self.sequence = 0
+        self.user_rc = 0
+
+        # Log that output is read from with `console_output = log`
+        self.log_tail = None
+
+        # Console started in the background for `restart`
+        self.standby = None
+        self.standby_thread = None
+
         # Platform
         # --------
 
@@ -92,7 +137,8 @@ class StataSession():
                 self.init_console()
         else:
             self.init_console()
-            config.set('execution_mode', 'console', permanent=True)
+            if name is None:
+                config.set('execution_mode', 'console', permanent=True)
 
         # Stata
         # -----
@@ -102,7 +148,7 @@ class StataSession():
         init_cmd = """\
             adopath + `"{0}"\'
             cd `"{1}"\'
-            set more on
+            set more {3}
             set pagesize 100
             set linesize {2}
             clear all
@@ -112,7 +158,9 @@ class StataSession():
             di "Stata version: `c(version)'"
             di "OS: $S_OS"
             `finished_init_cmd'
-            """.format(adodir, os.getcwd(), self.linesize).rstrip()
+            """.format(
+                adodir, os.getcwd(), self.linesize,
+                'on' if config.get_bool('pager', True) else 'off').rstrip()
         self.do(dedent(init_cmd), md5='finished_init_cmd', display=False)
         try:
             rc, res = self.do(
@@ -125,6 +173,69 @@ class StataSession():
             self.stata_version = 'unknown'
             pass
 
+        if config.get('execution_mode') == 'console':
+            # The log of a remote console is on the other host
+            if (config.get('console_output', 'pty') == 'log') and (
+                    not config.get('remote_agent')):
+                self.start_log_console()
+
+        if name is None:
+            self.start_standby()
+
+    def start_standby(self):
+        """Start a second console in the background for `restart`
+
+        Only with `standby_session` on and in console mode, since automation
+        mode drives the one Stata window open.
+        """
+        if not config.get_bool('standby_session', False):
+            return
+        if config.get('execution_mode') != 'console':
+            return
+
+        def spawn():
+            try:
+                self.standby = StataSession(
+                    self.kernel, name='standby-' + uuid4().hex[:8])
+            except (pexpect.ExceptionPexpect, OSError):
+                self.standby = None
+
+        self.standby_thread = threading.Thread(target=spawn, daemon=True)
+        self.standby_thread.start()
+
+    def restart(self):
+        """Replace Stata with a fresh, initialized Stata
+
+        If a standby console was started, it is swapped in, which takes
+        milliseconds once it is ready, and a new standby is started in the
+        background. Otherwise Stata is started and initialized here.
+        """
+        standby = None
+        if self.standby_thread is not None:
+            self.standby_thread.join()
+            standby = self.standby
+
+        self.standby = None
+        self.standby_thread = None
+        if config.get('execution_mode') == 'console':
+            # Closing waits for the process to exit; don't wait for that here
+            threading.Thread(
+                target=self.child.close, kwargs={'force': True},
+                daemon=True).start()
+            if self.log_tail is not None:
+                self.log_tail.close()
+        else:
+            self.shutdown()
+        if standby is None:
+            standby = StataSession(
+                self.kernel, name='standby-' + uuid4().hex[:8])
+
+        banner = self.banner
+        vars(self).update(vars(standby))
+        self.banner = banner
+        self.name = None
+        self.start_standby()
+
     def init_windows(self):
         """Start Stata on Windows
 
@@ -170,6 +281,17 @@ class StataSession():
         self.automate(cmd_name='UtilShowStata', value=1)
         self.start_log_aut()
 
+    @property
+    def cache_dir(self):
+        """Directory for the do files and graphs of this session"""
+        cache_dir = config.get('cache_dir')
+        if self.name is None:
+            return cache_dir
+
+        cache_dir = cache_dir / self.name
+        cache_dir.mkdir(exist_ok=True)
+        return cache_dir
+
     def init_console(self):
         """Start Stata in console mode
 
@@ -178,12 +300,10 @@ class StataSession():
         there's a `more` stopping it, and presses `q` until the more has
         gone away.
         """
-        self.child = pexpect.spawn(
-            config.get('stata_path'), encoding='utf-8', codec_errors='replace')
+        self.child = self.spawn()
         self.child.delaybeforesend = None
-        self.child.logfile = (
-            config.get('cache_dir') / 'console_debug.log').open(
-                'w', encoding='utf-8')
+        self.child.logfile = (self.cache_dir / 'console_debug.log').open(
+            'w', encoding='utf-8')
         banner = []
         try:
             self.child.expect(self.prompt, timeout=0.2)
@@ -202,6 +322,23 @@ class StataSession():
         self.banner += ansi_escape.sub('', '\n'.join(banner))
         self.banner = re.sub(r'\r\n', '\n', self.banner)
 
+    def spawn(self):
+        """Start Stata's console here, or through the `remote_agent`
+
+        Either way, the console has the interface of `pexpect.spawn` that the
+        rest of the session uses: `send`, `sendline` and `sendcontrol` for
+        input, `read_nonblocking` and `expect` for output, a `child_fd` that
+        is readable when there is output, and `isalive`, `exitstatus`,
+        `signalstatus` and `close` for the process.
+        """
+        address = config.get('remote_agent')
+        if address:
+            return RemoteConsole(
+                address, config.get('remote_agent_token', ''),
+                encoding='utf-8', codec_errors='replace')
+        return pexpect.spawn(
+            config.get('stata_path'), encoding='utf-8', codec_errors='replace')
+
     def start_log_aut(self):
         """Start log and watch file
 
@@ -235,7 +372,20 @@ class StataSession():
 
         return 0
 
-    def do(self, text, md5, **kwargs):
+    def start_log_console(self):
+        """Start the log that output is read from in console mode
+
+        Like `start_log_aut`, but Stata is still driven through the pty. The
+        log is named like the automation mode log, so that the cleaning of
+        user logs and the log completions leave it alone.
+        """
+        log_path = self.cache_dir / 'console_output.log'
+        cmd = 'log using `"{}"\', replace text name(stata_kernel_log)'.format(
+            log_path)
+        self.do(cmd + "\n`log_started'", md5='log_started', display=False)
+        self.log_tail = LogTail(log_path, self.child)
+
+    def do(self, text, md5, wide=False, **kwargs):
         """Main wrapper for sequence of running user-given code
 
         Args:
@@ -248,36 +398,135 @@ class StataSession():
                 expected that this string include many lines. It will be split
                 on \\n in `expect`.
             display (bool): Whether to send results to front-end
+            keep (int): Most characters of output to return
+            wide (bool): Whether to run at the largest linesize; see
+                `sentinel`
+        """
+        sentinel = self.sentinel(text, md5, wide)
+        child = self.send(sentinel.text if sentinel else text)
+        return run(self._do(text, child, md5, sentinel, **kwargs), child)
+
+    async def do_async(
+            self, text, md5, interrupt=None, wide=False, **kwargs):
+        """Run code like `do`, without blocking the event loop
+
+        While Stata runs, the running event loop only wakes up when Stata
+        writes to the console, so the kernel keeps handling other messages.
+
+        Args:
+            interrupt (asyncio.Event): set to break out of the running command
+        """
+        sentinel = self.sentinel(text, md5, wide)
+        child = self.send(sentinel.text if sentinel else text)
+        return await run_async(
+            self._do(text, child, md5, sentinel, **kwargs), child, interrupt)
+
+    def sentinel(self, text, md5, wide=False):
+        """Put begin and end markers around the text instead of the md5
+
+        The markers are printed with `display`, so that the output (unlike the
+        echo of the command) has them in one piece. Everything before the
+        begin marker is left over from earlier and skipped without looking at
+        it, and the end marker carries the value of `_rc` after the code.
+        Each execution gets a new sequence number, so that markers can't be
+        confused with those of an earlier execution.
+
+        Mata doesn't have `display`, so in Mata the md5 is used as before.
+
+        With `wide`, the text runs at the largest linesize, so that neither
+        its echo nor its output wraps, and the linesize is set back before
+        the end marker. The user's linesize is kept in the global
+        `stata_kernel_linesize`.
+
+        With `pager` off, `more` is turned off before the text, in case the
+        user's code turned it on.
+
+        Everything but the text is removed from the user's log files
+        afterwards. For that, the sizes of the open ones are kept in `logs`,
+        as that is where the lines before the text start.
+
+        Returns:
+            (Sentinel or None)
         """
+        md5 = "`{}'".format(md5)
+        if self.mata_mode or not text.endswith(md5):
+            return None
 
-        self.cache_dir_str = str(config.get('cache_dir'))
+        self.sequence += 1
+        begin = 'di "<<stata_kernel" "|begin|{}>>"'.format(self.sequence)
+        end = 'di "<<stata_kernel" "|end|{}|" _rc ">>"'.format(self.sequence)
+        before = []
+        after = []
+        if not config.get_bool('pager', True):
+            # Also when an earlier cell turned it back on
+            before = ['set more off']
+        if wide:
+            before += [
+                "global stata_kernel_linesize = `c(linesize)'",
+                'set linesize 255']
+            after = ['set linesize $stata_kernel_linesize']
+
+        text = '\n'.join(
+            before + [begin, text[:-len(md5)].rstrip('\n')] + after + [end])
+        return Sentinel(
+            self.sequence, text, begin, after, end, self.log_sizes())
+
+    def log_sizes(self):
+        """Sizes of the user's open log files, by path"""
+        sizes = {}
+        if not hasattr(self.kernel, 'completions'):
+            return sizes
+        for logfile in self.kernel.completions.suggestions['logfiles']:
+            try:
+                sizes[logfile] = os.path.getsize(logfile)
+            except OSError:
+                pass
+        return sizes
+
+    def send(self, text):
+        """Send text to Stata and return the child to watch for its output"""
+        self.cache_dir_str = str(self.cache_dir)
         if platform.system() == 'Windows':
             self.cache_dir_str = re.sub(r'\\', '/', self.cache_dir_str)
 
         if config.get('execution_mode') == 'console':
+            if not self.child.isalive():
+                raise pexpect.EOF(self.exit_message())
             self.child.sendline(text)
-            child = self.child
-        else:
-            self.automate('DoCommandAsync', text)
-            child = self.log_fd
+            return self.log_tail or self.child
 
-        try:
-            rc, res = self.expect(text=text, child=child, md5=md5, **kwargs)
-        except KeyboardInterrupt:
-            self.send_break(child=child, md5="`{}'".format(md5))
-            # expect twice because the md5 was sent to the log twice
-            kwargs.update({'display': False})
-            self.expect(text=text, child=child, md5=md5, **kwargs)
-            self.expect(text=text, child=child, md5=md5, **kwargs)
-            rc, res = 1, ''
+        self.automate('DoCommandAsync', text)
+        return self.log_fd
+
+    def _do(self, text, child, md5, sentinel, **kwargs):
+        rc, res = yield from self.expect(
+            text=text, child=child, md5=md5, sentinel=sentinel, **kwargs)
+        if isinstance(child, RemoteConsole):
+            child.done()
 
         if hasattr(self.kernel, 'completions'):
-            self.kernel.cleanTail("`{0}'".format(md5), self.prompt_dot)
+            if sentinel is None:
+                self.kernel.cleanTail("`{0}'".format(md5), self.prompt_dot)
+            else:
+                # From the linesize being set back, if it was
+                lines = sentinel.after + [sentinel.end]
+                self.kernel.cleanTail(
+                    lines[0], self.prompt_dot,
+                    trailing=len('\n'.join(lines[1:])) + 80)
+                self.kernel.cleanHead(
+                    sentinel.logs, '<<stata_kernel|begin|{}>>'.format(
+                        sentinel.seq))
         return rc, res
 
-    def expect(self, text, child, md5, text_to_exclude=None, display=True):
+    def expect(
+            self, text, child, md5, text_to_exclude=None, display=True,
+            sentinel=None, keep=None, timeout=None):
         """Watch for end of command from file descriptor or pty
 
+        This is a generator of the steps that `scanner.run` and
+        `scanner.run_async` carry out. A `KeyboardInterrupt` thrown in breaks
+        Stata out of the running command, and then the return code is 1.
+
         Args:
             text (str): Text sent to Stata.
             child (pexpect.spawn or fdpexpect.spawn): pty or log file to watch
@@ -285,180 +534,243 @@ class StataSession():
             text_to_exclude (str): string of text to exclude from output. It is
                 expected that this string include many lines. It will be split
                 on \\n in `expect`.
+            sentinel (Sentinel): markers sent around the text, if any
+            keep (int): most characters of output to return. Output before
+                that is only sent to the front end.
+            timeout (float): seconds after which Stata is broken out of the
+                command, like for an interrupt, and the return code is 1
         """
 
-        # split text into lines
+        # split text into lines. Matched lines are popped off the front, so
+        # use a deque to keep that constant time for long includes.
         if text_to_exclude is not None:
-            code_lines = text_to_exclude.split('\n')
+            code_lines = deque(text_to_exclude.split('\n'))
         else:
-            code_lines = text.split('\n')
+            code_lines = deque(text.split('\n'))
 
-        md5 = "`{}'".format(md5)
-        md5Prompt = self.prompt_dot + " " + md5
-        error_re = r'^r\((\d+)\);'
+        if sentinel is None:
+            md5 = "`{}'".format(md5)
+            end_re = self.prompt_dot + " " + md5
+        else:
+            # The echo of the end marker comes before it, like code
+            if code_lines[-1] == "`{}'".format(md5):
+                code_lines.pop()
+            code_lines.extend(sentinel.after)
+            code_lines.append(sentinel.end)
+            end_re = r'^<<stata_kernel\|end\|{}\|(?P<user_rc>\d+)>>'.format(
+                sentinel.seq)
+        error_re = r'^r\((?P<rc>\d+)\);'
 
         # Stata issues a note when saving graphs on disk, including the path.
         # The beginning of this note will be captured by g_exp.
         #     - Stata < 17 reports this note within parentheses,
         #     - Stata   17 reports this note without
-        # Upsettingly, it seems pexpect goes with the shortest match
-        # (?). Hence we add the leading parentheses as needed.
         #
-        # NB: The minimum linesize in Stata is 40 characters.
-        g_exp = r'\(?file {}'.format(self.cache_dir_str[:34])
-        more = r'^--more--'
-        eol = r'\r?\n'
-        expect_list = [md5Prompt, error_re, g_exp, more, eol, pexpect.EOF]
-
+        # Graphs are exported at the largest linesize (see `get_text`), so
+        # the note only wraps after the path.
+        g_exp = r'\(?file {}'.format(re.escape(self.cache_dir_str))
+        self.update_matchers()
+        scanner = LineScanner(
+            child, {MD5: end_re, ERROR: error_re, GRAPH: g_exp})
+
+        output = OutputBuffer(
+            self.kernel, display=display, keep=keep, cache_dir=self.cache_dir,
+            ansi=isinstance(child, CONSOLES))
+        if timeout is not None:
+            # Every wait for output checks it, not only the one for lines
+            scanner.deadline = default_timer() + timeout
+        try:
+            if sentinel is not None:
+                yield from self._readuntil(
+                    scanner, r'(?m)^<<stata_kernel\|begin\|{}>>\r?\n'.format(
+                        sentinel.seq))
+            return (yield from self._expect(
+                scanner, child, code_lines, output, display, sentinel))
+        except KeyboardInterrupt:
+            output.flush()
+            output.ready(wait=True)
+            yield from self._resync(scanner, child)
+            return 1, ''
+        except CellTimeout:
+            output.flush()
+            output.ready(wait=True)
+            yield from self._resync(scanner, child)
+            self.kernel.send_response(
+                self.kernel.iopub_socket, 'stream', {
+                    'text': (
+                        'stata_kernel error: the cell was stopped after '
+                        '{:g} seconds.\n'.format(timeout)),
+                    'name': 'stderr'})
+            return 1, ''
+        except pexpect.EOF:
+            # Show what Stata printed before it exited
+            output.close()
+            raise
+        finally:
+            scanner.release()
+
+    def _expect(
+            self, scanner, child, code_lines, output, display, sentinel):
         match_index = -1
-        res_list = []
-        res_disp = ''
-        any_disp = False
         rc = 0
-        while match_index != 0:
-            match_index = child.expect(expect_list, timeout=None)
-            res = child.before
-            if match_index == 0:
+        # Paths of the files exported for the current graph
+        graphs = []
+        exports = 1 + pdf_copy(config.get('graph_format', 'svg'))
+        while match_index != MD5:
+            # Also when lines keep coming without a wait
+            scanner.check_deadline()
+            try:
+                match_index, res, match = yield from scanner.next(
+                    timeout=output.timeout())
+            except pexpect.TIMEOUT:
+                # Nothing new within the flush interval; send what we have
+                output.flush()
+                continue
+            if match_index == MD5:
                 break
-            if match_index == 1:
-                rc = int(child.match.group(1))
+            if match_index == ERROR:
+                rc = int(match.group('rc'))
+                scanner.unread(res[match.end():])
+                output.flush()
                 if display:
-                    self.kernel.send_response(
-                        self.kernel.iopub_socket, 'stream', {
-                            'text': 'r({});\n'.format(child.match.group(1)),
-                            'name': 'stderr'})
+                    output.emit('stream', {
+                        'text': 'r({});\n'.format(rc), 'name': 'stderr'})
                 continue
-            if match_index == 2:
-                g_path = [self.expect_graph(child, child.match.group(0))]
-                if g_path[0] is None:
+            if match_index == GRAPH:
+                path = yield from self.expect_graph(scanner, res)
+                if path is None:
                     res = None
                     continue
 
-                if ((config.get('graph_format') == 'svg')
-                        and config.get('graph_svg_redundancy', 'True')) or (
-                            (config.get('graph_format') == 'png')
-                            and config.get('graph_png_redundancy', 'True')):
-
-                    while True:
-                        ind = child.expect([g_exp, pexpect.EOF], timeout=None)
-                        if ind == 0:
-                            g_path.append(
-                                self.expect_graph(child, child.match.group(0)))
-                            break
-                        sleep(0.1)
-
-                    code_lines = code_lines[1:]
-                if display:
-                    self.kernel.send_image(g_path)
+                # A graph and its PDF copy are shown together, once the note
+                # for the last of them has been read
+                graphs.append(path)
+                if len(graphs) < exports:
+                    continue
+                self._display(output, graphs, display)
+                graphs = []
+                continue
 
-            if match_index == 3:
-                self.send_break(child=child, md5=md5)
-                child.expect(md5Prompt, timeout=None)
+            if match_index == MORE:
+                if not config.get_bool('pager', True):
+                    # The code turned `more` on; page on instead of breaking
+                    scanner.resume()
+                    continue
+                yield from self._resync(scanner, child)
+                self._display(output, graphs, display)
+                output.flush()
                 if display:
-                    self.kernel.send_response(
-                        self.kernel.iopub_socket, 'stream', {
-                            'text': '--more--\n',
-                            'name': 'stdout'})
-                break
-            if match_index == 4:
-                code_lines, res = self.clean_log_eol(child, code_lines, res)
+                    output.emit('stream', {
+                        'text': '--more--\n', 'name': 'stdout'})
+                output.close()
+                return rc, output.text().replace('\n> ', '')
+            if match_index == EOL:
+                code_lines, res = yield from self.clean_log_eol(
+                    scanner, code_lines, res)
                 if res is None:
                     continue
-                res = ansi_escape.sub('', res) + '\n'
-                res = re.sub(r'\r\n', '\n', res)
-                res_disp += res
-                res_list.append(res)
-                if not ''.join(res_list).strip():
-                    continue
-                if not res_disp.strip():
-                    continue
-                else:
-                    any_disp = True
-                if display:
-                    self.kernel.send_response(
-                        self.kernel.iopub_socket, 'stream', {
-                            'text': res_disp,
-                            'name': 'stdout'})
-                    res_disp = ''
+                # Lines are cleaned up a chunk of output at a time
+                output.write_line(res)
+                if not scanner.has_lines():
+                    output.end_lines()
                 continue
-            if match_index == 5:
-                sleep(0.05)
-
-        self._mata_break(match_index, child)
-        res_disp = re.sub(r'\n\Z', '', res_disp, re.M)
-        if display and res_disp and any_disp:
-            self.kernel.send_response(
-                self.kernel.iopub_socket, 'stream', {
-                    'text': res_disp,
-                    'name': 'stdout'})
-            res_disp = ''
-
-        # Then scroll to next newline, but not including period to make it
-        # easier to remove code lines later
-        child.expect('\r?\n')
+            if match_index == EOF:
+                if output.timeout() == 0:
+                    output.flush()
+                yield from self._idle(scanner, child)
+
+        self._display(output, graphs, display)
+        output.flush()
+        # Wait for the graphs without blocking the event loop
+        future = output.ready()
+        while future is not None:
+            yield from wait_future(future)
+            future = output.ready()
+        if sentinel is None:
+            # Continue from the rest of the md5 line, where `child.expect`
+            # would have left off after matching the md5.
+            scanner.unread(res[match.end():])
+            yield from self._mata_break(
+                match_index, scanner, child, match.group(0))
+
+            # Then scroll to next newline, but not including period to make
+            # it easier to remove code lines later
+            yield from self._readuntil(scanner, '\r?\n')
+        else:
+            self.user_rc = int(match.group('user_rc'))
+        output.close()
 
         # Remove line continuation markers in output returned internally
-        res = ''.join(res_list)
+        res = output.text()
         res = res.replace('\n> ', '')
 
         return rc, res
 
-    def expect_graph(self, child, res):
+    def _display(self, output, graph_paths, display):
+        """Have the graphs loaded by the worker and shown in order"""
+        if graph_paths and display:
+            output.add_display(graph_worker.submit(
+                self.kernel.graph_messages, list(graph_paths)))
+
+    def update_matchers(self):
+        """Compile `Matchers` again if what they depend on has changed"""
+        key = (
+            self.cache_dir_str, tuple(self.kernel.graph_formats),
+            self.prompt_regex)
+        if (self.matchers is None) or (self.matchers.key != key):
+            self.matchers = Matchers(*key, self.stata_prompt_regex)
+
+    def expect_graph(self, scanner, res):
         """Find graph path over multiple lines
         """
-        expect_list = [r'\r?\n> ', r'\r?\n', pexpect.EOF]
-        while True:
-            m = child.expect(expect_list)
-            if m in [0, 1]:
-                res += child.before
-            if m == 1:
-                break
-            if m == 2:
-                sleep(0.1)
-
+        while (yield from scanner.continues('> ')):
+            line = yield from scanner.readline()
+            if line is None:
+                # The rest of the line hasn't been written to the log yet
+                yield from self._idle(scanner, scanner.child)
+                continue
+            res += line[2:]
         # the beginning of `(file ... not found)` of Stata 17 looks identical
         # to the `(file ... written)` of Stata < 16 (both captured by g_exp)
         # distinguish them by looking at the end of the output
         if res[-1] == ')' and res[0] != '(':
             res = '(' + res
 
-        regex = r'^\((note: )?file {}/graph\d+\.({}) not found\)'.format(
-            self.cache_dir_str, '|'.join(self.kernel.graph_formats))
-        if re.search(regex, res):
+        if self.matchers.not_found(res):
             return None
         else:
-            fname = re.search(r'/(graph\d+\.\w+) (written|saved)', res).group(1)
+            fname = self.matchers.graph_name(res).group(1)
             return self.cache_dir_str + '/' + fname
 
-    def clean_log_eol(self, child, code_lines, res):
+    def clean_log_eol(self, scanner, code_lines, res):
         """Clean output when expect hit a newline
 
         For the first line, try to match `. {lines[0][:75]}`, i.e. the first
         75 characters of the first line. (75, or linesize - 5) is chosen so
         that it catches lines that are `  1. ` inside a program or for loop
 
-        If it's a match, look at child.before to see how many characters were
+        If it's a match, look at the line to see how many characters were
         matched. If the line had more characters than were matched, take off
         the first 75 characters, prepend `> ` and try to match again.
         When the full line is matched, remove the first indexed object and
         repeat.
 
         Args:
-            child (pexpect.spawn): pexpect instance to send break to
-            code_lines (List[str]): List of code lines sent to console that have not yet been matched in output
+            scanner (LineScanner): scanner reading the console output
+            code_lines (deque[str]): Code lines sent to console that have
+                not yet been matched in output. Matched lines are removed in
+                place.
             res (str): Current line of result/output
 
         Returns:
-            (List[str], str, bool)
-            - List of code lines not yet matched in output after this
+            (deque[str], str)
+            - Code lines not yet matched in output after this
             - Result to be displayed
         """
-        regex = r'^\((note: )?file {}/graph\d+\.({}) not found\)'.format(
-            self.cache_dir_str, '|'.join(self.kernel.graph_formats))
-        if re.search(regex, res):
+        if self.matchers.not_found(res):
             return code_lines, None
 
-        if code_lines == []:
+        if not code_lines:
             return code_lines, res
 
         # On Windows, sometimes there are two spaces between the dot prompt and
@@ -470,9 +782,9 @@ class StataSession():
             return code_lines, res
 
         if self.mata_enter(res) and self.mata_mode:
-            res_match = re.search(self.stata_prompt_regex, res)
+            res_match = self.matchers.stata_prompt(res)
         else:
-            res_match = re.search(self.prompt_regex, res)
+            res_match = self.matchers.prompt(res)
 
         if not res_match:
             return code_lines, ''
@@ -482,43 +794,122 @@ class StataSession():
         # it's on the next line.
         code_lines[0] = code_lines[0][len(res):]
         res = ''
+        deadline = default_timer() + 5
         while code_lines[0]:
-            try:
-                child.expect(r'\r?\n', timeout=5)
-                res += child.before
-            except pexpect.EOF:
-                res += child.before
-                sleep(0.05)
+            res = yield from scanner.readline(timeout=5)
+            if res is None:
+                # Leave the pager prompt for `expect` to break out of
+                if scanner.at_more():
+                    if config.get_bool('pager', True):
+                        break
+                    scanner.resume()
+                    continue
+                if default_timer() > deadline:
+                    raise pexpect.TIMEOUT('continuation line not found')
+                yield from self._idle(scanner, scanner.child)
                 continue
             assert res.startswith('> ')
             res = res[2:]
             code_lines[0] = code_lines[0][len(res):]
             res = ''
 
-        return code_lines[1:], None
+        code_lines.popleft()
+        return code_lines, None
 
-    def send_break(self, child, md5):
+    def send_break(self, child):
         """Send break to Stata
 
         Tell Stata to stop current execution. This is used when `expect` hits
         more and for a KeyboardInterrupt. I've found that ctrl-C, ctrl-D is the
         most consistent way for the console version to stop execution.
 
-        Often, the first characters after sending ctrl-C, ctrl-D get removed.
-        Thus, I send the md5 an extra time so that the full md5 can be matched
-        without issues.
+        The break also throws away whatever was queued behind the running
+        command, including the md5 that marks the end of the cell, and often
+        the first characters sent after ctrl-C, ctrl-D get removed. Thus, I
+        send a new marker that nothing else can print, and return a regex for
+        the end of its echo.
 
         Args:
             child (pexpect.spawn): pexpect instance to send break to
-            md5 (str): The md5 to send a second time
+
+        Returns:
+            (str): regex matching the end of the line with the marker
         """
+        token = uuid4().hex
+        marker = "`{}'".format(token)
         if config.get('execution_mode') == 'console':
             child.sendcontrol('c')
             child.sendcontrol('d')
-            self.child.sendline(md5)
+            child.sendline(marker)
         else:
             self.automate('UtilSetStataBreak')
-            self.automate('DoCommandAsync', md5)
+            self.automate('DoCommandAsync', marker)
+        return re.escape(marker[-17:]) + r'[^\n]*\n'
+
+    def _resync(self, scanner, child):
+        """Break out of the running command and skip to the prompt after it
+
+        The cell's deadline no longer applies. Another interrupt while
+        waiting sends a new break, and the wait is for its marker instead.
+        """
+        scanner.deadline = None
+        regex = self.send_break(child)
+        while True:
+            try:
+                return (yield from self._readuntil(scanner, regex))
+            except KeyboardInterrupt:
+                regex = self.send_break(child)
+
+    def _readuntil(self, scanner, regex):
+        """Read past `regex`, waiting for the log file to be written to"""
+        while True:
+            before, match = yield from scanner.readuntil(regex)
+            if match is not None:
+                return before, match
+            yield from self._idle(scanner, scanner.child)
+
+    def _idle(self, scanner, child, base=0.05):
+        """Wait at the end of the output for Stata to write more
+
+        The end of a log file is only as far as Stata has got, so wait and
+        read again. The wait grows with the time since the last output, up
+        to `max_idle_wait` seconds, so that long-running commands don't
+        wake the kernel up 20 times a second.
+        It ends at the scanner's `deadline`, if that comes first.
+
+        Output from the console only ends when the console has exited.
+        Then, and whenever Stata is no longer running, raise `pexpect.EOF`
+        instead of waiting for output that will never come.
+        """
+        if not self.alive(child):
+            raise pexpect.EOF(self.exit_message())
+
+        scanner.check_deadline()
+        idle = default_timer() - scanner.last_read
+        seconds = min(base + idle / 4, self.max_idle_wait)
+        if scanner.deadline is not None:
+            seconds = min(seconds, max(scanner.deadline - default_timer(), 0))
+        yield from wait(seconds)
+
+    def alive(self, child):
+        """Whether Stata is still running
+
+        Only the console is a process of the kernel; in automation mode,
+        Stata is assumed to be running.
+        """
+        if isinstance(child, CONSOLES + (LogTail, )):
+            return self.child.isalive()
+        return True
+
+    def exit_message(self):
+        if self.child.signalstatus is not None:
+            how = 'was killed by signal {}'.format(self.child.signalstatus)
+        elif self.child.exitstatus is not None:
+            how = 'exited with status {}'.format(self.child.exitstatus)
+        else:
+            # A remote console whose agent can't be reached
+            how = 'can no longer be reached'
+        return 'Stata {}.'.format(how)
 
     def automate(self, cmd_name, value=None, **kwargs):
         """Execute `cmd_name` through Automation in a cross-platform manner
@@ -577,6 +968,13 @@ class StataSession():
             self.automate('DoCommandAsync', 'exit, clear')
         else:
             self.child.close(force=True)
+            if self.log_tail is not None:
+                self.log_tail.close()
+
+        if self.standby_thread is not None:
+            self.standby_thread.join()
+            if self.standby is not None:
+                self.standby.shutdown()
         return
 
     def show_gui(self):
@@ -629,34 +1027,26 @@ class StataSession():
         else:
             return line
 
-    def _mata_break(self, match_index, child):
+    def _mata_break(self, match_index, scanner, child, after):
         # Only full input allowed in mata: If command ended in line
         # continuation, yell at the user. Note that some valid mata code
         # ends in a line continuation. In this case we hack it by adding
         # {} and {}.
-        if self.mata_mode and child.after.startswith('> ') and match_index == 0:
-            mata_index = -1
+        if self.mata_mode and after.startswith('> ') and match_index == MD5:
+            prompt = r'\r\n[\.:>]'
             child.sendline('{}\n')
-            while mata_index == -1:
-                mata_index = child.expect([
-                    r'\r\n\.', r'\r\n:', r'\r\n>', pexpect.EOF])
-                sleep(0.01)
-
-            mata_index = -1
+            yield from self._readuntil(scanner, prompt)
             child.sendline('{}\n')
-            while mata_index == -1:
-                mata_index = child.expect([
-                    r'\r\n\.', r'\r\n:', r'\r\n>', pexpect.EOF])
-                sleep(0.01)
+            before, match = yield from self._readuntil(scanner, prompt)
 
-            res = re.sub(r'^ *{}(\r\n)?', '', child.before)
+            res = re.sub(r'^ *{}(\r\n)?', '', before)
             self.kernel.send_response(
                 self.kernel.iopub_socket, 'stream', {
                     'text': res + '\n',
                     'name': 'stdout'})
 
             self.mata_restart = True
-            if re.match(r'(\r?\n)? *>(\r?\n)?', child.after):
+            if re.match(r'(\r?\n)? *>(\r?\n)?', match.group(0)):
                 if config.get('execution_mode') == 'console':
                     child.sendcontrol('c')
                     child.sendcontrol('d')
@@ -664,4 +1054,4 @@ class StataSession():
                 else:
                     self.automate('UtilSetStataBreak')
 
-                child.expect(r'\r?\n: ')
+                yield from self._readuntil(scanner, r'\r?\n: ')
@@ -0,0 +1,387 @@
+"""Benchmarks against the simulated Stata console
+
+Run from the project root with
+
+    python tests/benchmarks.py [name ...]
+
+where each name is one of the functions registered below. With no names,
+all benchmarks are run.
+"""
+
+import os
+import sys
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_stata import FakeKernel, start_session  # noqa: E402
+from stata_kernel.config import config  # noqa: E402
+from stata_kernel.code_manager import CodeManager  # noqa: E402
+
+benchmarks = {}
+
+
+def benchmark(f):
+    benchmarks[f.__name__] = f
+    return f
+
+
+def run(session, code, **kwargs):
+    cm = CodeManager(code)
+    text_to_run, md5, text_to_exclude = cm.get_text(session)
+    start = default_timer()
+    rc, res = session.do(
+        text_to_run, md5, text_to_exclude=text_to_exclude, **kwargs)
+    return default_timer() - start
+
+
+@benchmark
+def output_buffer(session):
+    """IOPub messages and wall time for large outputs
+
+    `output_flush_bytes = 1` sends every line as its own message, which is
+    how output was sent before it was buffered.
+    """
+    print('{:>8} {:>12} {:>10} {:>10} {:>12}'.format(
+        'lines', 'flush_bytes', 'messages', 'seconds', 'messages/s'))
+    for nlines in [10000, 100000]:
+        for flush_bytes in ['1', '65536']:
+            config.set('output_flush_bytes', flush_bytes)
+            session.kernel.messages = []
+            seconds = run(session, 'fake_output {}'.format(nlines))
+            messages = len(session.kernel.messages)
+            print('{:>8} {:>12} {:>10} {:>10.2f} {:>12.0f}'.format(
+                nlines, flush_bytes, messages, seconds, messages / seconds))
+
+    config._remove_unsafe('output_flush_bytes')
+
+
+@benchmark
+def output_scaling(session):
+    """Time in `expect` should grow linearly with the amount of output
+
+    Runs 250k and 1M lines of output, and includes of 25k and 100k echoed
+    code lines, and checks that four times the work takes well under eight
+    times as long.
+    """
+    cases = [
+        ('output lines', lambda n: 'fake_output {}'.format(n), 250000),
+        ('code lines', lambda n: '\n'.join(['di 1'] * n), 25000)]
+    for label, make_code, n in cases:
+        times = []
+        for size in [n, 4 * n]:
+            seconds = run(session, make_code(size), display=False)
+            times.append(seconds)
+            print('{:>8} {:<12} {:>8.2f}s {:>8.2f}us/line'.format(
+                size, label, seconds, 1e6 * seconds / size))
+
+        ratio = times[1] / times[0]
+        print('ratio: {:.2f}'.format(ratio))
+        assert ratio < 8, 'expect() scales worse than linearly'
+
+
+@benchmark
+def console_throughput(session):
+    """MB/s of console output processed by `expect`"""
+    text = 'x' * 70
+    for nlines in [20000, 100000]:
+        seconds = run(
+            session, 'fake_output {} {}'.format(nlines, text), display=False)
+        nbytes = sum(
+            len('{} {}\r\n'.format(text, i)) for i in range(nlines))
+        print('{:>8} lines {:>8.1f} MB {:>8.2f}s {:>8.2f} MB/s'.format(
+            nlines, nbytes / 1e6, seconds, nbytes / 1e6 / seconds))
+
+
+@benchmark
+def normalize_lines(session):
+    """Cleaning up console lines one at a time or a chunk at a time
+
+    Each line used to go through the escape sequence regex, a regex replace
+    of `\\r\\n` and a concatenation. `normalize` does the lines of a chunk
+    together, and skips the regex if the chunk has no escapes.
+    """
+    import re
+    from stata_kernel.output import ansi_escape, normalize
+
+    def per_line(lines):
+        text = []
+        for res in lines:
+            res = ansi_escape.sub('', res)
+            res += '\n'
+            res = re.sub(r'\r\n', '\n', res)
+            text.append(res)
+        return ''.join(text)
+
+    def chunked(lines):
+        return ''.join(
+            normalize(lines[i:i + 512]) for i in range(0, len(lines), 512))
+
+    cases = [
+        ('plain', ['x' * 70 + ' {}'.format(i) for i in range(200000)]),
+        ('escapes', [
+            '\x1b[1m' + 'x' * 70 + ' {}\x1b[0m\r'.format(i)
+            for i in range(200000)])]
+    for label, lines in cases:
+        times = []
+        for f in [per_line, chunked]:
+            start = default_timer()
+            text = f(lines)
+            times.append(default_timer() - start)
+        assert text == per_line(lines)
+        print('{:>8} {:>8.1f}ms per line {:>8.1f}ms chunked {:>6.1f}x'.format(
+            label, 1000 * times[0], 1000 * times[1], times[0] / times[1]))
+
+
+@benchmark
+def echo_cleaning(session):
+    """Cost per line of taking the echo of a 100k-line include out of output
+
+    Every echoed line is checked for Stata's note that a graph wasn't found
+    and matched against the prompt. Those regexes used to be built with
+    `str.format` and looked up in `re`'s cache on each line; now they are
+    compiled once into `session.matchers`.
+    """
+    import re
+
+    n = 100000
+    seconds = run(session, '\n'.join(['di 1'] * n), display=False)
+    print('{:>8} lines {:>8.2f}s {:>8.2f}us/line end to end'.format(
+        n, seconds, 1e6 * seconds / n))
+
+    lines = ['. di {}'.format(i) for i in range(n)]
+    formats = session.kernel.graph_formats
+
+    def formatted():
+        for res in lines:
+            regex = r'^\((note: )?file {}/graph\d+\.({}) not found\)'.format(
+                session.cache_dir_str, '|'.join(formats))
+            re.search(regex, res)
+            re.search(session.prompt_regex, res)
+
+    def compiled():
+        matchers = session.matchers
+        for res in lines:
+            matchers.not_found(res)
+            matchers.prompt(res)
+
+    for label, f in [('formatted', formatted), ('compiled', compiled)]:
+        start = default_timer()
+        f()
+        seconds = default_timer() - start
+        print('{:>10} {:>8.2f}us/line'.format(label, 1e6 * seconds / n))
+
+
+@benchmark
+def restart(session):
+    """Seconds until Stata can run code again after a restart
+
+    Without a standby console, restarting means shutting Stata down and
+    starting and initializing a new one, as restarting the kernel does. With
+    `standby_session` on, `restart` swaps in the console started in the
+    background.
+    """
+    from stata_kernel.stata_session import StataSession
+
+    cold = []
+    for i in range(5):
+        start = default_timer()
+        session.shutdown()
+        session = StataSession(FakeKernel())
+        run(session, 'di 1')
+        cold.append(default_timer() - start)
+    session.shutdown()
+
+    config.set('standby_session', 'True')
+    session = start_session()
+    warm = []
+    for i in range(5):
+        session.standby_thread.join()
+        start = default_timer()
+        session.restart()
+        run(session, 'di 1')
+        warm.append(default_timer() - start)
+    session.shutdown()
+    config._remove_unsafe('standby_session')
+
+    for label, times in [('cold', cold), ('standby', warm)]:
+        print('{:>8} {:>8.1f}ms median {:>8.1f}ms max'.format(
+            label, 1000 * sorted(times)[2], 1000 * max(times)))
+    return start_session()
+
+
+@benchmark
+def post_hook(session):
+    """Time spent after each cell reading the kernel's state from Stata
+
+    The kernel used to run each of these as its own execution, each with its
+    markers, echo and prompt to wait for. `_StataKernelPostHook` reads them
+    all in one. With `autocomplete_refresh = lazy`, it leaves out the
+    completions.
+    """
+    import asyncio
+    from test_post_hook import start_kernel
+    from stata_kernel.completions import ALL_LOCALS
+
+    separate = [
+        "tempname __user_rc\nlocal `__user_rc' = _rc",
+        '_StataKernelLog off', "di `c(linesize)'", 'pwd',
+        '_StataKernelCompletions', ALL_LOCALS, "macro list `:all globals'",
+        '_StataKernelLog on',
+        "_StataKernelResetRC, num(``__user_rc'')\nmacro drop _`__user_rc'"
+        "\nmacro drop ___user_rc"]
+
+    async def one_by_one():
+        for code in separate:
+            await kernel.quickdo(code, wide=(code != "di `c(linesize)'"))
+
+    async def repeat(hook, n):
+        for i in range(n):
+            await hook()
+
+    kernel = start_kernel()
+    n = 200
+    try:
+        async def lazy():
+            await kernel.post_do_hook(completions=False)
+
+        for label, hook, trips in [
+                ('separate', one_by_one, len(separate)),
+                ('one', kernel.post_do_hook, 1),
+                ('lazy', lazy, 1)]:
+            start = default_timer()
+            asyncio.run(repeat(hook, n))
+            seconds = default_timer() - start
+            print('{:>10} {:>3} round trips {:>8.2f}ms/cell'.format(
+                label, trips, 1000 * seconds / n))
+    finally:
+        kernel.stata.shutdown()
+
+
+@benchmark
+def completions_unchanged(session):
+    """Parsing the completions of a large session after each cell
+
+    `_StataKernelCompletions, changed` prints `%unchanged%` for lists whose
+    signature didn't change, and Mata objects and programs listed the same as
+    last time aren't parsed again.
+    """
+    from types import SimpleNamespace
+    from stata_kernel.completions import CompletionsManager
+
+    def output(names):
+        return '\n'.join([
+            '%mata%', '-' * 40, *(
+                '    {:>4}   transmorphic   f{}()'.format(i, i)
+                for i in range(300)), '-' * 40, '%varlist%',
+            names('var'), '%globals%', names('g'), '%logfiles%', '%scalars%',
+            names('s'), '%programs%', *(
+                '  ado      {:>4}  prog{}'.format(i, i) for i in range(300)),
+            '         --------', '            45150', '%matrices%',
+            names('m'), ''])
+
+    full = output(lambda prefix: ' '.join(
+        '{}{}'.format(prefix, i) for i in range(2000)))
+    unchanged = output(lambda prefix: '%unchanged%')
+
+    kernel = SimpleNamespace(
+        magics=SimpleNamespace(available_magics=[]), stata=session)
+    completions = CompletionsManager(kernel)
+    n = 200
+    for label, res in [('full', full), ('unchanged', unchanged)]:
+        completions.update(kernel, full, '', '')
+        start = default_timer()
+        for i in range(n):
+            completions.update(kernel, res, '', '')
+        seconds = default_timer() - start
+        print('{:>10} {:>8.2f}ms/cell'.format(label, 1000 * seconds / n))
+    return session
+
+
+@benchmark
+def cell_latency(session):
+    """Time from a cell's request to its reply
+
+    The post-hook used to run before the reply was sent. Now it runs after,
+    and only the next request waits for it. Each cell here is sent once the
+    previous hook is done, as when the user takes a moment between cells.
+    """
+    import asyncio
+    from test_post_hook import CellKernel, start_kernel
+
+    async def awaited(code):
+        reply = await kernel.do_execute(code, False)
+        await kernel.settle()
+        return reply
+
+    async def after_reply(code):
+        return await kernel.do_execute(code, False)
+
+    async def repeat(cell, n):
+        seconds = 0
+        for i in range(n):
+            start = default_timer()
+            await cell('global who {}'.format(i))
+            seconds += default_timer() - start
+            await kernel.settle()
+        return seconds
+
+    kernel = start_kernel(CellKernel)
+    n = 200
+    try:
+        for label, cell in [('awaited', awaited), ('after', after_reply)]:
+            seconds = asyncio.run(repeat(cell, n))
+            print('{:>10} {:>8.2f}ms/cell until the reply'.format(
+                label, 1000 * seconds / n))
+    finally:
+        kernel.stata.shutdown()
+
+
+@benchmark
+def run_all(session):
+    """Total time of Run All on a notebook of many small cells
+
+    All cells are queued at once. The post-hook used to read the completions
+    after each of them; now only the last one does, and the others only read
+    the linesize, working directory and logs.
+    """
+    import asyncio
+    from test_post_hook import CellKernel, start_kernel
+
+    async def run_all(queued):
+        queue = asyncio.Queue()
+        for code in cells:
+            queue.put_nowait(code)
+        kernel.msg_queue = queue if queued else None
+        start = default_timer()
+        while not queue.empty():
+            await kernel.do_execute(queue.get_nowait(), False)
+        await kernel.settle()
+        return default_timer() - start
+
+    kernel = start_kernel(CellKernel)
+    cells = ['global cell {}'.format(i) for i in range(300)]
+    try:
+        for label, queued in [('each', False), ('deferred', True)]:
+            seconds = asyncio.run(run_all(queued))
+            print('{:>10} {:>8.0f}ms for {} cells'.format(
+                label, 1000 * seconds, len(cells)))
+    finally:
+        kernel.msg_queue = None
+        kernel.stata.shutdown()
+    return session
+
+
+def main(names):
+    session = start_session()
+    try:
+        for name in names or benchmarks:
+            print('\n# {}\n'.format(name))
+            session = benchmarks[name](session) or session
+    finally:
+        session.shutdown()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
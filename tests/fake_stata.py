@@ -0,0 +1,460 @@
+"""Simulated Stata console for tests and benchmarks
+
+Running this file starts a minimal imitation of the Stata console: it prints a
+banner and a dot prompt, echoes every line it reads the way Stata does
+(wrapping long lines with `> ` continuations) and understands just enough
+commands for `StataSession` to initialize and for tests to produce output:
+
+- `di`/`display` with quoted strings and `_rc`, or an arithmetic expression
+- `include path` runs the lines of a do file, echoing each one, and
+  `do path` also ends with Stata's `end of do-file`
+- `fake_output N [text]` prints N numbered lines
+- `fake_sleep S` waits S seconds before returning to the prompt, unless a
+  break (ctrl-C) arrives first
+- `fake_crash N` exits at once with status N, like Stata being killed
+- `fake_error N` prints `r(N);`, or sets `_rc` to N under `capture`
+- `more` shows a `--more--` pager prompt until a key is pressed, or a break
+  (ctrl-C) arrives; `set more off` turns it into a no-op
+- `fake_list N` prints N numbered lines like `fake_output`, but pauses at the
+  pager prompt every `set pagesize` lines while `more` is on
+- `global name = expr` stores a global, and `$name` is expanded
+- `scalar name = expr` stores a scalar, which `di scalar(name)` shows
+- `graph export path` prints Stata's note that the graph was written,
+  wrapped at the line size; graph commands themselves do nothing
+- `set linesize N` changes the width at which echoed lines wrap
+- `log using path, ...` copies everything but the pager prompt to a text log
+  until `log close`
+- `fake_data text` puts text in memory in place of a dataset, and `fake_data`
+  shows it; `clear` and `clear all` drop it (`clear all` scalars too), and
+  `macro drop _all` or `macro drop name` drops globals
+- `_StataKernelPark save|restore dir` saves or loads what the checkpoint
+  does, the linesize and the open log, which is closed and then appended
+  to, like the ado program of that name
+- `_StataKernelCheckpoint save|restore dir` saves or loads the data,
+  globals and scalars in the directory, skipping the data if it didn't
+  change, and prints the same summary as the ado program
+- `_StataKernelPostHook begin|end [completions]` prints the sections that
+  the ado program does, with the text of `fake_data` as the only variable
+  and the open log as the only log file.
+  Like the ado program, it keeps signatures of the lists of variables and
+  globals in `$stata_kernel_signatures`, and prints `%unchanged%` for a list
+  whose signature is the same as last time. Globals starting with
+  `stata_kernel_` aren't listed
+
+Anything else is accepted silently. Importing the module gives access to
+`FakeKernel` and `start_session`, which spawn a `StataSession` against this
+console.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import select
+import signal
+import termios
+import tempfile
+
+from contextlib import contextmanager
+
+STATA_VERSION = '17.0'
+
+# Keep the tests from reading or writing the user's own configuration
+os.environ.setdefault('CONTINUOUS_INTEGRATION', 'true')
+os.environ.setdefault(
+    'STATA_KERNEL_USER_CONFIG_PATH',
+    os.path.join(tempfile.gettempdir(), 'stata_kernel_test.conf'))
+
+
+class FakeStata():
+    def __init__(self):
+        self.linesize = 80
+        self.more = True
+        self.pagesize = 23
+        self.globals = {}
+        self.scalars = {}
+        self.rc = 0
+        self.log = None
+        self.data = ''
+        # Input read from the terminal but not run yet
+        self.pending = b''
+
+    def write(self, text):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        if self.log is not None:
+            self.log.write(text)
+            self.log.flush()
+
+    def prompt(self):
+        self.write('\n. ')
+
+    def echo(self, line, prompt=''):
+        width = max(self.linesize - 2, 1)
+        first = line[:width]
+        rest = line[width:]
+        self.write(prompt + first + '\n')
+        while rest:
+            self.write('> ' + rest[:width] + '\n')
+            rest = rest[width:]
+
+    def expand(self, text):
+        text = text.replace("`c(stata_version)'", STATA_VERSION)
+        text = text.replace("`c(linesize)'", str(self.linesize))
+        text = re.sub(
+            r'\$\{?(\w+)\}?', lambda m: self.globals.get(m.group(1), ''), text)
+        text = text.replace('`"', '"').replace('"\'', '"')
+        return re.sub(r"`[^'`]*'", '', text)
+
+    def run(self, line, nested=False):
+        line = line.rstrip('\r\n')
+        if nested:
+            self.echo(line, prompt='. ')
+        else:
+            self.echo(line)
+
+        cmd = self.expand(line).strip()
+        captured = False
+        for prefix in ('cap ', 'capture ', 'qui ', 'quietly ', 'noi '):
+            if cmd.startswith(prefix):
+                cmd = cmd[len(prefix):].strip()
+                captured = captured or prefix.startswith('cap')
+
+        if not cmd:
+            return
+        name, _, args = cmd.partition(' ')
+        args = args.strip()
+        if name in ('di', 'dis', 'disp', 'display'):
+            self.display(args)
+        elif name in ('include', 'do'):
+            path = args.strip('"`\'')
+            with open(path, encoding='utf-8') as f:
+                for included in f:
+                    self.run(included, nested=True)
+            if name == 'do':
+                self.write('\n. \nend of do-file\n')
+        elif name == 'fake_output':
+            parts = args.split(' ', 1)
+            text = parts[1] if len(parts) > 1 else 'line'
+            self.write(''.join(
+                '{} {}\n'.format(text, i) for i in range(int(parts[0]))))
+        elif name == 'fake_list':
+            for i in range(int(args)):
+                if self.more and i and (i % self.pagesize == 0):
+                    self.pager()
+                self.write('line {}\n'.format(i))
+        elif name == 'fake_sleep':
+            with self.breakable():
+                time.sleep(float(args))
+        elif name == 'global':
+            gname, _, value = args.partition(' ')
+            value = value.strip()
+            if value.startswith('='):
+                value = str(eval(value[1:], {'__builtins__': {}}))
+            self.globals[gname] = value
+        elif name == 'scalar':
+            sname, _, value = args.partition('=')
+            self.scalars[sname.strip()] = eval(value, {'__builtins__': {}})
+        elif name in ('gr', 'graph') and args.startswith('export'):
+            path = re.search(r'"(.+?)"', args).group(1)
+            fmt = path.rsplit('.', 1)[-1].upper()
+            self.echo('(file {} written in {} format)'.format(path, fmt))
+        elif name == 'fake_crash':
+            os._exit(int(args or 1))
+        elif name == 'fake_error':
+            if captured:
+                self.rc = int(args)
+            else:
+                self.write('r({});\n'.format(int(args)))
+        elif name == 'log':
+            self.log_command(args)
+        elif name == 'fake_data':
+            if args:
+                self.data = args
+            else:
+                self.write(self.data + '\n')
+        elif name == 'clear':
+            self.data = ''
+            if args == 'all':
+                self.scalars = {}
+        elif name == 'macro' and args == 'drop _all':
+            self.globals = {}
+        elif name == 'macro' and args.startswith('drop '):
+            for gname in args.split()[1:]:
+                self.globals.pop(gname, None)
+        elif name == '_StataKernelPark':
+            self.park(*args.split(' ', 1))
+        elif name == '_StataKernelCheckpoint':
+            self.checkpoint(*args.split(' ', 1))
+        elif name == '_StataKernelPostHook':
+            self.post_hook(args)
+        elif name == 'more':
+            if self.more:
+                self.pager()
+        elif name == 'set':
+            setting, _, value = args.partition(' ')
+            if setting == 'linesize':
+                self.linesize = int(value)
+            elif setting == 'pagesize':
+                self.pagesize = int(value)
+            elif setting == 'more':
+                self.more = value.strip() == 'on'
+
+    def display(self, args):
+        tokens = re.findall(r'"[^"]*"|_rc\b|\S+', args)
+        if tokens and all(t.startswith('"') or t == '_rc' for t in tokens):
+            self.write(''.join(
+                str(self.rc) if t == '_rc' else t[1:-1] for t in tokens) + '\n')
+        elif args:
+            try:
+                args = re.sub(
+                    r'scalar\((\w+)\)',
+                    lambda m: repr(self.scalars[m.group(1)]), args)
+                value = eval(args, {'__builtins__': {}})
+                self.write('{}\n'.format(value))
+            except Exception:
+                self.write('r(198);\n')
+        else:
+            self.write('\n')
+
+    def park(self, what, path):
+        self.checkpoint(what, path, quiet=True)
+        path = os.path.join(path.strip('"`\''), 'park.json')
+        if what == 'save':
+            logfile = None
+            if self.log is not None:
+                logfile = self.log.name
+                self.log_command('close')
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({'linesize': self.linesize, 'log': logfile}, f)
+        else:
+            with open(path, encoding='utf-8') as f:
+                state = json.load(f)
+            self.linesize = state['linesize']
+            if state['log']:
+                self.open_log(state['log'], append=True)
+
+    def checkpoint(self, what, path, quiet=False):
+        path = path.strip('"`\'')
+        manifest = os.path.join(path, 'manifest.json')
+        data = os.path.join(path, 'frame_default.json')
+        if what == 'save':
+            os.makedirs(path, exist_ok=True)
+            old = {}
+            if os.path.exists(manifest):
+                with open(manifest, encoding='utf-8') as f:
+                    old = json.load(f)
+
+            saved = 0
+            signature = str(len(self.data)) + ':' + self.data
+            if (old.get('signature') != signature) or not os.path.exists(data):
+                with open(data, 'w', encoding='utf-8') as f:
+                    json.dump(self.data, f)
+                saved = 1
+            with open(manifest, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'signature': signature, 'globals': self.globals,
+                    'scalars': self.scalars}, f)
+            if quiet:
+                return
+            self.write(
+                'Checkpoint saved to {}: {} frame(s) saved, {} unchanged, '
+                '{} globals, {} scalars, 0 matrices, 0 stored estimates.'
+                '\n'.format(
+                    path, saved, 1 - saved, len(self.globals),
+                    len(self.scalars)))
+        else:
+            if not os.path.exists(manifest):
+                self.write('no checkpoint in {}\nr(601);\n'.format(path))
+                return
+            with open(manifest, encoding='utf-8') as f:
+                state = json.load(f)
+            with open(data, encoding='utf-8') as f:
+                self.data = json.load(f)
+            counter = int(self.globals.get('stata_kernel_graph_counter', 0))
+            self.globals = state['globals']
+            self.globals['stata_kernel_graph_counter'] = str(max(
+                counter, int(self.globals.get('stata_kernel_graph_counter', 0))))
+            self.globals.pop('stata_kernel_signatures', None)
+            self.scalars = state['scalars']
+            if quiet:
+                return
+            self.write('Restored the checkpoint in {}.\n'.format(path))
+
+    def post_hook(self, what):
+        if what == 'begin':
+            self.write('%locals%\n')
+            return
+
+        linesize = self.globals.get('stata_kernel_linesize', self.linesize)
+        self.write('%linesize%\n{}\n%pwd%\n{}\n'.format(
+            linesize, os.getcwd()))
+        logfiles = '' if self.log is None else self.log.name + '\n'
+        if what != 'end completions':
+            self.write('%logfiles%\n' + logfiles)
+            return
+
+        self.write('%macros%\n')
+        for name, value in self.globals.items():
+            self.write('{}:{}{}\n'.format(
+                name, ' ' * max(16 - len(name), 1), value))
+
+        names = {
+            'varlist': self.data,
+            'globals': ' '.join(
+                g for g in self.globals if not g.startswith('stata_kernel_'))}
+        last = self.globals.get('stata_kernel_signatures', '').split()
+        signatures = []
+        for what, listed in names.items():
+            signature = '{}={},{}'.format(
+                what, len(listed.split()), hash(listed))
+            signatures.append(signature)
+            if signature in last:
+                names[what] = '%unchanged%'
+        self.globals['stata_kernel_signatures'] = ' '.join(signatures)
+        self.write(
+            '%mata%\n%varlist%\n{varlist}\n%globals%\n{globals}\n'
+            '%logfiles%\n{logfiles}%scalars%\n\n%programs%\n'
+            '  ado      100  _StataKernelPostHook\n%matrices%\n\n'.format(
+                logfiles=logfiles, **names))
+
+    def log_command(self, args):
+        if args.startswith('using'):
+            path = re.search(r'"(.+?)"', args).group(1)
+            self.open_log(path, append='append' in args)
+        elif args.startswith('close') and self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def open_log(self, path, append=False):
+        if not append:
+            open(path, 'w').close()
+        # Appending, like Stata, so writes after the kernel trims the log
+        # land at its new end
+        self.log = open(path, 'a', encoding='utf-8')
+        self.log.write('      name:  stata_kernel_log\n')
+        self.log.write('       log:  {}\n  log type:  text\n'.format(path))
+
+    def readline(self):
+        """Next line of input, or '' at the end of the input"""
+        fd = sys.stdin.fileno()
+        while b'\n' not in self.pending:
+            data = os.read(fd, 65536)
+            if not data:
+                line, self.pending = self.pending, b''
+                return line.decode('utf-8')
+            self.pending += data
+        line, _, self.pending = self.pending.partition(b'\n')
+        return line.decode('utf-8') + '\n'
+
+    def pager(self):
+        # Like Stata, show the pager prompt on the console only, and erase it
+        # once a key is pressed. Lines sent before it showed up are kept
+        # for after it.
+        fd = sys.stdin.fileno()
+        while select.select([fd], [], [], 0)[0]:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            self.pending += data
+        attrs = termios.tcgetattr(fd)
+        keys = list(attrs)
+        keys[3] = keys[3] & ~termios.ICANON
+        keys[6] = list(keys[6])
+        keys[6][termios.VMIN] = 1
+        keys[6][termios.VTIME] = 0
+        termios.tcsetattr(fd, termios.TCSANOW, keys)
+        sys.stdout.write('--more--')
+        sys.stdout.flush()
+        try:
+            with self.breakable():
+                os.read(fd, 1)
+        finally:
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+        sys.stdout.write('\r        \r')
+        sys.stdout.flush()
+
+    @contextmanager
+    def breakable(self):
+        signal.signal(signal.SIGINT, self.interrupt)
+        try:
+            yield
+        finally:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def interrupt(self, signum, frame):
+        raise KeyboardInterrupt
+
+    def main(self):
+        fd = sys.stdin.fileno()
+        if os.isatty(fd):
+            attrs = termios.tcgetattr(fd)
+            attrs[3] = attrs[3] & ~termios.ECHO
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+
+        # Like Stata, only stop on ctrl-C when there is something to break
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.write('  ___  ____  ____  ____  ____ (R)\n')
+        self.write(' /__    /   ____/   /   ____/   Fake Stata\n')
+        self.prompt()
+        eof = 0
+        while True:
+            line = self.readline()
+            if not line:
+                # ctrl-D on an empty line, which the real console ignores,
+                # unless the terminal is gone
+                eof += 1
+                if eof > 1000:
+                    break
+                continue
+            eof = 0
+            if line.strip() == 'exit, clear':
+                break
+            try:
+                self.run(line)
+            except KeyboardInterrupt:
+                self.write('\n--Break--\nr(1);\n')
+            self.prompt()
+
+
+class FakeKernel():
+    """Stand-in for `StataKernel` that records what would go to IOPub"""
+    implementation_version = '1.14.3'
+    graph_formats = ['svg', 'png', 'pdf', 'eps']
+    iopub_socket = None
+    output_keep = 65536
+
+    def __init__(self):
+        self.messages = []
+
+    def send_response(self, stream, msg_type, content):
+        self.messages.append((msg_type, content))
+
+    def graph_messages(self, graph_paths):
+        return [{
+            'data': {'text/plain': '\n'.join(graph_paths)},
+            'graph_paths': graph_paths}]
+
+    def stdout(self):
+        return ''.join(
+            content['text'] for msg_type, content in self.messages
+            if msg_type == 'stream' and content['name'] == 'stdout')
+
+
+def fake_stata_path():
+    return '{} {}'.format(sys.executable, os.path.abspath(__file__))
+
+
+def start_session(kernel=None):
+    """Start a `StataSession` attached to the simulated console"""
+    from stata_kernel.config import config
+    from stata_kernel.stata_session import StataSession
+
+    config.set('stata_path', fake_stata_path())
+    config.set('execution_mode', 'console')
+    return StataSession(kernel or FakeKernel())
+
+
+if __name__ == '__main__':
+    FakeStata().main()
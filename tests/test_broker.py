@@ -0,0 +1,114 @@
+import threading
+import pexpect
+import pytest
+
+from time import sleep
+from timeit import default_timer
+from fake_stata import fake_stata_path, start_session
+from test_stata_session import run
+from stata_kernel.config import config
+from stata_kernel.broker import Broker, stats
+
+
+class TestBroker(object):
+    """Kernels sharing one fake Stata console through a broker"""
+
+    token = 'broker-token'
+
+    def setup_method(self, method):
+        config.set('stata_path', fake_stata_path())
+        self.broker = Broker(self.token, size=1)
+        threading.Thread(target=self.broker.serve_forever, daemon=True).start()
+        self.address = '{}:{}'.format(*self.broker.server_address)
+        config.set('remote_agent', self.address)
+        config.set('remote_agent_token', self.token)
+        self.sessions = []
+
+    def teardown_method(self, method):
+        for session in self.sessions:
+            session.shutdown()
+        config._remove_unsafe('remote_agent')
+        config._remove_unsafe('remote_agent_token')
+        self.broker.shutdown()
+        self.broker.server_close()
+
+    def start(self):
+        session = start_session()
+        self.sessions.append(session)
+        return session
+
+    def test_park(self):
+        """Each kernel finds its data and globals again"""
+        a = self.start()
+        run(a, 'fake_data alpha\nglobal who a\nset linesize 100')
+        b = self.start()
+        assert run(b, 'fake_data')[1].strip() == ''
+        assert run(b, 'di "$who"')[1].strip() == ''
+        run(b, 'fake_data beta\nglobal who b')
+
+        assert run(a, 'fake_data')[1].strip() == 'alpha'
+        assert run(a, 'di "$who"')[1].strip() == 'a'
+        assert run(a, "di `c(linesize)'")[1].strip() == '100'
+        assert run(b, 'fake_data')[1].strip() == 'beta'
+
+        assert self.broker.started == 1
+        assert stats(self.address, self.token)['leases'] > 4
+
+    def test_park_scalars_and_logs(self, tmp_path):
+        """Scalars are kept, and an open log is appended to again"""
+        log = tmp_path / 'a.log'
+        a = self.start()
+        run(a, 'scalar answer = 42\nlog using "{}", text'.format(log))
+        b = self.start()
+        run(b, 'di "from b"')
+
+        assert run(a, 'di scalar(answer)')[1].strip() == '42'
+        run(a, 'di "back in a"\nlog close')
+        text = log.read_text()
+        assert 'di scalar(answer)' in text
+        assert 'back in a' in text
+        assert 'from b' not in text
+
+    def test_queue(self):
+        """A kernel waits for the console while another one runs code"""
+        a = self.start()
+        b = self.start()
+        results = {}
+        thread = threading.Thread(
+            target=lambda: results.update(a=run(a, 'fake_sleep 1\ndi 1')))
+        thread.start()
+        sleep(0.3)
+
+        waiting = threading.Thread(
+            target=lambda: results.update(b=run(b, 'di 2')))
+        waiting.start()
+        deadline = default_timer() + 5
+        while stats(self.address, self.token)['queued'] != 1:
+            assert default_timer() < deadline
+            sleep(0.05)
+        thread.join()
+        waiting.join()
+
+        assert results == {'a': (0, '\n1\n\n'), 'b': (0, '\n2\n\n')}
+        latency = stats(self.address, self.token)['lease_latency']
+        assert latency['max'] > 0.3
+
+    def test_exit(self):
+        """A console that exits is replaced, and its kernel is told"""
+        a = self.start()
+        with pytest.raises(pexpect.EOF, match='exited with status 5'):
+            run(a, 'fake_crash 5')
+        b = self.start()
+        assert run(b, 'di 1') == (0, '\n1\n\n')
+        assert self.broker.started == 2
+
+    def test_disconnect(self):
+        """The console of a kernel that shut down is cleared for the next"""
+        a = self.start()
+        run(a, 'fake_data alpha')
+        a.shutdown()
+        self.sessions.remove(a)
+
+        b = self.start()
+        assert run(b, 'fake_data')[1].strip() == ''
+        assert self.broker.started == 1
@@ -0,0 +1,82 @@
+from types import SimpleNamespace
+from fake_stata import start_session
+from test_stata_session import run
+from stata_kernel.stata_magics import StataMagics
+
+
+def stand_in_kernel(sc_delimit_mode=False):
+    """What `StataMagics` reads from the kernel for these magics"""
+    return SimpleNamespace(
+        implementation='stata_kernel', implementation_version='1.14.3',
+        language='stata', language_version='17', execution_count=1,
+        sc_delimit_mode=sc_delimit_mode)
+
+
+class TestCheckpoint(object):
+    """`%checkpoint` and `%restore` against fake Stata"""
+
+    @classmethod
+    def setup_class(cls):
+        cls.session = start_session()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.session.shutdown()
+
+    def magic(self, code):
+        kernel = stand_in_kernel()
+        magics = StataMagics(kernel)
+        code = magics.magic(code, kernel)
+        assert magics.status == 0
+        return run(self.session, code)
+
+    def test_round_trip(self, tmp_path):
+        path = str(tmp_path / 'with space')
+        run(self.session, 'fake_data alpha\nglobal who a')
+        rc, res = self.magic('%checkpoint ' + path)
+        assert rc == 0
+        assert '1 frame(s) saved, 0 unchanged' in res
+
+        run(self.session, 'fake_data beta\nglobal who b\nglobal extra 1')
+        assert self.magic('%restore ' + path)[0] == 0
+        assert run(self.session, 'fake_data')[1].strip() == 'alpha'
+        assert run(self.session, 'di "$who$extra"')[1].strip() == 'a'
+
+    def test_unchanged_data(self, tmp_path):
+        """Data that didn't change since the last checkpoint isn't saved"""
+        path = str(tmp_path)
+        run(self.session, 'fake_data alpha')
+        self.magic('%checkpoint ' + path)
+        run(self.session, 'global who a')
+        res = self.magic('%checkpoint ' + path)[1]
+        assert '0 frame(s) saved, 1 unchanged, ' in res
+
+        run(self.session, 'fake_data beta')
+        res = self.magic('%checkpoint ' + path)[1]
+        assert '1 frame(s) saved, 0 unchanged, ' in res
+
+    def test_graph_counter(self, tmp_path):
+        """Restoring doesn't number new graphs like ones already exported"""
+        path = str(tmp_path)
+        run(self.session, 'global stata_kernel_graph_counter 2')
+        self.magic('%checkpoint ' + path)
+        run(self.session, 'global stata_kernel_graph_counter 5')
+        self.magic('%restore ' + path)
+        res = run(self.session, 'di $stata_kernel_graph_counter')[1]
+        assert res.strip() == '5'
+
+    def test_default_path(self):
+        run(self.session, 'fake_data gamma')
+        self.magic('%checkpoint')
+        run(self.session, 'clear')
+        self.magic('%restore')
+        assert run(self.session, 'fake_data')[1].strip() == 'gamma'
+
+    def test_delimit(self, tmp_path):
+        kernel = stand_in_kernel(sc_delimit_mode=True)
+        code = StataMagics(kernel).magic('%checkpoint ' + str(tmp_path), kernel)
+        assert code.endswith("\"';")
+
+    def test_missing(self, tmp_path):
+        rc, res = self.magic('%restore ' + str(tmp_path / 'none'))
+        assert rc == 601
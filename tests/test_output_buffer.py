@@ -0,0 +1,326 @@
+import re
+import random
+import pytest
+import tracemalloc
+
+from pathlib import Path
+from timeit import default_timer
+from fake_stata import FakeKernel, start_session
+from stata_kernel.config import config
+from stata_kernel.output import OutputBuffer, ansi_escape, normalize
+from stata_kernel.code_manager import CodeManager
+
+
+def run(session, code, **kwargs):
+    session.kernel.messages = []
+    cm = CodeManager(code)
+    text_to_run, md5, text_to_exclude = cm.get_text(session)
+    return session.do(
+        text_to_run, md5, text_to_exclude=text_to_exclude, **kwargs)
+
+
+def reference(lines, ansi=True):
+    """What `StataSession.expect` did to each line before `normalize`"""
+    text = ''
+    for res in lines:
+        if ansi:
+            res = ansi_escape.sub('', res)
+        res += '\n'
+        res = re.sub(r'\r\n', '\n', res)
+        text += res
+    return text
+
+
+def random_lines(rng):
+    """Lines made of pieces of escape sequences, returns and text"""
+    pieces = [
+        '\x1b', '\x1b[', '[', '?', '1', '25', ';', 'h', 'l', 'm', 'K', 'O',
+        'R', 'n', '=', '#', '3', '(', 'B', '/Z', '0c', 'y', '\r', '\r\r',
+        ' ', 'a', '> ', '. ']
+    return [
+        ''.join(rng.choice(pieces) for _ in range(rng.randrange(10)))
+        for _ in range(rng.randrange(1, 6))]
+
+
+class TestNormalize(object):
+    """`normalize` against the per-line cleanup it replaces"""
+
+    @pytest.mark.parametrize('ansi', [True, False])
+    def test_same_as_per_line(self, ansi):
+        rng = random.Random(17)
+        for _ in range(20000):
+            lines = random_lines(rng)
+            assert normalize(lines, ansi) == reference(lines, ansi), lines
+
+    def test_return_before_escape(self):
+        """A return only ends the line if escape sequences alone follow it"""
+        lines = ['a\r\x1b[0m', 'b\r\x1b5;6R', '\r\x1b[0m\r\x1b[1m']
+        assert normalize(lines) == 'a\nb\r;6R\n\r\n'
+
+    def test_plain(self):
+        assert normalize(['a', '', 'b']) == 'a\n\nb\n'
+
+    def test_buffer_same_as_lines(self):
+        """Lines written a chunk at a time are sent as if one at a time"""
+        rng = random.Random(18)
+        for _ in range(2000):
+            lines = [
+                rng.choice(['', ' ', 'a', ' \x1b[0m', '\x1b[1mb', '\r'])
+                for _ in range(rng.randrange(1, 8))]
+            by_line = FakeKernel()
+            output = OutputBuffer(by_line, ansi=True)
+            for line in lines:
+                output.write(reference([line]))
+            output.close()
+
+            by_chunk = FakeKernel()
+            output = OutputBuffer(by_chunk, ansi=True)
+            cut = rng.randrange(len(lines) + 1)
+            for line in lines[:cut]:
+                output.write_line(line)
+            output.end_lines()
+            for line in lines[cut:]:
+                output.write_line(line)
+            output.close()
+            assert by_chunk.stdout() == by_line.stdout(), lines
+            assert output.text() == reference(lines)
+
+
+class TestOutputBuffer(object):
+    def test_coalesces_lines(self):
+        kernel = FakeKernel()
+        output = OutputBuffer(kernel)
+        output.flush_interval = 60
+        for i in range(100):
+            output.write('line {}\n'.format(i))
+        output.close()
+        assert len(kernel.messages) == 1
+        assert kernel.stdout() == ''.join(
+            'line {}\n'.format(i) for i in range(100))
+
+    def test_flushes_on_size(self):
+        kernel = FakeKernel()
+        output = OutputBuffer(kernel)
+        output.flush_bytes = 10
+        output.flush_interval = 60
+        output.write('12345\n')
+        assert kernel.messages == []
+        output.write('67890\n')
+        assert kernel.stdout() == '12345\n67890\n'
+
+    def test_blank_lines(self):
+        """Leading blanks are kept, one trailing newline is dropped"""
+        kernel = FakeKernel()
+        output = OutputBuffer(kernel)
+        for line in ['\n', '  \n', 'a\n', '\n', '\n']:
+            output.write(line)
+        output.close()
+        assert kernel.stdout() == '\n  \na\n\n'
+
+    def test_only_blank_lines(self):
+        kernel = FakeKernel()
+        output = OutputBuffer(kernel)
+        output.write('\n')
+        output.write('\n')
+        output.close()
+        assert kernel.messages == []
+
+    def test_no_display(self):
+        kernel = FakeKernel()
+        output = OutputBuffer(kernel, display=False)
+        output.write('a\n')
+        output.close()
+        assert kernel.messages == []
+
+    def test_keep(self):
+        kernel = FakeKernel()
+        output = OutputBuffer(kernel, keep=20)
+        lines = ['line {}\n'.format(i) for i in range(100)]
+        for line in lines:
+            output.write(line)
+        output.close()
+        assert output.text() == ''.join(lines)[-20:]
+        assert kernel.stdout() == ''.join(lines)
+        assert len(output.kept.pieces) <= 4
+
+    def test_max_bytes(self):
+        """Past the budget, output goes to a file and only its end is sent"""
+        config.set('output_max_bytes', '1000')
+        try:
+            kernel = FakeKernel()
+            output = OutputBuffer(kernel)
+            output.flush_bytes = 100
+            lines = ['line {}\n'.format(i) for i in range(500)]
+            for line in lines:
+                output.write(line)
+            output.close()
+        finally:
+            config._remove_unsafe('output_max_bytes')
+
+        texts = [content['text'] for _, content in kernel.messages[:-2]]
+        notice, tail = kernel.messages[-2:]
+        assert all(msg_type == 'stream' for msg_type, _ in kernel.messages[:-2])
+        head = ''.join(texts)
+        assert len(head) <= 900
+        assert ''.join(lines).startswith(head) and head.endswith('\n')
+
+        assert notice[0] == 'display_data'
+        path = output.spill.name
+        assert path in notice[1]['data']['text/plain']
+        assert Path(path).parent == Path(config.get('cache_dir'))
+        assert Path(path).read_text() == ''.join(lines)
+
+        assert tail[0] == 'stream'
+        assert len(tail[1]['text']) <= 100
+        assert tail[1]['text'].startswith('line ')
+        assert ''.join(lines).endswith(tail[1]['text'])
+
+    def test_max_bytes_omitted(self):
+        """The notice counts exactly the characters that weren't sent"""
+        config.set('output_max_bytes', '1000')
+        try:
+            kernel = FakeKernel()
+            output = OutputBuffer(kernel)
+            lines = ['{:<59}\n'.format(i) for i in range(50)]
+            for line in lines:
+                output.write(line)
+            output.close()
+        finally:
+            config._remove_unsafe('output_max_bytes')
+
+        notice = kernel.messages[-2][1]['data']['text/plain']
+        shown = len(kernel.stdout())
+        omitted = len(''.join(lines)) - shown
+        assert omitted == 2040
+        assert notice.startswith(
+            '... {:,} characters of output not shown'.format(omitted))
+
+    def test_max_bytes_not_reached(self):
+        kernel = FakeKernel()
+        output = OutputBuffer(kernel)
+        for i in range(100):
+            output.write('line {}\n'.format(i))
+        output.close()
+        assert output.spill is None
+        assert kernel.stdout() == ''.join(
+            'line {}\n'.format(i) for i in range(100))
+
+    def test_invalid_settings(self):
+        """Bad values are rejected by %set and ignored in the config file"""
+        assert config.is_valid('output_flush_interval', '50')
+        assert not config.is_valid('output_flush_interval', '100ms')
+        assert not config.is_valid('output_flush_bytes', '-1')
+        config.set('output_flush_interval', '100ms')
+        try:
+            output = OutputBuffer(FakeKernel())
+        finally:
+            config._remove_unsafe('output_flush_interval')
+        assert output.flush_interval == 0.1
+
+
+class TestSessionOutput(object):
+    @classmethod
+    def setup_class(cls):
+        cls.session = start_session()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.session.shutdown()
+
+    def test_large_output_is_batched(self):
+        rc, res = run(self.session, 'fake_output 5000')
+        assert rc == 0
+        messages = self.session.kernel.messages
+        assert len(messages) < 100
+        expected = ''.join('line {}\n'.format(i) for i in range(5000))
+        assert self.session.kernel.stdout().strip() == expected.strip()
+
+    def test_max_bytes(self):
+        config.set('output_max_bytes', '10000')
+        try:
+            rc, res = run(self.session, 'fake_output 5000')
+        finally:
+            config._remove_unsafe('output_max_bytes')
+        assert rc == 0
+        notices = [
+            content['data']['text/plain']
+            for msg_type, content in self.session.kernel.messages
+            if msg_type == 'display_data']
+        assert len(notices) == 1
+        assert 'line 4999' in self.session.kernel.stdout()
+        assert 'line 2500' not in self.session.kernel.stdout()
+        path = notices[0].split('The full output is in ')[1].strip()
+        assert 'line 2500\n' in Path(path).read_text()
+
+    def test_error_flushes_output_first(self):
+        rc, res = run(self.session, 'di "before"\nfake_error 111')
+        assert rc == 111
+        msg_types = [
+            content['name'] for msg_type, content in self.session.kernel.messages]
+        assert msg_types[:2] == ['stdout', 'stderr']
+        assert 'before' in self.session.kernel.stdout()
+
+    def test_interval_flush(self):
+        config.set('output_flush_interval', '50')
+        try:
+            run(self.session, 'di "first"\nfake_sleep 0.5\ndi "second"')
+        finally:
+            config._remove_unsafe('output_flush_interval')
+        texts = [content['text'] for _, content in self.session.kernel.messages]
+        assert len(texts) == 2
+        assert 'first' in texts[0] and 'second' in texts[1]
+
+    @pytest.mark.slow
+    @pytest.mark.parametrize('make_code, n', [
+        (lambda n: 'fake_output {}'.format(n), 20000),
+        (lambda n: '\n'.join(['di 1'] * n), 5000)])
+    def test_scales_linearly(self, make_code, n):
+        """Four times the output takes well under eight times as long
+
+        A smaller version of the `output_scaling` benchmark; anything that
+        rebuilds the output so far on every line is quadratic and fails this.
+        """
+        times = []
+        for size in [n, 4 * n]:
+            start = default_timer()
+            rc, res = run(self.session, make_code(size), display=False)
+            times.append(default_timer() - start)
+            assert rc == 0
+        assert times[1] / times[0] < 8
+
+    @pytest.mark.slow
+    def test_keep_memory_flat(self):
+        """With `keep`, peak memory doesn't grow with the size of the output
+
+        Without it, the whole output is kept and peak memory grows with it.
+        Sent messages are dropped, as they are by the real kernel. What was
+        sent is held for the spill file up to `output_max_bytes`, so that is
+        set below the size of the output.
+        """
+        self.session.kernel.send_response = lambda *args: None
+        config.set('output_max_bytes', '100000')
+        # Long enough lines that the text, not the objects holding it, is
+        # what grows with the output
+        text = 'x' * 40
+
+        def peak(code, **kwargs):
+            tracemalloc.start()
+            try:
+                run(self.session, code, **kwargs)
+                return tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+        try:
+            kept = [
+                peak('fake_output {} {}'.format(n, text), keep=65536)
+                for n in [10000, 100000]]
+            full = [
+                peak('fake_output {} {}'.format(n, text))
+                for n in [10000, 100000]]
+        finally:
+            del self.session.kernel.send_response
+            config._remove_unsafe('output_max_bytes')
+
+        assert kept[1] < 1.5 * kept[0]
+        assert full[1] > 4 * kept[1]
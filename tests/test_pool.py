@@ -0,0 +1,127 @@
+import asyncio
+
+from pathlib import Path
+from timeit import default_timer
+from fake_stata import FakeKernel, fake_stata_path
+from stata_kernel.config import config
+from stata_kernel.pool import SessionPool, ParallelCell
+from stata_kernel.output import OutputBuffer
+
+
+def displays(kernel):
+    """Last text shown in each display, by display id"""
+    shown = {}
+    for msg_type, content in kernel.messages:
+        if msg_type in ['display_data', 'update_display_data']:
+            display_id = content.get('transient', {}).get('display_id')
+            if display_id:
+                shown[display_id] = content['data']
+    return shown
+
+
+class TestSessionPool(object):
+    def setup_method(self, method):
+        config.set('stata_path', fake_stata_path())
+        config.set('execution_mode', 'console')
+        config.set('parallel_pool_size', '2')
+        self.kernel = FakeKernel()
+        self.pool = SessionPool(self.kernel)
+
+    def teardown_method(self, method):
+        self.pool.shutdown()
+        config._remove_unsafe('parallel_pool_size')
+
+    def run(self, *codes):
+        async def main():
+            self.cells = [ParallelCell(self.kernel) for code in codes]
+            return await asyncio.gather(*[
+                self.pool.run(code, cell)
+                for code, cell in zip(codes, self.cells)])
+
+        return asyncio.run(main())
+
+    def test_runs_in_parallel(self):
+        # Start both workers first, so that only running code is timed
+        self.run('di 0', 'di 0')
+        start = default_timer()
+        results = self.run('fake_sleep 0.5\ndi 1', 'fake_sleep 0.5\ndi 2')
+        assert default_timer() - start < 0.9
+        assert [res.strip() for rc, res in results] == ['1', '2']
+
+    def test_pool_size(self):
+        """Cells queue for an idle worker beyond `parallel_pool_size`"""
+        results = self.run(*['di {}'.format(i) for i in range(5)])
+        assert [res.strip() for rc, res in results] == [
+            str(i) for i in range(5)]
+        assert len(self.pool.workers) == 2
+
+    def test_output_in_own_display(self):
+        self.run('di "first"', 'fake_error 111')
+        shown = list(displays(self.kernel).values())
+        assert len(shown) == 2
+        assert shown[0]['text/plain'].strip() == 'first'
+        assert 'r(111);' in shown[1]['text/plain']
+        assert 'finished with r(111)' in shown[1]['text/plain']
+
+    def test_graphs_in_worker_cache_dir(self):
+        self.run('scatter y x', 'scatter y x')
+        paths = [
+            path for cell in self.cells for data in cell.images
+            for path in data['text/plain'].split('\n')]
+        cache_dir = config.get('cache_dir')
+        assert sorted({Path(path).parent for path in paths}) == [
+            cache_dir / 'worker1', cache_dir / 'worker2']
+
+    def test_worker_exits(self):
+        """A worker whose Stata exits is replaced by a new one"""
+        results = self.run('fake_crash 4')
+        assert results == [(1, '')]
+        assert 'exited with status 4' in self.cells[0].text.text()
+        assert self.pool.workers == []
+
+        results = self.run('di 1')
+        assert results[0][1].strip() == '1'
+        assert [worker.name for worker in self.pool.workers] == ['worker2']
+
+    def test_updates_throttled(self):
+        """Output is shown at most once per interval, and always at the end"""
+        config.set('output_flush_interval', '200')
+        config.set('output_flush_bytes', '1000')
+        try:
+            start = default_timer()
+            self.run('fake_output 20000')
+        finally:
+            config._remove_unsafe('output_flush_interval')
+            config._remove_unsafe('output_flush_bytes')
+        updates = [
+            content for msg_type, content in self.kernel.messages
+            if msg_type == 'update_display_data']
+        assert len(updates) <= 3 + (default_timer() - start) / 0.2
+        assert updates[-1]['data']['text/plain'].rstrip().endswith(
+            'line 19999')
+
+    def test_text_bounded(self):
+        """The display only keeps the end of a large output"""
+        config.set('output_max_bytes', '1000')
+        try:
+            cell = ParallelCell(self.kernel)
+        finally:
+            config._remove_unsafe('output_max_bytes')
+        lines = ['{:<59}\n'.format(i) for i in range(50)]
+
+        async def run():
+            output = OutputBuffer(cell)
+            for line in lines:
+                output.write(line)
+            output.close()
+            cell.finish(0)
+
+        asyncio.run(run())
+
+        shown = displays(self.kernel)[cell.display_id]['text/plain']
+        notice, rest = shown.split('\n', 1)
+        assert len(rest) <= 100
+        assert ''.join(lines).endswith(rest)
+        assert notice == '... {:,} characters of output not shown'.format(
+            len(''.join(lines)) - len(rest))
+        assert len(cell.text.text()) <= 100
@@ -0,0 +1,319 @@
+import os
+import asyncio
+
+from types import SimpleNamespace
+from fake_stata import FakeKernel, start_session
+from test_stata_session import run
+from stata_kernel.config import config
+from stata_kernel.kernel import StataKernel, POST_HOOK, post_hook
+from stata_kernel.completions import CompletionsManager
+from stata_kernel.stata_magics import StataMagics
+
+
+class HookKernel(FakeKernel):
+    """Stand-in with `StataKernel`'s own hook after each cell"""
+    magics = SimpleNamespace(available_magics=['%set'])
+    interrupt = None
+    sc_delimit_mode = False
+    post_hook_task = None
+    settle = StataKernel.settle
+    post_do_hook = StataKernel.post_do_hook
+    quickdo = StataKernel.quickdo
+    cleanTail = StataKernel.cleanTail
+    cleanHead = StataKernel.cleanHead
+    do_complete = StataKernel.do_complete
+
+
+class CellKernel(HookKernel):
+    """Stand-in that runs cells with `StataKernel.do_execute`"""
+    implementation = StataKernel.implementation
+    language = StataKernel.language
+    language_version = '17'
+    output_keep = StataKernel.output_keep
+    execution_count = 1
+    shell_stream = None
+    msg_queue = None
+    requests_queued = StataKernel.requests_queued
+    do_execute = StataKernel.do_execute
+    is_complete = StataKernel.is_complete
+    cell_timeout = StataKernel.cell_timeout
+    interrupt_on_sigint = StataKernel.interrupt_on_sigint
+
+
+def start_kernel(cls=HookKernel):
+    kernel = cls()
+    kernel.stata = start_session(kernel)
+    kernel.completions = CompletionsManager(kernel)
+    if cls is CellKernel:
+        kernel.magics = StataMagics(kernel)
+    return kernel
+
+
+class TestPostHook(object):
+    @classmethod
+    def setup_class(cls):
+        cls.kernel = start_kernel()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.kernel.stata.shutdown()
+
+    def test_one_round_trip(self):
+        kernel = self.kernel
+        run(kernel.stata, 'fake_data price\nglobal who a\nset linesize 100')
+        calls = []
+        do_async = kernel.stata.do_async
+
+        def counted(*args, **kwargs):
+            calls.append(args)
+            return do_async(*args, **kwargs)
+
+        kernel.stata.do_async = counted
+        try:
+            asyncio.run(kernel.post_do_hook())
+        finally:
+            del kernel.stata.do_async
+            run(kernel.stata, 'set linesize 80')
+
+        assert len(calls) == 1
+        assert kernel.stata.linesize == 100
+        assert kernel.stata.cwd == os.getcwd()
+        assert kernel.completions.globals['who'] == 'a'
+        assert kernel.completions.suggestions['varlist'] == ['price']
+        assert 'who' in kernel.completions.suggestions['globals']
+        assert kernel.completions.suggestions['programs'] == []
+        assert kernel.completions.suggestions['magics'] == ['%set']
+
+    def test_lazy(self):
+        """With `autocomplete_refresh = lazy`, completions are read when a
+        completion needs them"""
+        kernel = self.kernel
+        config.set('autocomplete_refresh', 'lazy')
+        try:
+            run(kernel.stata, 'fake_data weight')
+            asyncio.run(kernel.post_do_hook())
+            assert kernel.completions.stale
+            assert kernel.completions.suggestions['varlist'] != ['weight']
+
+            asyncio.run(kernel.do_complete('%se', 3))
+            assert kernel.completions.stale
+            reply = asyncio.run(kernel.do_complete('sum wei', 7))
+        finally:
+            config._remove_unsafe('autocomplete_refresh')
+        assert reply['matches'] == ['weight']
+        assert not kernel.completions.stale
+
+    def test_sections(self):
+        """The sections of the real helper's output, with wrapped lines"""
+        res = '\n'.join([
+            '%locals%', 'alpha be', '> ta', '%linesize%', '120', '%pwd%',
+            '/home/user/my project', '%macros%',
+            'S_OS:           Unix', 'who:            a b', '%mata%',
+            '%varlist%', 'price mpg', '%globals%', 'S_OS who', '%logfiles%',
+            '%scalars%', '%programs%', '  ado      100  _StataKernelPostHook',
+            '         --------', '              100', '%matrices%', ''])
+        match = post_hook(res)
+        assert match.group('linesize') == '120'
+        assert match.group('pwd') == '/home/user/my project'
+        assert match.group('completions').startswith('%mata%\n%varlist%')
+
+        completions = self.kernel.completions
+        assert completions.parse_globals(match.group('macros')) == {
+            'S_OS': 'Unix', 'who': 'a b'}
+        suggestions = completions.parse_suggestions(
+            completions.matchall(match.group('completions')),
+            match.group('locals'))
+        assert suggestions['locals'] == ['alpha', 'beta']
+        assert suggestions['varlist'] == ['price', 'mpg']
+        assert suggestions['programs'] == []
+
+    def test_unchanged(self):
+        """Lists are only printed again when their signature changes"""
+        kernel = self.kernel
+        run(kernel.stata, 'fake_data height\nglobal what a')
+        asyncio.run(kernel.post_do_hook())
+        suggestions = kernel.completions.suggestions
+
+        # As a wide command would
+        run(kernel.stata, 'global stata_kernel_linesize 80')
+        res = asyncio.run(kernel.quickdo(POST_HOOK))
+        sections = kernel.completions.matchall(post_hook(res).group(
+            'completions')).groupdict()
+        assert sections['varlist'].strip() == '%unchanged%'
+        assert sections['globals'].strip() == '%unchanged%'
+
+        run(kernel.stata, 'fake_data width')
+        asyncio.run(kernel.post_do_hook())
+        assert kernel.completions.suggestions['varlist'] == ['width']
+        assert kernel.completions.suggestions['globals'] is (
+            suggestions['globals'])
+        assert 'what' in suggestions['globals']
+        assert not [
+            name for name in suggestions['globals']
+            if name.startswith('stata_kernel_')]
+
+    def test_sections_unchanged(self):
+        res = '\n'.join([
+            '%mata%', '%varlist%', '%unchanged%', '%globals%', 'S_OS who',
+            '%logfiles%', '%scalars%', '%unchanged%', '%programs%',
+            '  ado      100  _StataKernelPostHook', '%matrices%', ''])
+        completions = CompletionsManager.__new__(CompletionsManager)
+        completions.__dict__.update(self.kernel.completions.__dict__)
+        completions.listings = {}
+        first = completions.parse_suggestions(completions.matchall(res), '')
+        assert first['varlist'] == ['%unchanged%']
+
+        previous = {'varlist': ['price'], 'scalars': ['s'], 'programs': []}
+        suggestions = completions.parse_suggestions(
+            completions.matchall(res), '', previous)
+        assert suggestions['varlist'] == ['price']
+        assert suggestions['scalars'] == ['s']
+        assert suggestions['globals'] == ['S_OS', 'who']
+        assert suggestions['programs'] is previous['programs']
+
+    def test_sections_lazy(self):
+        res = '\n'.join([
+            '%locals%', '%linesize%', '80', '%pwd%', '/tmp', '%logfiles%',
+            '/tmp/a.log', '/tmp/b.smcl', ''])
+        match = post_hook(res)
+        assert match.group('completions') is None
+        completions = self.kernel.completions
+        try:
+            completions.mark_stale(match.group('logfiles'))
+            assert completions.suggestions['logfiles'] == [
+                '/tmp/a.log', '/tmp/b.smcl']
+        finally:
+            completions.mark_stale('')
+
+
+class TestUserLog(object):
+    """Only the user's code and its output are left in the user's logs"""
+
+    @classmethod
+    def setup_class(cls):
+        cls.kernel = start_kernel()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.kernel.stata.shutdown()
+
+    def test_markers_removed(self, tmp_path):
+        kernel = self.kernel
+        path = str(tmp_path / 'user.log')
+        kernel.completions.suggestions['logfiles'] = [path]
+        config.set('pager', 'False')
+        try:
+            run(kernel.stata, 'log using "{}", text'.format(path))
+            run(kernel.stata, 'di "hello"')
+            asyncio.run(kernel.quickdo('di "wide"'))
+            with open(path, encoding='utf-8') as f:
+                log = f.read()
+        finally:
+            config._remove_unsafe('pager')
+            kernel.completions.suggestions['logfiles'] = []
+            run(kernel.stata, 'log close\nset more on')
+
+        assert '. di "hello"\nhello\n' in log
+        assert '. di "wide"\nwide\n' in log
+        assert '<<stata_kernel' not in log
+        assert 'set more' not in log
+        assert 'linesize' not in log
+
+
+class TestAfterReply(object):
+    """The post-hook runs after the reply has been sent"""
+
+    @classmethod
+    def setup_class(cls):
+        cls.kernel = start_kernel(CellKernel)
+
+    @classmethod
+    def teardown_class(cls):
+        cls.kernel.stata.shutdown()
+
+    def test_previous_snapshot(self):
+        kernel = self.kernel
+
+        async def cell():
+            reply = await kernel.do_execute('global who b', False)
+            assert not kernel.post_hook_task.done()
+            assert 'who' not in kernel.completions.suggestions['globals']
+            reply = await kernel.do_complete('di $wh', 6)
+            assert reply['matches'] == []
+            await kernel.settle()
+            return reply
+
+        asyncio.run(cell())
+        assert kernel.post_hook_task is None
+        assert kernel.completions.globals['who'] == 'b'
+
+    def test_next_cell_waits(self):
+        kernel = self.kernel
+
+        async def cells():
+            await kernel.do_execute('cap fake_error 7', False)
+            kernel.messages = []
+            reply = await kernel.do_execute('di _rc', False)
+            await kernel.settle()
+            return reply
+
+        reply = asyncio.run(cells())
+        assert reply['status'] == 'ok'
+        assert kernel.stdout().strip() == '7'
+
+    def test_run_all(self):
+        """Completions are only read after the last queued cell"""
+        kernel = self.kernel
+        cells = ['global run 1', 'global run 2', 'fake_data run']
+        hooks = []
+        post_do_hook = kernel.post_do_hook
+
+        async def counted(completions=None):
+            hooks.append(completions)
+            return await post_do_hook(completions)
+
+        async def run_all():
+            kernel.msg_queue = asyncio.Queue()
+            for code in cells:
+                kernel.msg_queue.put_nowait(code)
+            while not kernel.msg_queue.empty():
+                code = kernel.msg_queue.get_nowait()
+                await kernel.do_execute(code, False)
+                await kernel.settle()
+                assert kernel.completions.stale != kernel.msg_queue.empty()
+
+        kernel.post_do_hook = counted
+        try:
+            asyncio.run(run_all())
+        finally:
+            del kernel.post_do_hook
+            kernel.msg_queue = None
+        assert hooks == [False, False, None]
+        assert not kernel.completions.stale
+        assert kernel.completions.globals['run'] == '2'
+        assert kernel.completions.suggestions['varlist'] == ['run']
+
+    def test_run_all_do_file(self, tmp_path):
+        """A queued cell's do file can set the linesize and open a log"""
+        kernel = self.kernel
+        log = tmp_path / 'queued.log'
+        do_file = tmp_path / 'settings.do'
+        do_file.write_text(
+            'set linesize 100\nlog using "{}", text\n'.format(log))
+
+        async def queued(code):
+            kernel.msg_queue = asyncio.Queue()
+            kernel.msg_queue.put_nowait('next')
+            await kernel.do_execute(code, False)
+            await kernel.settle()
+
+        try:
+            asyncio.run(queued('do "{}"'.format(do_file)))
+            assert kernel.stata.linesize == 100
+            assert kernel.completions.suggestions['logfiles'] == [str(log)]
+            assert kernel.completions.stale
+        finally:
+            kernel.msg_queue = None
+            run(kernel.stata, 'log close\nset linesize 80')
+            asyncio.run(kernel.post_do_hook())
+        assert kernel.stata.linesize == 80
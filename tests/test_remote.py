@@ -0,0 +1,135 @@
+import os
+import zlib
+import socket
+import asyncio
+import threading
+import pexpect
+import pytest
+
+from time import sleep
+from timeit import default_timer
+from fake_stata import fake_stata_path, start_session
+from test_stata_session import run, run_async
+from stata_kernel.config import config
+from stata_kernel.remote import (
+    Agent, RemoteConsole, HELLO, INPUT, OUTPUT, RAW_OUTPUT, frame,
+    output_frame, unframe)
+
+
+def test_unframe_partial():
+    """Frames split across reads are only taken once complete"""
+    data = frame(INPUT, b'di 1\n') + output_frame(b'x' * 5000)
+    buffer = bytearray()
+    frames = []
+    for i in range(0, len(data), 7):
+        buffer += data[i:i + 7]
+        frames += unframe(buffer)
+    assert not buffer
+    assert frames[0] == (INPUT, b'di 1\n')
+    assert frames[1][0] == OUTPUT
+    assert zlib.decompress(frames[1][1]) == b'x' * 5000
+
+
+def test_output_frame_small():
+    assert output_frame(b'. ') == frame(RAW_OUTPUT, b'. ')
+
+
+def test_unframe_too_large():
+    with pytest.raises(ValueError):
+        unframe(bytearray(b'I\xff\xff\xff\xff'))
+
+
+class TestRemote(object):
+    """A session driving fake Stata through an agent on localhost"""
+
+    token = 'secret-token'
+
+    @classmethod
+    def setup_class(cls):
+        cls.agent = Agent(fake_stata_path(), cls.token)
+        cls.thread = threading.Thread(
+            target=cls.agent.serve_forever, daemon=True)
+        cls.thread.start()
+        config.set('remote_agent', '{}:{}'.format(*cls.agent.server_address))
+        config.set('remote_agent_token', cls.token)
+        cls.session = start_session()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.session.shutdown()
+        config._remove_unsafe('remote_agent')
+        config._remove_unsafe('remote_agent_token')
+        cls.agent.shutdown()
+        cls.agent.server_close()
+
+    def test_remote(self):
+        assert isinstance(self.session.child, RemoteConsole)
+        assert run(self.session, 'di 1\ndi "a"') == (0, '\n1\na\n\n')
+
+    def test_large_output(self):
+        rc, res = run(self.session, 'fake_output 20000 x')
+        lines = res.strip().split('\n')
+        assert len(lines) == 20000
+        assert lines[-1] == 'x 19999'
+
+    def test_interrupt(self):
+        async def main():
+            interrupt = asyncio.Event()
+            asyncio.get_running_loop().call_later(0.3, interrupt.set)
+            return await run_async(
+                self.session, 'fake_sleep 30\ndi 2', interrupt=interrupt)
+
+        start = default_timer()
+        assert asyncio.run(main()) == (1, '')
+        assert default_timer() - start < 10
+        assert run(self.session, 'di 3') == (0, '\n3\n\n')
+
+    def test_more(self):
+        run(self.session, 'di 1\nmore\ndi 2')
+        texts = [content['text'] for _, content in self.session.kernel.messages]
+        assert texts[-1] == '--more--\n'
+        assert run(self.session, 'di 3') == (0, '\n3\n\n')
+
+    def test_exit(self):
+        """The agent reports the exit status of the remote console"""
+        session = start_session()
+        try:
+            with pytest.raises(pexpect.EOF, match='exited with status 4'):
+                run(session, 'di 1\nfake_crash 4')
+        finally:
+            session.shutdown()
+
+    def test_wrong_token(self):
+        console = RemoteConsole(
+            '{}:{}'.format(*self.agent.server_address), 'wrong', timeout=5)
+        try:
+            with pytest.raises(pexpect.EOF):
+                console.read_nonblocking(100, 5)
+            assert not console.isalive()
+        finally:
+            console.close()
+
+    def test_hello_too_large(self):
+        """The agent hangs up on a client that doesn't send a token first"""
+        sock = socket.create_connection(self.agent.server_address, timeout=5)
+        try:
+            sock.sendall(frame(HELLO, b'x' * 2000))
+            assert sock.recv(100) == b''
+        finally:
+            sock.close()
+
+    def test_disconnect_kills_console(self):
+        before = set(self.agent.consoles)
+        session = start_session()
+        child, = self.agent.consoles - before
+        session.shutdown()
+
+        deadline = default_timer() + 10
+        while default_timer() < deadline:
+            try:
+                os.kill(child.pid, 0)
+            except ProcessLookupError:
+                break
+            sleep(0.05)
+        else:
+            pytest.fail('console was not killed')
@@ -0,0 +1,198 @@
+import asyncio
+import pexpect
+import pexpect.fdpexpect
+import pytest
+
+from timeit import default_timer
+
+from stata_kernel.scanner import (
+    LineScanner, CellTimeout, MD5, ERROR, GRAPH, MORE, EOL, EOF, run,
+    run_async)
+
+patterns = {
+    MD5: r"\. `abc'",
+    ERROR: r'^r\((?P<rc>\d+)\);',
+    GRAPH: r'\(?file /tmp/cache'}
+
+
+class FakeChild(object):
+    """Child that hands out a fixed list of chunks
+
+    A chunk of None times out and a chunk of `pexpect.EOF` reports the end of
+    the output once, like a log file that hasn't been written to yet.
+    """
+
+    def __init__(self, chunks, buffer=''):
+        self.chunks = list(chunks)
+        self.buffer = buffer
+
+    def read_nonblocking(self, size, timeout):
+        if not self.chunks:
+            raise pexpect.EOF('done')
+        chunk = self.chunks.pop(0)
+        if chunk is None:
+            raise pexpect.TIMEOUT('timeout')
+        if chunk is pexpect.EOF:
+            raise pexpect.EOF('not written yet')
+        return chunk
+
+
+def scan(chunks, buffer=''):
+    scanner = LineScanner(FakeChild(chunks, buffer), patterns)
+    kinds = []
+    while True:
+        kind, line, match = run(scanner.next(), scanner.child)
+        kinds.append((kind, line))
+        if kind in [MD5, MORE, EOF]:
+            return kinds
+
+
+class TestLineScanner(object):
+    def test_lines_split_across_chunks(self):
+        kinds = scan(['. di 1\r\n1\r', '\n\r\nr(111);\r\n', ". `abc'\r\n"])
+        assert kinds == [
+            (EOL, '. di 1'), (EOL, '1'), (EOL, ''), (ERROR, 'r(111);'),
+            (MD5, ". `abc'")]
+
+    def test_starts_from_child_buffer(self):
+        kinds = scan([". `abc'\r\n"], buffer='left\r\nover\r\n')
+        assert kinds == [(EOL, 'left'), (EOL, 'over'), (MD5, ". `abc'")]
+
+    def test_graph_line_starts_at_match(self):
+        kinds = scan(['  (file /tmp/cache/graph0.svg written)\r\n'])
+        assert kinds[0] == (GRAPH, '(file /tmp/cache/graph0.svg written)')
+
+    def test_more_without_newline(self):
+        kinds = scan(['a\r\n--more--'])
+        assert kinds == [(EOL, 'a'), (MORE, '--more--')]
+
+    def test_eof(self):
+        assert scan(['a\r\n', 'b']) == [(EOL, 'a'), (EOF, '')]
+
+    def test_timeout(self):
+        scanner = LineScanner(FakeChild(['a', None]), patterns)
+        with pytest.raises(pexpect.TIMEOUT):
+            run(scanner.next(timeout=0), scanner.child)
+
+    def test_continues(self):
+        scanner = LineScanner(FakeChild(['a\r\n>', ' b\r\nc\r\n']), patterns)
+        assert run(scanner.readline(), scanner.child) == 'a'
+        assert run(scanner.continues('> '), scanner.child)
+        assert run(scanner.readline(), scanner.child) == '> b'
+        assert not run(scanner.continues('> '), scanner.child)
+
+    def test_release(self):
+        child = FakeChild(['a\r\nb\r\nc'])
+        scanner = LineScanner(child, patterns)
+        assert run(scanner.readline(), scanner.child) == 'a'
+        scanner.release('rest')
+        assert child.buffer == 'restb\r\nc'
+
+    def test_eof_mid_line(self):
+        chunks = ['a\r\nb', pexpect.EOF, 'c\r\n']
+        scanner = LineScanner(FakeChild(chunks), patterns)
+        assert run(scanner.next(), scanner.child) == (EOL, 'a', None)
+        assert run(scanner.next(), scanner.child)[0] == EOF
+        assert run(scanner.next(), scanner.child) == (EOL, 'bc', None)
+
+    def test_at_more(self):
+        scanner = LineScanner(FakeChild(['a\r\n--more--']), patterns)
+        assert run(scanner.readline(), scanner.child) == 'a'
+        assert run(scanner.readline(), scanner.child) is None
+        assert scanner.at_more()
+
+    def test_resume(self):
+        """Paging on drops the prompt and what erases it, and nothing else"""
+        child = FakeChild(['a\r\n--more--', '\r', '        \r  b\r\n'])
+        child.sent = []
+        child.send = child.sent.append
+        scanner = LineScanner(child, patterns)
+        assert run(scanner.next(), child) == (EOL, 'a', None)
+        assert run(scanner.next(), child)[0] == MORE
+        scanner.resume()
+        assert child.sent == [' ']
+        assert run(scanner.next(), child) == (EOL, '  b', None)
+
+    def test_release_to_pexpect(self, tmp_path):
+        """The next `child.expect` starts from what was released"""
+        log = tmp_path / 'log.log'
+        log.write_text('one\r\ntwo\r\nthree\r\n')
+        with log.open() as f:
+            child = pexpect.fdpexpect.fdspawn(f, encoding='utf-8')
+            child.expect('one')
+            scanner = LineScanner(child, patterns)
+            assert run(scanner.readline(), scanner.child) == ''
+            assert run(scanner.readline(), scanner.child) == 'two'
+            scanner.release()
+            child.expect('\r\n')
+            assert child.before == 'three'
+
+    def test_readuntil(self):
+        chunks = ['a\r\nb `x', pexpect.EOF, "yz\' c\r\nd\r\n"]
+        scanner = LineScanner(FakeChild(chunks), patterns)
+        before, match = run(scanner.readuntil(r"yz'[^\n]*\n"), scanner.child)
+        assert match is None
+        before, match = run(scanner.readuntil(r"yz'[^\n]*\n"), scanner.child)
+        assert before == 'a\r\nb `x'
+        assert run(scanner.readline(), scanner.child) == 'd'
+
+    def test_deadline(self):
+        """Waits past the scanner's deadline raise `CellTimeout`"""
+        scanner = LineScanner(FakeChild([None, 'a\r\n', None]), patterns)
+        scanner.deadline = default_timer() + 60
+        before, match = run(scanner.readuntil('a'), scanner.child)
+        assert match is not None
+
+        scanner.deadline = default_timer()
+        with pytest.raises(CellTimeout):
+            run(scanner.readuntil('b'), scanner.child)
+        with pytest.raises(CellTimeout):
+            run(scanner.readline(), scanner.child)
+
+
+class TestRunAsync(object):
+    def test_loop_free_while_waiting(self):
+        """The loop runs other tasks while the pty is quiet"""
+        child = pexpect.spawn(
+            'sh', ['-c', 'sleep 0.3; echo done'], encoding='utf-8')
+        scanner = LineScanner(child, patterns)
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0.01)
+
+        async def main():
+            ticker = asyncio.ensure_future(tick())
+            try:
+                return await run_async(scanner.next(), child)
+            finally:
+                ticker.cancel()
+
+        try:
+            assert asyncio.run(main()) == (EOL, 'done', None)
+        finally:
+            child.close(force=True)
+        assert len(ticks) > 10
+
+    def test_interrupt(self):
+        """Setting the interrupt event throws KeyboardInterrupt in"""
+        child = pexpect.spawn('sleep', ['5'], encoding='utf-8')
+        scanner = LineScanner(child, patterns)
+
+        def steps():
+            try:
+                yield from scanner.next()
+            except KeyboardInterrupt:
+                return 'interrupted'
+
+        async def main():
+            interrupt = asyncio.Event()
+            asyncio.get_running_loop().call_later(0.1, interrupt.set)
+            return await run_async(steps(), child, interrupt)
+
+        try:
+            assert asyncio.run(main()) == 'interrupted'
+        finally:
+            child.close(force=True)
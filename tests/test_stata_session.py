@@ -0,0 +1,528 @@
+import os
+import re
+import signal
+import asyncio
+import tempfile
+import threading
+import pexpect
+import pytest
+
+from pathlib import Path
+from time import sleep
+from timeit import default_timer
+from collections import deque
+from types import SimpleNamespace
+from fake_stata import FakeKernel, start_session
+from test_scanner import FakeChild
+from stata_kernel.config import config
+from stata_kernel.scanner import (
+    LineScanner, CellTimeout, MD5, ERROR, GRAPH, READ, run as drive)
+from stata_kernel.code_manager import CodeManager
+from stata_kernel.stata_session import StataSession, Matchers
+
+
+def run(session, code, **kwargs):
+    session.kernel.messages = []
+    cm = CodeManager(code)
+    text_to_run, md5, text_to_exclude = cm.get_text(session)
+    return session.do(
+        text_to_run, md5, text_to_exclude=text_to_exclude, **kwargs)
+
+
+def run_async(session, code, **kwargs):
+    session.kernel.messages = []
+    cm = CodeManager(code)
+    text_to_run, md5, text_to_exclude = cm.get_text(session)
+    return session.do_async(
+        text_to_run, md5, text_to_exclude=text_to_exclude, **kwargs)
+
+
+def graph_paths(session):
+    return [
+        content['graph_paths'] for msg_type, content in session.kernel.messages
+        if msg_type == 'display_data']
+
+
+class TestExpect(object):
+    """Console output handling in `StataSession.expect`"""
+
+    @classmethod
+    def setup_class(cls):
+        cls.session = start_session()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.session.shutdown()
+
+    def teardown_method(self, method):
+        # Every test leaves the console in sync for the next cell
+        assert run(self.session, 'di 41 + 1') == (0, '\n42\n\n')
+
+    def test_output(self):
+        rc, res = run(self.session, 'di 1\ndi "a"')
+        assert (rc, res) == (0, '\n1\na\n\n')
+        assert self.session.kernel.stdout() == '\n1\na\n'
+
+    def test_long_echo(self):
+        """Echoed code wrapped with `> ` continuations is removed"""
+        line = 'di "{}"'.format('a' * 150)
+        rc, res = run(self.session, line)
+        assert res.strip() == 'a' * 150
+        rc, res = run(self.session, 'di 5\n{}\ndi 6'.format(line))
+        assert res.strip() == '5\n{}\n6'.format('a' * 150)
+
+    def test_error_with_rest_of_line(self):
+        rc, res = run(self.session, 'di "r(111); trailing"')
+        assert rc == 111
+        assert self.session.kernel.messages[0] == (
+            'stream', {'text': 'r(111);\n', 'name': 'stderr'})
+        assert self.session.kernel.stdout().strip() == 'trailing'
+
+    def test_more(self):
+        """Output stops at the pager, which is broken out of"""
+        rc, res = run(self.session, 'di 1\nmore\ndi 2')
+        texts = [content['text'] for _, content in self.session.kernel.messages]
+        assert texts[-1] == '--more--\n'
+        assert '2' not in ''.join(texts)
+
+    def test_interrupt(self):
+        """A break stops the command and the next cell starts in sync"""
+        timer = threading.Timer(0.3, os.kill, [os.getpid(), signal.SIGINT])
+        timer.start()
+        start = default_timer()
+        rc, res = run(self.session, 'di 1\nfake_sleep 30\ndi 2')
+        assert default_timer() - start < 10
+        assert rc == 1
+        assert '2' not in self.session.kernel.stdout()
+
+    def test_do_async(self):
+        """The event loop keeps running while Stata is busy"""
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0.01)
+
+        async def main():
+            ticker = asyncio.ensure_future(tick())
+            try:
+                return await run_async(self.session, 'fake_sleep 0.5\ndi 3')
+            finally:
+                ticker.cancel()
+
+        assert asyncio.run(main()) == (0, '\n3\n\n')
+        assert len(ticks) > 20
+
+    def test_do_async_interrupt(self):
+        async def main():
+            interrupt = asyncio.Event()
+            asyncio.get_running_loop().call_later(0.3, interrupt.set)
+            return await run_async(
+                self.session, 'fake_sleep 30\ndi 2', interrupt=interrupt)
+
+        start = default_timer()
+        assert asyncio.run(main()) == (1, '')
+        assert default_timer() - start < 10
+
+    def test_timeout(self):
+        """A cell past its timeout is broken out of like an interrupt"""
+        start = default_timer()
+        rc, res = run(self.session, 'di 1\nfake_sleep 30\ndi 2', timeout=0.5)
+        assert 0.5 <= default_timer() - start < 10
+        assert rc == 1
+        assert self.session.kernel.stdout().strip() == '1'
+        assert self.session.kernel.messages[-1] == (
+            'stream', {
+                'text': (
+                    'stata_kernel error: the cell was stopped after 0.5 '
+                    'seconds.\n'),
+                'name': 'stderr'})
+
+    def test_timeout_not_reached(self):
+        assert run(self.session, 'fake_sleep 0.2\ndi 2', timeout=5) == (
+            0, '\n2\n\n')
+
+    def test_matchers_reused(self):
+        """Output regexes are compiled again only when their inputs change"""
+        run(self.session, 'di 1')
+        matchers = self.session.matchers
+        run(self.session, 'di 2')
+        assert self.session.matchers is matchers
+
+        self.session.kernel.graph_formats = ['svg']
+        try:
+            run(self.session, 'di 3')
+        finally:
+            del self.session.kernel.graph_formats
+        assert self.session.matchers is not matchers
+        assert self.session.matchers.not_found(
+            '(file {}/graph1.svg not found)'.format(
+                self.session.cache_dir_str))
+
+    def test_timeout_async(self):
+        async def main():
+            return await run_async(
+                self.session, 'fake_sleep 30\ndi 2', timeout=0.5)
+
+        start = default_timer()
+        assert asyncio.run(main()) == (1, '')
+        assert default_timer() - start < 10
+        assert 'stopped after' in self.session.kernel.messages[-1][1]['text']
+
+    def test_pager_off(self):
+        """With `pager` off, output that turns `more` on isn't cut short"""
+        child = self.session.child
+        sent = []
+        child.sendcontrol = sent.append
+        config.set('pager', 'False')
+        try:
+            rc, res = run(
+                self.session, 'set more on\nset pagesize 100\nfake_list 10000')
+            shown = self.session.kernel.stdout()
+        finally:
+            config._remove_unsafe('pager')
+            del child.sendcontrol
+            run(self.session, 'set more on')
+        expected = ''.join('line {}\n'.format(i) for i in range(10000))
+        assert rc == 0
+        assert res.strip() == expected.strip()
+        assert shown.strip() == expected.strip()
+        assert sent == []
+
+    def test_pager_off_next_cell(self):
+        """`more` turned on by a cell is off again for the next one"""
+        child = self.session.child
+        keys = []
+        send = child.send
+        child.send = lambda s: keys.append(s) or send(s)
+        config.set('pager', 'False')
+        try:
+            run(self.session, 'set more on')
+            rc, res = run(self.session, 'fake_list 10000')
+        finally:
+            config._remove_unsafe('pager')
+            del child.send
+            run(self.session, 'set more on')
+        assert rc == 0
+        assert res.strip().split('\n')[-1] == 'line 9999'
+        assert ' ' not in keys
+
+    def test_more_async(self):
+        async def main():
+            return await run_async(self.session, 'di 1\nmore\ndi 2')
+
+        rc, res = asyncio.run(main())
+        texts = [content['text'] for _, content in self.session.kernel.messages]
+        assert texts[-1] == '--more--\n'
+
+    def test_sentinel_rc(self):
+        """The end marker reports `_rc` and the sequence number increases"""
+        sequence = self.session.sequence
+        rc, res = run(self.session, 'cap fake_error 7\ndi 1')
+        assert (rc, res.strip()) == (0, '1')
+        assert self.session.user_rc == 7
+        assert self.session.sequence == sequence + 1
+
+    def test_stale_output(self):
+        """Output left over from earlier is skipped up to the begin marker"""
+        self.session.child.sendline('di "stale"')
+        rc, res = run(self.session, 'di "fresh"')
+        assert (rc, res.strip()) == (0, 'fresh')
+        assert 'stale' not in self.session.kernel.stdout()
+
+    def test_sentinel_mata(self):
+        """Mata has no `display`, so the md5 marks the end as before"""
+        self.session.mata_mode = True
+        try:
+            assert self.session.sentinel("x = 1\n`abc'", 'abc') is None
+        finally:
+            self.session.mata_mode = False
+        sentinel = self.session.sentinel("di 1\n`abc'", 'abc')
+        assert sentinel.text.split('\n') == [
+            sentinel.begin, 'di 1', sentinel.end]
+
+    @pytest.mark.parametrize('graph_format', [None, 'svg'])
+    def test_graph(self, graph_format):
+        """Redundant exports are sent together with `graph_format` set"""
+        if graph_format:
+            config.set('graph_format', graph_format)
+        try:
+            rc, res = run(self.session, 'scatter y x')
+        finally:
+            config._remove_unsafe('graph_format')
+
+        cache = str(config.get('cache_dir'))
+        paths = graph_paths(self.session)
+        if graph_format:
+            assert len(paths) == 1
+            paths = paths[0]
+        else:
+            paths = [path for paths in paths for path in paths]
+        assert [Path(path).parent for path in paths] == [Path(cache)] * 2
+        assert [Path(path).suffix for path in paths] == ['.svg', '.pdf']
+        assert rc == 0 and not res.strip()
+
+    def test_graph_long_path(self):
+        """The graph note is written at the largest linesize, so that a long
+        cache directory doesn't wrap it, and the linesize is set back"""
+        cache_dir = config.get('cache_dir')
+        long_dir = Path(tempfile.mkdtemp()) / ('x' * 60)
+        config.set('cache_dir', long_dir)
+        try:
+            rc, res = run(self.session, 'scatter y x')
+        finally:
+            config.set('cache_dir', cache_dir)
+
+        paths = [path for paths in graph_paths(self.session) for path in paths]
+        assert len(paths) == 2
+        for path in paths:
+            assert re.match(r'graph\d+\.(svg|pdf)$', Path(path).name)
+            assert Path(path).parent == long_dir
+        assert run(self.session, "di `c(linesize)'")[1].strip() == '80'
+
+    def test_graph_redundancy_off(self):
+        """Without the PDF copy grouped in, each export is shown by itself"""
+        config.set('graph_format', 'svg')
+        config.set('graph_svg_redundancy', 'False')
+        try:
+            rc, res = run(self.session, 'scatter y x')
+        finally:
+            config._remove_unsafe('graph_format')
+            config._remove_unsafe('graph_svg_redundancy')
+        assert [len(paths) for paths in graph_paths(self.session)] == [1]
+        assert rc == 0
+
+    def test_graph_in_order(self):
+        """A graph being loaded holds back later output, not the console"""
+        kernel = self.session.kernel
+
+        def graph_messages(graph_paths):
+            sleep(1)
+            return FakeKernel.graph_messages(kernel, graph_paths)
+
+        kernel.graph_messages = graph_messages
+        config.set('graph_format', 'svg')
+        try:
+            start = default_timer()
+            rc, res = run(
+                self.session, 'di "a"\nscatter y x\nfake_sleep 1\ndi "b"')
+            elapsed = default_timer() - start
+        finally:
+            del kernel.graph_messages
+            config._remove_unsafe('graph_format')
+
+        shown = [
+            content['text'].strip() if msg_type == 'stream' else 'graph'
+            for msg_type, content in kernel.messages]
+        assert shown == ['a', 'graph', 'b']
+        assert rc == 0
+        assert elapsed < 1.8
+
+    def test_wide(self):
+        """Internal code runs at the largest linesize without wrapping"""
+        line = 'di "{}"'.format('a' * 150)
+        cm = CodeManager("di `c(linesize)'\n" + line)
+        text_to_run, md5, text_to_exclude = cm.get_text(self.session)
+        rc, res = self.session.do(
+            text_to_run, md5, text_to_exclude=text_to_exclude, display=False,
+            wide=True)
+        assert res.strip() == '255\n' + 'a' * 150
+        assert run(self.session, "di `c(linesize)'")[1].strip() == '80'
+
+
+class TestExpectLog(TestExpect):
+    """The same, reading output from the log with `console_output = log`"""
+
+    @classmethod
+    def setup_class(cls):
+        config.set('console_output', 'log')
+        cls.session = start_session()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.session.shutdown()
+        config._remove_unsafe('console_output')
+
+    def test_reads_log(self):
+        assert run(self.session, 'fake_output 3 x')[1].strip() == (
+            'x 0\nx 1\nx 2')
+        log = self.session.log_tail.path.read_text()
+        assert 'x 2\n' in log
+        assert '\n<<stata_kernel|end|{}|'.format(self.session.sequence) in log
+
+
+class TestExit(object):
+    """Stata exiting in the middle of a cell"""
+
+    def teardown_method(self, method):
+        config._remove_unsafe('console_output')
+
+    @pytest.mark.parametrize('output', ['pty', 'log'])
+    def test_exit(self, output):
+        """The cell fails with the exit status instead of waiting forever"""
+        config.set('console_output', output)
+        session = start_session()
+        try:
+            start = default_timer()
+            with pytest.raises(pexpect.EOF, match='exited with status 3'):
+                run(session, 'di 1\nfake_crash 3\ndi 2')
+            assert default_timer() - start < 5
+            assert '1' in session.kernel.stdout()
+
+            # Later cells fail the same way until Stata is restarted
+            with pytest.raises(pexpect.EOF, match='exited with status 3'):
+                run(session, 'di 1')
+            session.restart()
+            assert run(session, 'di 1') == (0, '\n1\n\n')
+        finally:
+            session.shutdown()
+
+    def test_exit_async(self):
+        session = start_session()
+        try:
+            with pytest.raises(pexpect.EOF, match='exited with status 9'):
+                asyncio.run(run_async(session, 'fake_sleep 0.2\nfake_crash 9'))
+        finally:
+            session.shutdown()
+
+    def test_idle_backoff(self):
+        """At the end of a log file, waits grow with the time since output"""
+        session = SimpleNamespace(
+            max_idle_wait=0.5, alive=lambda child: True)
+        scanner = LineScanner(FakeChild([]), TestCleaning.patterns)
+        waits = []
+        for idle in [0, 1, 100]:
+            scanner.last_read = default_timer() - idle
+            steps = StataSession._idle(session, scanner, None)
+            waits.append(next(steps)[1])
+        assert waits[0] < 0.06
+        assert waits[0] < waits[1] <= 0.5
+        assert waits[2] == 0.5
+
+
+class TestCleaning(object):
+    """`expect_graph` and `clean_log_eol` against output split oddly"""
+
+    patterns = {
+        MD5: r"\. `abc'",
+        ERROR: r'^r\((?P<rc>\d+)\);',
+        GRAPH: r'\(?file /tmp/cache'}
+
+    def session(self):
+        prompt_regex = r'^(\s*\d+)?\.  ??(.+)$'
+        session = SimpleNamespace(
+            cache_dir_str='/tmp/cache', kernel=FakeKernel(), linesize=80,
+            mata_mode=False, mata_enter=lambda res: None,
+            matchers=Matchers(
+                '/tmp/cache', FakeKernel.graph_formats, prompt_regex,
+                prompt_regex),
+            max_idle_wait=0.5, alive=lambda child: True)
+        session._idle = lambda *args: StataSession._idle(session, *args)
+        return session
+
+    def test_graph_path_partly_written(self):
+        """Automation mode reads a log file, where EOF is normal mid-line"""
+        scanner = LineScanner(
+            FakeChild([
+                '(file /tmp/cache/gr\r\n', '> aph0.svg wr', pexpect.EOF,
+                'itten in SVG format)\r\n']), self.patterns)
+        kind, res, match = drive(scanner.next(), scanner.child)
+        assert kind == GRAPH
+        path = drive(
+            StataSession.expect_graph(self.session(), scanner, res),
+            scanner.child)
+        assert path == '/tmp/cache/graph0.svg'
+
+    def test_continuation_at_more(self):
+        """`clean_log_eol` leaves a pager prompt for `expect`"""
+        line = 'di "{}"'.format('a' * 100)
+        scanner = LineScanner(
+            FakeChild(['. ' + line[:78] + '\r\n--more--']), self.patterns)
+        res = drive(scanner.readline(), scanner.child)
+        code_lines, res = drive(
+            StataSession.clean_log_eol(
+                self.session(), scanner, deque([line]), res), scanner.child)
+        assert res is None
+        assert scanner.at_more()
+
+    def test_continuation_past_deadline(self):
+        """Waiting for the rest of an echoed line stops at the deadline"""
+        line = 'di "{}"'.format('a' * 100)
+        scanner = LineScanner(
+            FakeChild(['. ' + line[:78] + '\r\n'] + [None] * 100),
+            self.patterns)
+        res = drive(scanner.readline(), scanner.child)
+        scanner.deadline = default_timer()
+        with pytest.raises(CellTimeout):
+            drive(
+                StataSession.clean_log_eol(
+                    self.session(), scanner, deque([line]), res),
+                scanner.child)
+
+    def test_graph_path_past_deadline(self):
+        """Waiting at the end of a log file stops at the deadline"""
+        scanner = LineScanner(
+            FakeChild(
+                ['(file /tmp/cache/gr\r\n', '> aph0.svg wr'] +
+                [pexpect.EOF] * 100),
+            self.patterns)
+        kind, res, match = drive(scanner.next(), scanner.child)
+        scanner.deadline = default_timer() + 0.2
+        start = default_timer()
+        with pytest.raises(CellTimeout):
+            drive(
+                StataSession.expect_graph(self.session(), scanner, res),
+                scanner.child)
+        assert default_timer() - start < 1
+
+    def test_resync_interrupted(self):
+        """Another interrupt while breaking out sends a new break"""
+        session = self.session()
+        breaks = []
+
+        def send_break(child):
+            breaks.append(child)
+            return r'marker{}\r\n'.format(len(breaks))
+
+        session.send_break = send_break
+        session._readuntil = (
+            lambda *args: StataSession._readuntil(session, *args))
+        scanner = LineScanner(FakeChild([]), self.patterns)
+        scanner.deadline = default_timer()
+        steps = StataSession._resync(session, scanner, scanner.child)
+        assert next(steps) == (READ, None)
+        assert steps.throw(KeyboardInterrupt()) == (READ, None)
+        assert len(breaks) == 2
+        with pytest.raises(StopIteration):
+            steps.send('marker1\r\nmarker2\r\n. ')
+        assert scanner.partial == '. '
+
+
+class TestRestart(object):
+    """`restart` with and without a standby console"""
+
+    def teardown_method(self, method):
+        config._remove_unsafe('standby_session')
+
+    @pytest.mark.parametrize('standby', ['True', 'False'])
+    def test_restart(self, standby):
+        config.set('standby_session', standby)
+        session = start_session()
+        try:
+            assert (session.standby_thread is not None) == (standby == 'True')
+            pid = session.child.pid
+            run(session, 'global answer = 42')
+            assert run(session, 'di $answer') == (0, '\n42\n\n')
+
+            session.restart()
+            assert session.child.pid != pid
+            assert run(session, 'di "$answer"')[1].strip() == ''
+            assert run(session, 'di 1') == (0, '\n1\n\n')
+            if standby == 'True':
+                session.standby_thread.join()
+                assert session.standby.child.isalive()
+        finally:
+            session.shutdown()
+        if standby == 'True':
+            assert not session.standby.child.isalive()